@@ -1,18 +1,3688 @@
-import gi
+import subprocess
+import os
+import signal
+import collections
+import threading
+import time
+import sys
+import queue
+import logging
+import json
+import re
+import struct
+import shutil
+import tempfile
+import fcntl
+import glob
+import functools
+import atexit
+import math
+import random
+import argparse
+import configparser
+import shlex
+from concurrent.futures import ThreadPoolExecutor, wait
+
+APP_ID = "suspend-then-hibernate-settings"
+
+log = logging.getLogger(APP_ID)
+
+
+class Span:
+    """One timed operation of a Tracer.
+
+    Used as a context manager the span covers the block and becomes the parent
+    of the spans started inside it on the same thread. Otherwise it runs from
+    its creation until ``end()``, which may be called from another thread.
+    """
+
+    def __init__(self, tracer, name, category, parent, args):
+        self.tracer = tracer
+        self.id = tracer._next_id()
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.args = args
+        self.thread = threading.current_thread()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.scoped = False
+
+    def __enter__(self):
+        self.scoped = True
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.tracer._pop(self)
+        if exc is not None:
+            self.args["error"] = f"{exc_type.__name__}: {exc}"
+        self.end()
+        return False
+
+    def end(self, **args):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.start
+            self.args.update(args)
+            self.tracer._record(self)
+
+
+class Tracer:
+    """Timed spans with parent/child links, exported in the Chrome trace format.
+
+    Every span logs its duration at debug level. Spans are only kept once
+    ``enable`` was called (``--trace FILE``), and are written to that file when
+    the program exits.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.events = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._last_id = 0
+        self._threads = set()
+
+    def enable(self, path):
+        self.path = path
+        atexit.register(self.export)
+
+    def span(self, name, category="app", **args):
+        return Span(self, name, category, self.current(), args)
+
+    def traced(self, name=None, category="app"):
+        """Decorator running every call of a function in a span."""
+        def decorate(func):
+            @functools.wraps(func)
+            def run(*args, **kwargs):
+                with self.span(name or func.__qualname__, category):
+                    return func(*args, **kwargs)
+            return run
+        return decorate
+
+    def current(self):
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else getattr(self._local, "inherited", None)
+
+    def wrap(self, func):
+        """Return ``func`` with the current span as the parent of the spans it starts on another thread."""
+        parent = self.current()
+
+        def run(*args, **kwargs):
+            self._local.inherited = parent
+            return func(*args, **kwargs)
+        return run
+
+    def _next_id(self):
+        with self._lock:
+            self._last_id += 1
+            return self._last_id
+
+    def _push(self, span):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        self._local.stack.append(span)
+
+    def _pop(self, span):
+        self._local.stack.remove(span)
+
+    def _record(self, span):
+        log.debug("%s %s took %.1f ms", span.category, span.name, span.duration * 1000)
+        if self.path is None:
+            return
+        pid, tid = os.getpid(), span.thread.ident
+        args = dict(span.args, span_id=span.id, parent_id=span.parent.id if span.parent else None)
+        start = (span.start - self.origin) * 1e6
+        if span.scoped:
+            events = [{"name": span.name, "cat": span.category, "ph": "X", "ts": start,
+                       "dur": span.duration * 1e6, "pid": pid, "tid": tid, "args": args}]
+        else:
+            # Spans ending on another thread do not nest, they are shown as async events
+            common = {"name": span.name, "cat": span.category, "id": span.id, "pid": pid, "tid": tid}
+            events = [dict(common, ph="b", ts=start, args=args),
+                      dict(common, ph="e", ts=start + span.duration * 1e6)]
+        with self._lock:
+            if tid not in self._threads:
+                self._threads.add(tid)
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                               "args": {"name": span.thread.name}})
+            self.events.extend(events)
+
+    def export(self):
+        with self._lock:
+            events = list(self.events)
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        log.info("Trace of %d events written to %s", len(events), self.path)
+
+
+TRACER = Tracer()
+
+
+def configure_logging(level="info"):
+    # Diagnostics go to stderr, stdout is kept for results
+    debug = level == "debug"
+    logging.basicConfig(
+        level=level.upper(),
+        format="%(relativeCreated)8.0f %(threadName)s %(message)s" if debug else "%(message)s",
+    )
+
+
+# Packages needed by the application itself and by the hibernate configuration step
+GUI_PACKAGES = ["python3-gobject", "polkit", "gettext"]
+HIBERNATE_PACKAGES = ["audit", "policycoreutils-python-utils", "libnotify"]
+REQUIRED_PACKAGES = GUI_PACKAGES + HIBERNATE_PACKAGES
+# Packages each step needs, installed together in one dnf transaction
+STEP_PACKAGES = {
+    "gui": GUI_PACKAGES,
+    "configure": HIBERNATE_PACKAGES,
+    "resume": ["grubby", "dracut"],
+}
+# Steps that installed packages before they were installed in one transaction (the resume step did not)
+LEGACY_PACKAGE_STEPS = ["gui", "configure", "profile"]
+# Repository id given to a local repository directory
+LOCAL_REPO_ID = "suspend-then-hibernate-local"
+
+# Locations of the rpm database, newest layout first
+RPMDB_PATHS = ["/usr/lib/sysimage/rpm", "/var/lib/rpm"]
+
+
+def rooted(root, *parts):
+    return os.path.join(root, *[part.lstrip("/") for part in parts])
+
+
+class PackageInventory:
+    """Installed state of rpm packages, resolved with a single rpm query.
+
+    Every lookup also resolves the packages in ``prefetch`` so that the later
+    steps are answered from the cache. The cache is dropped whenever the rpm
+    database changes on disk. ``root`` selects the rpm database of a sysroot.
+    """
+
+    def __init__(self, prefetch=REQUIRED_PACKAGES, rpmdb_paths=RPMDB_PATHS, root="/"):
+        self.prefetch = list(prefetch)
+        self.root = root
+        self.rpmdb_paths = [rooted(root, path) for path in rpmdb_paths]
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._installed = {}
+
+    def rpmdb_stamp(self):
+        for path in self.rpmdb_paths:
+            try:
+                mtimes = [entry.stat().st_mtime_ns for entry in os.scandir(path)]
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                continue
+            return (path, max(mtimes))
+        return None
+
+    def query(self, packages):
+        with self._lock:
+            stamp = self.rpmdb_stamp()
+            if stamp is None or stamp != self._stamp:
+                self._installed = {}
+                self._stamp = stamp
+
+            unknown = [p for p in dict.fromkeys(list(packages) + self.prefetch) if p not in self._installed]
+            if unknown:
+                log.info(f"Querying rpm for: {' '.join(unknown)}")
+                installed = self._rpm_query(unknown)
+                if installed is None:
+                    # rpm is not available, report everything as missing and do not cache it
+                    return {package: False for package in packages}
+                for package in unknown:
+                    self._installed[package] = package in installed
+
+            return {package: self._installed[package] for package in packages}
+
+    @TRACER.traced("dependency check", "check")
+    def missing(self, packages):
+        return [package for package, installed in self.query(packages).items() if not installed]
+
+    def invalidate(self):
+        with self._lock:
+            self._installed = {}
+            self._stamp = None
+
+    @TRACER.traced("rpm query", "subprocess")
+    def _rpm_query(self, packages):
+        root = [f"--root={self.root}"] if self.root != "/" else []
+        try:
+            result = subprocess.run(
+                ["rpm", "-q", "--queryformat", "%{NAME}\\n"] + root + list(packages),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+            )
+        except FileNotFoundError:
+            log.warning("rpm is not available.")
+            return None
+        # Missing packages are reported as "package NAME is not installed"
+        return {line.strip() for line in result.stdout.splitlines() if not line.endswith("is not installed")}
+
+
+PACKAGE_INVENTORY = PackageInventory()
+
+
+def package_inventory(root="/"):
+    return PACKAGE_INVENTORY if root == "/" else PackageInventory(root=root)
+
+
+def plan_packages(steps=STEP_PACKAGES, root="/"):
+    """Return the single package transaction that covers every step.
+
+    The result has the deduplicated ``packages`` to install, the packages
+    each step is missing, and ``legacy_invocations``, the number of dnf runs
+    the same installation used to take (one for the application's packages
+    and one per package in the configuration script). Packages of steps that
+    used to install nothing are left out of that count.
+    """
+    wanted = list(dict.fromkeys(package for packages in steps.values() for package in packages))
+    installed = package_inventory(root).query(wanted)
+    by_step = {step: [package for package in packages if not installed[package]] for step, packages in steps.items()}
+    return {
+        "packages": [package for package in wanted if not installed[package]],
+        "by_step": by_step,
+        "legacy_invocations": sum(
+            len(missing) if step == "configure" else 1
+            for step, missing in by_step.items() if missing and step in LEGACY_PACKAGE_STEPS
+        ),
+    }
+
+
+def dnf_install_command(packages, root="/", cacheonly=False, local_repo=None):
+    command = ["dnf", "install", "-y"]
+    if root != "/":
+        command.append(f"--installroot={root}")
+    if cacheonly:
+        command.append("--cacheonly")
+    if local_repo:
+        # Only the local repository, for machines without network access
+        command += ["--disablerepo=*", f"--repofrompath={LOCAL_REPO_ID},{local_repo}", f"--enablerepo={LOCAL_REPO_ID}"]
+    return command + list(packages)
+
+
+def transaction_savings(plan, result):
+    """Estimate the time one transaction saved over the separate dnf runs used before.
+
+    Every dnf run loads the repository metadata and resolves dependencies
+    before it installs anything, the single transaction pays that once.
+    """
+    if not result.get("resolve_seconds"):
+        return None
+    return max(0, plan["legacy_invocations"] - 1) * result["resolve_seconds"]
+
+
+def format_transaction(plan, result):
+    text = f"Installed {len(result['installed'])} packages in one dnf transaction in {result['seconds']:.1f}s."
+    saved = transaction_savings(plan, result)
+    if saved is not None and plan["legacy_invocations"] > 1:
+        text += f" About {saved:.1f}s saved compared with {plan['legacy_invocations']} separate dnf runs."
+    return text
+
+
+def benchmark_package_lookup(packages=REQUIRED_PACKAGES, rounds=5):
+    """Compare one rpm process per package with a single batched and a cached lookup."""
+    def measure(lookup):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            lookup()
+        return (time.perf_counter() - start) / rounds
+
+    def per_package():
+        for package in packages:
+            subprocess.run(["rpm", "-q", package], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    inventory = PackageInventory(prefetch=packages)
+
+    def batched():
+        inventory.invalidate()
+        inventory.query(packages)
+
+    inventory.query(packages)
+    results = {
+        "per_package": measure(per_package),
+        "batched": measure(batched),
+        "cached": measure(lambda: inventory.query(packages)),
+    }
+    print(f"Package lookup over {len(packages)} packages, {rounds} rounds:")
+    for name, seconds in results.items():
+        print(f"  {name:<12} {seconds * 1000:8.2f} ms")
+    return results
+
+
+# Phases of the privileged configuration script, in the order they run
+CONFIGURATION_STEPS = [
+    ("packages", "Installing required packages"),
+    ("sleep-conf", "Preparing /etc/systemd/sleep.conf"),
+    ("swap", "Creating the swap file"),
+    ("resume", "Setting the resume device"),
+]
+# Prefix of the lines the configuration script prints when a step begins or ends
+STEP_MARKER = "@@STEP"
+# Number of configuration runs kept in the step timing history
+STEP_HISTORY_LENGTH = 50
+
+
+def state_dir():
+    path = os.path.join(os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"), APP_ID)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def build_configuration_script():
+    """Return the privileged configuration script.
+
+    Every step is wrapped in step markers of the form
+    ``@@STEP <name> begin|end <epoch seconds>`` so that the caller can follow
+    the progress while the script runs. Packages are installed by the
+    install_packages operation, not by the script.
+    """
+    lines = [
+        "#!/bin/bash",
+        "set -e",
+        f"step() {{ printf '{STEP_MARKER} %s %s %s\\n' \"$1\" \"$2\" \"$(date +%s.%N)\"; }}",
+    ]
+
+    # Create /etc/systemd/sleep.conf immediately
+    lines.append("step sleep-conf begin")
+    lines.append("mkdir -p /etc/systemd/")
+    lines.append("touch /etc/systemd/sleep.conf")
+    lines.append("step sleep-conf end")
+
+    return "\n".join(lines) + "\n"
+
+
+def parse_step_marker(line):
+    """Return ``(step, phase, timestamp)`` for a step marker line, otherwise None."""
+    parts = line.split()
+    if len(parts) != 4 or parts[0] != STEP_MARKER or parts[2] not in ("begin", "end"):
+        return None
+    try:
+        return parts[1], parts[2], float(parts[3])
+    except ValueError:
+        return None
+
+
+class StepTimer:
+    """Tracks the step markers of one configuration run."""
+
+    def __init__(self, steps=CONFIGURATION_STEPS):
+        self.names = [name for name, label in steps]
+        self.labels = dict(steps)
+        self.started = {}
+        self.durations = {}
+
+    def feed(self, line):
+        """Record a marker line, returning the step it concerns or None for other output."""
+        marker = parse_step_marker(line)
+        if marker is None or marker[0] not in self.labels:
+            return None
+        name, phase, timestamp = marker
+        if phase == "begin":
+            self.started[name] = timestamp
+        elif name in self.started:
+            self.durations[name] = timestamp - self.started[name]
+        return name
+
+    def fraction(self):
+        done = sum(1 for name in self.names if name in self.durations)
+        return done / len(self.names)
+
+    def summary(self):
+        return ", ".join(f"{name} {self.durations[name]:.1f}s" for name in self.names if name in self.durations)
+
+    def save(self):
+        path = os.path.join(state_dir(), "step-timings.json")
+        try:
+            with open(path, "r") as f:
+                history = json.load(f)
+        except (OSError, ValueError):
+            history = []
+        history.append({"time": time.time(), "durations": self.durations})
+        with open(path, "w") as f:
+            json.dump(history[-STEP_HISTORY_LENGTH:], f, indent=2)
+        log.info(f"Step timings saved to {path}")
+
+
+# Number of output lines a job keeps in memory and the log view keeps on screen
+JOB_OUTPUT_MAX_LINES = 2000
+# Seconds a cancelled job gets to exit before it is killed
+JOB_CANCEL_GRACE = 5
+
+
+def _call_once(func, *args):
+    # GLib.idle_add repeats a callback for as long as it returns True
+    func(*args)
+    return False
+
+
+class Job:
+    """A command running in the background with its output streamed line by line.
+
+    Lines and completion are handed to ``dispatch`` (``GLib.idle_add`` in the
+    window) so that ``on_line`` and ``on_done`` run on the main loop. Lines are
+    batched per dispatch, and both the kept output of each stream and the lines
+    waiting for the main loop are capped at ``max_lines``.
+    """
+
+    def __init__(self, command, on_line=None, on_done=None, dispatch=None, max_lines=JOB_OUTPUT_MAX_LINES):
+        self.command = list(command)
+        self.on_line = on_line
+        self.on_done = on_done
+        self.dispatch = dispatch or _call_once
+        self.output = {
+            "stdout": collections.deque(maxlen=max_lines),
+            "stderr": collections.deque(maxlen=max_lines),
+        }
+        self.returncode = None
+        self.cancelled = False
+        self.dropped_lines = 0
+        self._process = None
+        self._lock = threading.Lock()
+        self._pending = collections.deque(maxlen=max_lines)
+        self._flush_scheduled = False
+        self._finished = threading.Event()
+        self.span = None
+
+    @property
+    def stdout(self):
+        return "\n".join(self.output["stdout"])
+
+    @property
+    def stderr(self):
+        return "\n".join(self.output["stderr"])
+
+    def start(self):
+        log.info(f"Running command: {' '.join(self.command)}")
+        self.span = TRACER.span(os.path.basename(self.command[0]), "subprocess", command=" ".join(self.command))
+        try:
+            self._process = subprocess.Popen(
+                self.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                stdin=subprocess.DEVNULL, text=True, errors="replace", start_new_session=True,
+            )
+        except OSError as e:
+            self._append("stderr", str(e))
+            self.returncode = 127
+            self._finish()
+            return self
+
+        readers = [
+            threading.Thread(target=self._read, args=(self._process.stdout, "stdout"), daemon=True),
+            threading.Thread(target=self._read, args=(self._process.stderr, "stderr"), daemon=True),
+        ]
+        for reader in readers:
+            reader.start()
+        threading.Thread(target=self._wait, args=(readers,), daemon=True).start()
+        return self
+
+    def cancel(self):
+        if self._process is None or self.returncode is not None:
+            return
+        log.info(f"Cancelling command: {' '.join(self.command)}")
+        self.cancelled = True
+        try:
+            # The command runs in its own process group so that its children are stopped too
+            os.killpg(self._process.pid, signal.SIGTERM)
+        except PermissionError:
+            # Commands started through pkexec run as root and cannot be signalled from here
+            log.warning("Not permitted to stop the command.")
+            return
+        except ProcessLookupError:
+            # Exited before its return code was collected
+            return
+        timer = threading.Timer(JOB_CANCEL_GRACE, self._kill)
+        timer.daemon = True
+        timer.start()
+
+    def wait(self, timeout=None):
+        self._finished.wait(timeout)
+        return self.returncode
+
+    @property
+    def running(self):
+        return not self._finished.is_set()
+
+    def _kill(self):
+        if self.returncode is None:
+            try:
+                os.killpg(self._process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _read(self, stream, name):
+        for line in stream:
+            self._append(name, line.rstrip("\n"))
+        stream.close()
+
+    def _append(self, name, line):
+        with self._lock:
+            self.output[name].append(line)
+            if self.on_line is None:
+                return
+            if len(self._pending) == self._pending.maxlen:
+                self.dropped_lines += 1
+            self._pending.append((name, line))
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.dispatch(_call_once, self._flush)
+
+    def _flush(self):
+        with self._lock:
+            lines = list(self._pending)
+            self._pending.clear()
+            self._flush_scheduled = False
+        for name, line in lines:
+            self.on_line(self, name, line)
+
+    def _wait(self, readers):
+        returncode = self._process.wait()
+        for reader in readers:
+            reader.join()
+        self.returncode = returncode
+        self._finish()
+
+    def _finish(self):
+        log.info(f"Command finished with exit code {self.returncode}: {' '.join(self.command)}")
+        if self.span is not None:
+            self.span.end(returncode=self.returncode, dropped_lines=self.dropped_lines)
+        self._finished.set()
+        if self.on_done:
+            self.dispatch(_call_once, self.on_done, self)
+
+    def error_message(self, tail=20):
+        return (
+            f"An error occurred while executing the command: {' '.join(self.command)}\n"
+            f"Exit Code: {self.returncode}\n"
+            f"Output: {chr(10).join(self.stdout.splitlines()[-tail:])}\n"
+            f"Error Output: {chr(10).join(self.stderr.splitlines()[-tail:])}"
+        )
+
+
+# Files the privileged helper is allowed to write
+PRIVILEGED_WRITE_PREFIXES = ["/etc/systemd/"]
+
+
+def atomic_write(path, content, mode=0o644):
+    """Replace ``path`` with ``content`` through a rename, returning False if it already matched."""
+    with TRACER.span("write", "file", path=path):
+        try:
+            with open(path, "r") as f:
+                if f.read() == content:
+                    return False
+        except OSError:
+            pass
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+                f.flush()
+                os.fchmod(f.fileno(), mode)
+                os.fsync(f.fileno())
+            os.rename(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return True
+
+
+def checked_sysroot(root):
+    """Return the real path of a sysroot the helper may write into as root.
+
+    Only root may have prepared it, otherwise a user could point its etc/systemd
+    wherever they like.
+    """
+    root = os.path.realpath(root)
+    if root != "/":
+        info = os.stat(root)
+        if info.st_uid != 0 or info.st_mode & 0o022:
+            raise PermissionError(f"{root} must be owned by root and not writable by others")
+    return root
+
+
+def privileged_write_file(args, session):
+    root = checked_sysroot(args.get("root", "/"))
+    path = os.path.realpath(args["path"])
+    # Only the sysroot itself is resolved, a symlink inside it must not lead outside the allowed prefixes
+    if not any(path.startswith(rooted(root, prefix)) for prefix in PRIVILEGED_WRITE_PREFIXES):
+        raise PermissionError(f"Writing {path} is not allowed")
+    return {"changed": atomic_write(path, args["content"], args.get("mode", 0o644))}
+
+
+def privileged_install_packages(args, session):
+    """Install packages in one dnf transaction, timing how long dnf takes to resolve them."""
+    packages = list(args["packages"])
+    root = checked_sysroot(args.get("root", "/"))
+    local_repo = args.get("local_repo")
+    if local_repo and not os.path.isdir(os.path.join(local_repo, "repodata")):
+        raise ValueError(f"{local_repo} is not a repository, create its metadata with createrepo_c")
+
+    session.step("packages", "begin")
+    start = time.perf_counter()
+    resolved = []
+
+    def on_line(stream, line):
+        # Printed once the metadata is loaded and the transaction resolved (dnf 4 and dnf 5)
+        if not resolved and line.strip().rstrip(":") in ("Dependencies resolved.", "Transaction Summary"):
+            resolved.append(time.perf_counter() - start)
+
+    if packages:
+        session.run(dnf_install_command(packages, root, args.get("cacheonly", False), local_repo), on_line=on_line)
+    session.step("packages", "end")
+    return {
+        "installed": packages,
+        "seconds": time.perf_counter() - start,
+        "resolve_seconds": resolved[0] if resolved else None,
+    }
+
+
+def privileged_run_script(args, session):
+    fd, script_path = tempfile.mkstemp(prefix=f"{APP_ID}-", suffix=".sh")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(args["script"])
+        session.run(["bash", script_path])
+    finally:
+        os.unlink(script_path)
+    return {}
+
+
+def privileged_batch(args, session):
+    # Applied in order, the first failure aborts the rest of the batch
+    results = []
+    for request in args["requests"]:
+        operation = PRIVILEGED_OPERATIONS[request["op"]]
+        results.append(operation(request.get("args") or {}, session))
+    return results
+
+
+SWAPFILE_PATH = "/var/swap/swapfile"
+# ioctl numbers and flags from linux/fs.h and linux/fiemap.h
+FS_IOC_GETFLAGS = 0x80086601
+FS_IOC_SETFLAGS = 0x40086602
+FS_IOC_FIEMAP = 0xC020660B
+FS_NOCOW_FL = 0x00800000
+FIEMAP_FLAG_SYNC = 0x1
+FIEMAP_EXTENT_UNKNOWN = 0x2
+FIEMAP_EXTENT_ENCODED = 0x8
+
+
+def meminfo_bytes(key, meminfo="/proc/meminfo"):
+    with open(meminfo, "r") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name == key:
+                return int(value.split()[0]) * 1024
+    raise KeyError(key)
+
+
+def hibernation_swap_size(meminfo="/proc/meminfo"):
+    """Swap needed to hold a hibernation image of all of RAM, rounded up to whole GiB."""
+    gib = 1024 ** 3
+    return -(-meminfo_bytes("MemTotal", meminfo) // gib) * gib
+
+
+def mount_of(path, mounts="/proc/mounts"):
+    """Return ``(device, mountpoint, fstype)`` of the mount holding ``path``."""
+    path = os.path.realpath(path)
+    # The swap directory may not exist yet, look at its closest existing parent
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    best = None
+    with open(mounts, "r") as f:
+        for line in f:
+            device, mountpoint, fstype = line.split()[:3]
+            mountpoint = mountpoint.replace("\\040", " ")
+            if path == mountpoint or path.startswith(mountpoint.rstrip("/") + "/"):
+                if best is None or len(mountpoint) > len(best[1]):
+                    best = (device, mountpoint, fstype)
+    return best
+
+
+def device_uuid(device, by_uuid="/dev/disk/by-uuid"):
+    device = os.path.realpath(device)
+    for name in os.listdir(by_uuid):
+        if os.path.realpath(os.path.join(by_uuid, name)) == device:
+            return name
+    raise RuntimeError(f"No filesystem UUID found for {device}")
+
+
+def active_swaps(swaps="/proc/swaps"):
+    with open(swaps, "r") as f:
+        return [line.split()[0] for line in f.readlines()[1:] if line.strip()]
+
+
+def create_swapfile(path, size, nocow=False):
+    """Allocate ``path`` with fallocate instead of writing zeros to it.
+
+    With ``size`` 0 the file is only created (with copy-on-write off if
+    ``nocow``), for a caller that fills it itself.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        if nocow:
+            # Copy-on-write has to be switched off while the file is still empty
+            flags = struct.unpack("i", fcntl.ioctl(fd, FS_IOC_GETFLAGS, struct.pack("i", 0)))[0]
+            fcntl.ioctl(fd, FS_IOC_SETFLAGS, struct.pack("i", flags | FS_NOCOW_FL))
+        # posix_fallocate rejects a length of 0 with EINVAL
+        if size:
+            os.posix_fallocate(fd, 0, size)
+    except BaseException:
+        os.close(fd)
+        os.unlink(path)
+        raise
+    os.close(fd)
+
+
+def fiemap_physical_offset(path):
+    """Return the physical byte offset of the first extent of ``path`` via FS_IOC_FIEMAP."""
+    # struct fiemap followed by room for a single struct fiemap_extent
+    request = bytearray(struct.pack("=QQIIII", 0, 0xFFFFFFFFFFFFFFFF, FIEMAP_FLAG_SYNC, 0, 1, 0) + bytes(56))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, request, True)
+    finally:
+        os.close(fd)
+    if struct.unpack_from("=I", request, 20)[0] == 0:
+        raise RuntimeError(f"{path} has no allocated extents")
+    logical, physical = struct.unpack_from("=QQ", request, 32)
+    flags = struct.unpack_from("=I", request, 72)[0]
+    if logical != 0 or flags & (FIEMAP_EXTENT_UNKNOWN | FIEMAP_EXTENT_ENCODED):
+        raise RuntimeError(f"The first extent of {path} has no usable physical location")
+    return physical
+
+
+def resume_offset(path, fstype, session=None):
+    """Return the resume_offset kernel argument, in pages, for a swap file."""
+    if fstype == "btrfs":
+        # FIEMAP reports btrfs logical addresses, only btrfs itself can map them to the device
+        command = ["btrfs", "inspect-internal", "map-swapfile", "-r", path]
+        output = session.run(command) if session else subprocess.run(
+            command, capture_output=True, text=True, check=True).stdout
+        return int(output.strip().split()[-1])
+    return fiemap_physical_offset(path) // os.sysconf("SC_PAGE_SIZE")
+
+
+def kernel_args(session):
+    # grubby prints the default entry with a line like: args="ro rhgb quiet"
+    for line in session.run(["grubby", "--info=DEFAULT"]).splitlines():
+        if line.startswith("args="):
+            return line[len("args="):].strip('"').split()
+    return []
+
+
+def privileged_provision_swap(args, session):
+    """Create a swap file large enough for hibernation and point the kernel's resume at it."""
+    path = args.get("path", SWAPFILE_PATH)
+    directory = os.path.dirname(path)
+
+    session.step("swap", "begin")
+    size = int(args.get("size") or hibernation_swap_size())
+    device, mountpoint, fstype = mount_of(directory)
+    session.log(f"Swap file {path}: {size // 1024 ** 2} MiB on {fstype} ({device})")
+
+    created = False
+    if os.path.exists(path) and os.path.getsize(path) >= size:
+        session.log(f"Reusing the existing {path}")
+    else:
+        if os.path.exists(path):
+            if path in active_swaps():
+                session.run(["swapoff", path])
+            os.unlink(path)
+        if fstype == "btrfs" and not os.path.exists(directory):
+            # A separate subvolume keeps the swap file out of snapshots
+            session.run(["btrfs", "subvolume", "create", directory])
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        create_swapfile(path, size, nocow=fstype == "btrfs")
+        session.run(["mkswap", path])
+        created = True
+    if path not in active_swaps():
+        session.run(["swapon", path])
+
+    with open("/etc/fstab", "r") as f:
+        fstab = f.read()
+    if not any(line.split()[:1] == [path] for line in fstab.splitlines()):
+        atomic_write("/etc/fstab", fstab.rstrip("\n") + f"\n{path} none swap defaults 0 0\n")
+    session.step("swap", "end")
+
+    session.step("resume", "begin")
+    offset = resume_offset(path, fstype, session)
+    wanted = [f"resume=UUID={device_uuid(device)}", f"resume_offset={offset}"]
+    session.log(f"Resume from {' '.join(wanted)}")
+    kernel_args_changed = not set(wanted) <= set(kernel_args(session))
+    if kernel_args_changed:
+        session.run(["grubby", "--update-kernel=ALL", f"--args={' '.join(wanted)}"])
+    if atomic_write("/etc/dracut.conf.d/resume.conf", 'add_dracutmodules+=" resume "\n'):
+        session.run(["dracut", "-f"])
+    session.step("resume", "end")
+    return {
+        "path": path,
+        "size": size,
+        "created": created,
+        "resume_offset": offset,
+        "kernel_args_changed": kernel_args_changed,
+    }
+
+
+def filefrag_physical_offset(path):
+    # The first extent row of filefrag -v reads: "   0:        0..   1023:      34816..     35839:   1024:"
+    output = subprocess.run(["filefrag", "-v", path], capture_output=True, text=True, check=True).stdout
+    for line in output.splitlines():
+        fields = line.split(":")
+        if len(fields) > 3 and fields[0].strip() == "0":
+            return int(fields[2].split("..")[0]) * os.statvfs(path).f_bsize
+    raise RuntimeError(f"filefrag reported no extents for {path}")
+
+
+def benchmark_swapfile(size_mib=1024, filesystems=("ext4", "btrfs")):
+    """Compare fallocate with zero-filling, and FIEMAP with filefrag, on loopback images.
+
+    Needs root, mkfs for each filesystem and loop device support.
+    """
+    size = size_mib * 1024 ** 2
+    results = {}
+    for fstype in filesystems:
+        if shutil.which(f"mkfs.{fstype}") is None:
+            log.warning(f"mkfs.{fstype} is not installed, skipping {fstype}.")
+            continue
+        workdir = tempfile.mkdtemp(prefix=f"{APP_ID}-bench-", dir="/var/tmp")
+        image, mountpoint = os.path.join(workdir, "image"), os.path.join(workdir, "mnt")
+        os.mkdir(mountpoint)
+        try:
+            with open(image, "wb") as f:
+                f.truncate(size * 3)
+            subprocess.run([f"mkfs.{fstype}", "-q", image], check=True, stdout=subprocess.DEVNULL)
+            subprocess.run(["mount", "-o", "loop", image, mountpoint], check=True)
+            try:
+                nocow = fstype == "btrfs"
+                timings = {}
+
+                start = time.perf_counter()
+                create_swapfile(os.path.join(mountpoint, "fallocated"), size, nocow=nocow)
+                timings["fallocate"] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                create_swapfile(os.path.join(mountpoint, "zeroed"), 0, nocow=nocow)
+                with open(os.path.join(mountpoint, "zeroed"), "r+b") as f:
+                    zeros = bytes(1024 ** 2)
+                    for _ in range(size_mib):
+                        f.write(zeros)
+                    os.fsync(f.fileno())
+                timings["zero_fill"] = time.perf_counter() - start
+
+                start = time.perf_counter()
+                resume_offset(os.path.join(mountpoint, "fallocated"), fstype)
+                timings["resume_offset"] = time.perf_counter() - start
+
+                if fstype != "btrfs":
+                    start = time.perf_counter()
+                    filefrag_physical_offset(os.path.join(mountpoint, "fallocated"))
+                    timings["filefrag"] = time.perf_counter() - start
+                results[fstype] = timings
+            finally:
+                subprocess.run(["umount", mountpoint], check=True)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for fstype, timings in results.items():
+        print(f"{fstype}, {size_mib} MiB swap file:")
+        for name, seconds in timings.items():
+            print(f"  {name:<14} {seconds * 1000:10.2f} ms")
+    return results
+
+
+IMAGE_SIZE_PATH = "/sys/power/image_size"
+HIBERNATE_COMPRESSOR_PATH = "/sys/module/hibernate/parameters/compressor"
+IMAGE_SIZE_TMPFILES = f"/etc/tmpfiles.d/{APP_ID}-image-size.conf"
+# The kernel compresses the image in chunks of 32 pages, with at most 3 threads
+HIBERNATE_CHUNK_SIZE = 32 * 4096
+HIBERNATE_COMPRESS_THREADS = 3
+HIBERNATE_COMPRESSORS = ["lzo", "lz4"]
+TUNING_HISTORY_LENGTH = 50
+
+
+def hibernate_compressors():
+    """Return ``{name: (compress, decompress)}`` for the kernel's compressors that have Python bindings here."""
+    codecs = {}
+    try:
+        import lzo
+
+        codecs["lzo"] = (lzo.compress, lzo.decompress)
+    except ImportError:
+        pass
+    try:
+        import lz4.block
+
+        codecs["lz4"] = (lz4.block.compress, lz4.block.decompress)
+    except ImportError:
+        pass
+    return codecs
+
+
+def memory_like_pages(size, seed=0):
+    """Return ``size`` bytes of pages resembling a desktop's memory.
+
+    The mix is roughly what hibernation images hold: zero pages, pointer heavy
+    heap pages, text, and pages that do not compress at all (media, crypto).
+    """
+    rng = random.Random(seed)
+    words = b"the of and to in is for on that with file value true false none error user path data".split()
+    base = 0x7F0000000000 | rng.getrandbits(28) << 12
+    pages = []
+    for _ in range(size // 4096):
+        kind = rng.random()
+        if kind < 0.30:
+            page = bytes(4096)
+        elif kind < 0.60:
+            page = struct.pack("<512Q", *(
+                base + rng.randrange(1 << 16) * 8 if rng.random() < 0.6 else rng.randrange(256) for _ in range(512)
+            ))
+        elif kind < 0.85:
+            page = b" ".join(rng.choice(words) for _ in range(1024))[:4096].ljust(4096, b"\n")
+        else:
+            page = rng.randbytes(4096)
+        pages.append(page)
+    return b"".join(pages)
+
+
+def benchmark_compressors(data, chunk_size=HIBERNATE_CHUNK_SIZE):
+    """Return the ratio and compress/decompress speeds in bytes/s of each compressor on ``data``."""
+    threads = max(1, min((os.cpu_count() or 1) - 1, HIBERNATE_COMPRESS_THREADS))
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+    results = {}
+    for name, (compress, decompress) in hibernate_compressors().items():
+        start = time.perf_counter()
+        packed = [compress(chunk) for chunk in chunks]
+        compress_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for chunk in packed:
+            decompress(chunk)
+        decompress_seconds = time.perf_counter() - start
+        results[name] = {
+            "ratio": len(data) / sum(len(chunk) for chunk in packed),
+            # The kernel spreads chunks over its compression threads
+            "compress": len(data) / compress_seconds * threads,
+            "decompress": len(data) / decompress_seconds * threads,
+        }
+    return results
+
+
+def measure_disk_throughput(directory, size=256 * 1024 ** 2, block_size=1024 ** 2):
+    """Return the sequential write and read speed in bytes/s of the filesystem holding ``directory``."""
+    block = os.urandom(block_size)
+    fd, path = tempfile.mkstemp(prefix=f".{APP_ID}-", dir=directory)
+    try:
+        start = time.perf_counter()
+        for _ in range(size // block_size):
+            os.write(fd, block)
+        os.fsync(fd)
+        write = size / (time.perf_counter() - start)
+        # Drop the file from the page cache so that it is read back from the disk
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.lseek(fd, 0, os.SEEK_SET)
+        start = time.perf_counter()
+        while os.read(fd, block_size):
+            pass
+        read = size / (time.perf_counter() - start)
+    finally:
+        os.close(fd)
+        os.unlink(path)
+    return {"directory": directory, "write": write, "read": read}
+
+
+def hibernation_settings():
+    def read(path):
+        try:
+            with open(path, "r") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    image_size = read(IMAGE_SIZE_PATH)
+    # Kernels before 6.9 have no compressor parameter and always use lzo
+    return {"image_size": int(image_size) if image_size else None, "compressor": read(HIBERNATE_COMPRESSOR_PATH)}
+
+
+def estimate_hibernation(compressors, disk, meminfo="/proc/meminfo"):
+    """Estimate hibernate and resume time for each compressor and image size.
+
+    Memory that cannot be reclaimed always goes into the image. Page cache
+    beyond ``image_size`` is dropped instead, and read back from the disk
+    after resume, which counts as ``refill``.
+    """
+    total = meminfo_bytes("MemTotal", meminfo)
+    available = meminfo_bytes("MemAvailable", meminfo)
+    resident = total - available
+    reclaimable = available - meminfo_bytes("MemFree", meminfo)
+    image_sizes = {"smallest": 0, "default": total * 2 // 5, "everything": resident + reclaimable}
+
+    candidates = []
+    for compressor, speed in compressors.items():
+        images = set()
+        for label, image_size in image_sizes.items():
+            image = max(resident, min(image_size, resident + reclaimable))
+            if image in images:
+                continue
+            images.add(image)
+            stored = image / speed["ratio"]
+            # Compression and I/O overlap, the slower of the two sets the pace
+            write = max(image / speed["compress"], stored / disk["write"])
+            read = max(image / speed["decompress"], stored / disk["read"])
+            refill = (resident + reclaimable - image) / disk["read"]
+            candidates.append({
+                "compressor": compressor, "label": label, "image_size": image_size, "image": image,
+                "write": write, "read": read, "refill": refill, "total": write + read + refill,
+            })
+    candidates.sort(key=lambda candidate: candidate["total"])
+    return candidates
+
+
+def machine_description():
+    def dmi(name):
+        try:
+            with open(f"/sys/class/dmi/id/{name}", "r") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    return {
+        "hostname": os.uname().nodename,
+        "product": " ".join(filter(None, [dmi("sys_vendor"), dmi("product_name")])) or None,
+        "kernel": os.uname().release,
+        "cpus": os.cpu_count(),
+        "memory": meminfo_bytes("MemTotal"),
+    }
+
+
+def tune_hibernation_image(sample_size=32 * 1024 ** 2):
+    """Benchmark compressors and the swap disk, and recommend an image size and compressor.
+
+    The result is appended to hibernate-tuning.json in the state directory,
+    together with a description of the machine so that runs on different
+    machines can be compared.
+    """
+    settings = hibernation_settings()
+    compressors = benchmark_compressors(memory_like_pages(sample_size))
+    if settings["compressor"] is None:
+        compressors = {name: speed for name, speed in compressors.items() if name == "lzo"}
+    swap_dir = os.path.dirname(SWAPFILE_PATH)
+    disk = measure_disk_throughput(swap_dir if os.access(swap_dir, os.W_OK) else "/var/tmp")
+    candidates = estimate_hibernation(compressors, disk)
+    result = {
+        "time": time.time(),
+        "machine": machine_description(),
+        "current": settings,
+        "compressors": compressors,
+        "disk": disk,
+        "candidates": candidates,
+        "recommended": candidates[0] if candidates else None,
+    }
+
+    path = os.path.join(state_dir(), "hibernate-tuning.json")
+    try:
+        with open(path, "r") as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        history = []
+    history.append(result)
+    with open(path, "w") as f:
+        json.dump(history[-TUNING_HISTORY_LENGTH:], f, indent=2)
+    log.info(f"Hibernation tuning results saved to {path}")
+    return result
+
+
+def format_tuning(result):
+    mib = 1024 ** 2
+    lines = [
+        f"Swap disk: write {result['disk']['write'] / mib:.0f} MiB/s, read {result['disk']['read'] / mib:.0f} MiB/s",
+    ]
+    for name, speed in result["compressors"].items():
+        lines.append(
+            f"{name}: ratio {speed['ratio']:.2f}, compress {speed['compress'] / mib:.0f} MiB/s, "
+            f"decompress {speed['decompress'] / mib:.0f} MiB/s"
+        )
+    if not result["compressors"]:
+        lines.append("No compressor could be benchmarked, install python3-lz4 or python3-lzo.")
+    for candidate in result["candidates"]:
+        lines.append(
+            f"{candidate['compressor']} with the {candidate['label']} image ({candidate['image'] / mib:.0f} MiB): "
+            f"hibernate {candidate['write']:.1f}s, resume {candidate['read']:.1f}s, "
+            f"reload cache {candidate['refill']:.1f}s"
+        )
+    current = result["current"]
+    lines.append(f"Current: image_size {current['image_size']}, compressor {current['compressor'] or 'lzo'}")
+    return "\n".join(lines)
+
+
+def benchmark_hibernation():
+    result = tune_hibernation_image()
+    print(format_tuning(result))
+    with open(os.path.join(state_dir(), "hibernate-tuning.json"), "r") as f:
+        history = json.load(f)
+    print("\nSaved runs:")
+    for run in history:
+        machine, best = run["machine"], run["recommended"]
+        choice = f"{best['compressor']}, {best['label']} image, {best['total']:.1f}s" if best else "no recommendation"
+        print(f"  {time.strftime('%Y-%m-%d', time.localtime(run['time']))} "
+              f"{machine['product'] or machine['hostname']} ({machine['kernel']}): {choice}")
+    return result
+
+
+def privileged_tune_hibernation(args, session):
+    """Set the hibernation image size and compressor now and for later boots."""
+    image_size = int(args["image_size"])
+    compressor = args.get("compressor")
+    if compressor is not None and compressor not in HIBERNATE_COMPRESSORS:
+        raise ValueError(f"Unknown hibernation compressor {compressor}")
+
+    session.log(f"Setting the hibernation image size to {image_size} bytes")
+    with open(IMAGE_SIZE_PATH, "w") as f:
+        f.write(str(image_size))
+    # sysfs is reset on boot, tmpfiles.d writes the value again
+    atomic_write(IMAGE_SIZE_TMPFILES, f"w {IMAGE_SIZE_PATH} - - - - {image_size}\n")
+
+    kernel_args_changed = False
+    if compressor is not None:
+        session.log(f"Setting the hibernation compressor to {compressor}")
+        if os.path.exists(HIBERNATE_COMPRESSOR_PATH):
+            with open(HIBERNATE_COMPRESSOR_PATH, "w") as f:
+                f.write(compressor)
+        argument = f"hibernate.compressor={compressor}"
+        if argument not in kernel_args(session):
+            session.run(["grubby", "--update-kernel=ALL", f"--args={argument}"])
+            kernel_args_changed = True
+    return {"image_size": image_size, "compressor": compressor, "kernel_args_changed": kernel_args_changed}
+
+
+SLEEP_HOOK_PATH = f"/usr/lib/systemd/system-sleep/{APP_ID}"
+# Root-owned copy of this script the hook runs, and the interpreter it runs it with
+SLEEP_HOOK_SCRIPT = f"/usr/libexec/{APP_ID}/{APP_ID}.py"
+SLEEP_HOOK_PYTHON = "/usr/bin/python3"
+BATTERY_LOG_PATH = f"/var/lib/{APP_ID}/battery-samples.bin"
+# Header: magic, version, record size, capacity, number of records ever written
+BATTERY_LOG_HEADER = "<4sHHIQ"
+BATTERY_LOG_MAGIC = b"STHB"
+# Record: time, phase, mem_sleep state, sleep action, unit, level and full level (uWh or uAh)
+BATTERY_RECORD = "<dBBBBII"
+BATTERY_LOG_CAPACITY = 4096
+BATTERY_PHASES = ["pre", "post"]
+MEM_SLEEP_STATES = ["s2idle", "shallow", "deep"]
+SLEEP_ACTIONS = ["suspend", "hibernate", "hybrid-sleep", "suspend-then-hibernate", "suspend-after-failed-hibernate"]
+BATTERY_UNITS = ["energy", "charge"]
+UNKNOWN_CODE = 255
+# Suspends shorter than this are mostly entry and resume, not sleep
+MIN_DRAIN_SAMPLE_SECONDS = 600
+MIN_DRAIN_SAMPLES = 3
+# Bounds of the adaptive HibernateDelaySec, in seconds
+ADAPTIVE_DELAY_RANGE = (15 * 60, 24 * 3600)
+
+
+class BatteryLog:
+    """Fixed size ring buffer of battery samples in a binary file.
+
+    Records are only ever appended, the oldest being overwritten once
+    ``capacity`` is reached, so the file stays the same size however many
+    suspend cycles it has seen.
+    """
+
+    def __init__(self, path=BATTERY_LOG_PATH, capacity=BATTERY_LOG_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.header_size = struct.calcsize(BATTERY_LOG_HEADER)
+        self.record_size = struct.calcsize(BATTERY_RECORD)
+
+    def _header(self, f):
+        data = f.read(self.header_size)
+        if len(data) < self.header_size:
+            return self.capacity, 0
+        magic, version, record_size, capacity, written = struct.unpack(BATTERY_LOG_HEADER, data)
+        if magic != BATTERY_LOG_MAGIC or version != 1 or record_size != self.record_size:
+            raise ValueError(f"{self.path} is not a battery log")
+        return capacity, written
+
+    def append(self, *record):
+        os.makedirs(os.path.dirname(self.path), mode=0o755, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            capacity, written = self._header(f)
+            f.seek(self.header_size + (written % capacity) * self.record_size)
+            f.write(struct.pack(BATTERY_RECORD, *record))
+            f.seek(0)
+            f.write(struct.pack(BATTERY_LOG_HEADER, BATTERY_LOG_MAGIC, 1, self.record_size, capacity, written + 1))
+
+    def records(self):
+        """Return all kept records, oldest first."""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            capacity, written = self._header(f)
+            data = f.read(min(written, capacity) * self.record_size)
+        records = list(struct.iter_unpack(BATTERY_RECORD, data))
+        if written > capacity:
+            oldest = written % capacity
+            records = records[oldest:] + records[:oldest]
+        return [
+            {
+                "time": timestamp,
+                "phase": BATTERY_PHASES[phase],
+                "mem_sleep": MEM_SLEEP_STATES[mem_sleep] if mem_sleep < len(MEM_SLEEP_STATES) else None,
+                "action": SLEEP_ACTIONS[action] if action < len(SLEEP_ACTIONS) else None,
+                "unit": BATTERY_UNITS[unit],
+                "level": level,
+                "full": full,
+            }
+            for timestamp, phase, mem_sleep, action, unit, level, full in records
+        ]
+
+
+def read_battery(sysfs_root="/sys"):
+    """Return ``(unit, level, full)`` summed over the system's batteries, or None without a battery."""
+    supplies = os.path.join(sysfs_root, "class", "power_supply")
+
+    def read(*parts):
+        try:
+            with open(os.path.join(supplies, *parts), "r") as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    totals = {}
+    for name in sorted(os.listdir(supplies)) if os.path.isdir(supplies) else []:
+        # Peripherals such as mice report scope Device
+        if read(name, "type") != "Battery" or read(name, "scope") == "Device":
+            continue
+        for unit in BATTERY_UNITS:
+            level, full = read(name, f"{unit}_now"), read(name, f"{unit}_full")
+            if level is not None and full is not None:
+                level_sum, full_sum = totals.get(unit, (0, 0))
+                totals[unit] = (level_sum + int(level), full_sum + int(full))
+                break
+    for unit in BATTERY_UNITS:
+        if unit in totals:
+            return (unit,) + totals[unit]
+    return None
+
+
+def mem_sleep_states(sysfs_root="/sys"):
+    """Return the suspend modes the kernel offers and the selected one, or ([], None)."""
+    # The selected state is in brackets: "s2idle [deep]"
+    try:
+        with open(os.path.join(sysfs_root, "power", "mem_sleep"), "r") as f:
+            states = f.read().split()
+    except OSError:
+        return [], None
+    current = next((state.strip("[]") for state in states if state.startswith("[")), None)
+    return [state.strip("[]") for state in states], current
+
+
+def current_mem_sleep(sysfs_root="/sys"):
+    return mem_sleep_states(sysfs_root)[1]
+
+
+def record_battery(phase, action, sysfs_root="/sys", battery_log=None):
+    """Append the battery level to the battery log, called by the system-sleep hook."""
+    battery = read_battery(sysfs_root)
+    if battery is None:
+        return None
+    unit, level, full = battery
+    mem_sleep = current_mem_sleep(sysfs_root)
+    (battery_log or BatteryLog()).append(
+        time.time(),
+        BATTERY_PHASES.index(phase),
+        MEM_SLEEP_STATES.index(mem_sleep) if mem_sleep in MEM_SLEEP_STATES else UNKNOWN_CODE,
+        SLEEP_ACTIONS.index(action) if action in SLEEP_ACTIONS else UNKNOWN_CODE,
+        BATTERY_UNITS.index(unit),
+        level,
+        full,
+    )
+    return {"phase": phase, "action": action, "mem_sleep": mem_sleep, "unit": unit, "level": level, "full": full}
+
+
+def suspend_drain(records):
+    """Return ``{mem_sleep: [drain per hour as a fraction of a full battery, ...]}``.
+
+    Only a pre sample directly followed by its post sample counts, and only when
+    the machine stayed suspended: a cycle that ended in hibernation drained
+    nothing for part of the time.
+    """
+    drains = {}
+    for pre, post in zip(records, records[1:]):
+        if pre["phase"] != "pre" or post["phase"] != "post" or pre["unit"] != post["unit"]:
+            continue
+        if "hibernate" in (pre["action"], post["action"]) or pre["mem_sleep"] is None:
+            continue
+        hours = (post["time"] - pre["time"]) / 3600
+        if hours * 3600 < MIN_DRAIN_SAMPLE_SECONDS or not pre["full"]:
+            continue
+        drains.setdefault(pre["mem_sleep"], []).append(max(0, pre["level"] - post["level"]) / pre["full"] / hours)
+    return drains
+
+
+def adaptive_hibernate_delay(records, reserve=0.2, mem_sleep=None):
+    """Return the longest HibernateDelaySec that keeps ``reserve`` of the battery, from measured drain.
+
+    The suspend is assumed to start at the level the battery is at or above
+    for 90% of recorded suspends, and to drain at the median measured rate.
+    Returns None until enough suspends were recorded in the current mode.
+    """
+    import statistics
+
+    drains = suspend_drain(records)
+    mem_sleep = mem_sleep or (records[-1]["mem_sleep"] if records else None)
+    samples = drains.get(mem_sleep, [])
+    if len(samples) < MIN_DRAIN_SAMPLES:
+        return None
+    drain = statistics.median(samples)
+    start_level = percentile([r["level"] / r["full"] for r in records if r["phase"] == "pre" and r["full"]], 0.1)
+    if drain <= 0:
+        delay = ADAPTIVE_DELAY_RANGE[1]
+    else:
+        delay = (start_level - reserve) / drain * 3600
+    delay = int(min(max(delay, ADAPTIVE_DELAY_RANGE[0]), ADAPTIVE_DELAY_RANGE[1]))
+    return {
+        "mem_sleep": mem_sleep,
+        "cycles": len(samples),
+        "drain_per_hour": drain,
+        "drain_by_mode": {mode: statistics.median(values) for mode, values in drains.items()},
+        "start_level": start_level,
+        "reserve": reserve,
+        "delay": delay,
+    }
+
+
+def format_adaptive_delay(recommendation):
+    if recommendation is None:
+        return (
+            f"Not enough measured suspends yet, at least {MIN_DRAIN_SAMPLES} of "
+            f"{MIN_DRAIN_SAMPLE_SECONDS // 60} minutes or more are needed."
+        )
+    return (
+        f"Measured drain in {recommendation['mem_sleep']}: {recommendation['drain_per_hour'] * 100:.1f}% per hour "
+        f"over {recommendation['cycles']} suspends. Starting from {recommendation['start_level'] * 100:.0f}%, "
+        f"hibernating after {recommendation['delay']} seconds keeps {recommendation['reserve'] * 100:.0f}% in reserve."
+    )
+
+
+def privileged_install_sleep_hook(args, session):
+    """Install the system-sleep hook that records the battery level and wakeup counts around suspend.
+
+    The hook runs as root on every suspend and resume, so it runs a root-owned
+    copy of this script rather than the file the window was started from,
+    which its user may be able to change. The copy is compiled here, sparing
+    the hook from parsing the whole script on every sleep.
+    """
+    with open(os.path.abspath(__file__), "r") as f:
+        script_changed = atomic_write(SLEEP_HOOK_SCRIPT, f.read())
+    compiled = SLEEP_HOOK_SCRIPT + "c"
+    if script_changed or not os.path.exists(compiled):
+        # Compiled by the interpreter the hook uses, .pyc files are specific to the Python version
+        session.run([
+            SLEEP_HOOK_PYTHON, "-c", "import py_compile, sys; py_compile.compile(sys.argv[1], sys.argv[2], doraise=True)",
+            SLEEP_HOOK_SCRIPT, compiled,
+        ])
+    python = shlex.quote(SLEEP_HOOK_PYTHON)
+    arguments = '--record-battery "$1" "${SYSTEMD_SLEEP_ACTION:-$2}"'
+    hook = (
+        "#!/bin/sh\n"
+        f"# Installed by {APP_ID} to measure battery drain and wakeups while suspended\n"
+        "# The source is only run if the compiled copy cannot be, after a Python update\n"
+        f"{python} {shlex.quote(compiled)} {arguments} ||\n"
+        f"    exec {python} {shlex.quote(SLEEP_HOOK_SCRIPT)} {arguments}\n"
+    )
+    return {"changed": atomic_write(SLEEP_HOOK_PATH, hook, 0o755) or script_changed}
+
+
+WAKEUP_SNAPSHOT_PATH = f"/var/lib/{APP_ID}/wakeup-snapshot.json"
+WAKEUP_LAST_PATH = f"/var/lib/{APP_ID}/wakeup-last.json"
+WAKEUP_TMPFILES = f"/etc/tmpfiles.d/{APP_ID}-wakeup.conf"
+
+
+def read_acpi_wakeup(procfs_root="/proc"):
+    """Parse /proc/acpi/wakeup into a list of ACPI wakeup devices.
+
+    Lines look like "XHC0	  S3	*enabled   pci:0000:03:00.3", the sysfs node
+    being missing for devices like the lid or the power button.
+    """
+    devices = []
+    try:
+        with open(os.path.join(procfs_root, "acpi", "wakeup"), "r") as f:
+            lines = f.read().splitlines()[1:]
+    except OSError:
+        return devices
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        devices.append({
+            "device": fields[0],
+            "sleep_state": fields[1],
+            "enabled": fields[2].lstrip("*") == "enabled",
+            "node": fields[3] if len(fields) > 3 else None,
+        })
+    return devices
+
+
+def wakeup_counts(sysfs_root="/sys"):
+    """Return ``{device path: wakeup count}`` of the registered wakeup sources.
+
+    The kernel only registers a source, listed in /sys/class/wakeup, while
+    the device's wakeup is enabled.
+    """
+    counts = {}
+    for source in glob.glob(os.path.join(sysfs_root, "class", "wakeup", "*")):
+        device = os.path.join(source, "device")
+        if not os.path.islink(device):
+            # Wakeup sources of the kernel itself, like alarmtimer
+            continue
+        try:
+            with open(os.path.join(source, "wakeup_count"), "r") as f:
+                count = f.read().strip()
+        except OSError:
+            continue
+        path = os.path.relpath(os.path.realpath(device), os.path.realpath(sysfs_root))
+        if count.isdigit():
+            counts[path] = int(count)
+    return counts
+
+
+def wakeup_devices(sysfs_root="/sys", pinned=(), scan=True):
+    """Return ``{device path: {"enabled", "wakeup_count", "driver"}}`` for every device that can wake the system.
+
+    Device paths are relative to /sys, like "devices/pci0000:00/0000:00:14.0".
+    Devices are found by their power/wakeup attribute, disabled ones too.
+    Without ``scan`` only the enabled ones and the ``pinned`` paths are read,
+    which is enough to count what woke the system.
+    """
+    counts = wakeup_counts(sysfs_root)
+    paths = set(counts) | set(pinned)
+    if scan:
+        for directory, subdirectories, files in os.walk(os.path.join(sysfs_root, "devices")):
+            if os.path.basename(directory) != "power":
+                continue
+            # Power directories hold no devices
+            subdirectories[:] = []
+            if "wakeup" in files:
+                paths.add(os.path.relpath(os.path.dirname(directory), sysfs_root))
+
+    devices = {}
+    for path in sorted(paths):
+        device = os.path.join(sysfs_root, path)
+        try:
+            with open(os.path.join(device, "power", "wakeup"), "r") as f:
+                enabled = f.read().strip()
+        except OSError:
+            # Unplugged since it was pinned
+            continue
+        if enabled not in ("enabled", "disabled"):
+            continue
+        driver = os.path.join(device, "driver")
+        devices[path] = {
+            "enabled": enabled == "enabled",
+            "wakeup_count": counts.get(path),
+            "driver": os.path.basename(os.readlink(driver)) if os.path.islink(driver) else None,
+        }
+    return devices
+
+
+@TRACER.traced(category="probe")
+def wakeup_snapshot(sysfs_root="/sys", procfs_root="/proc", pinned=(), scan=True):
+    available, current = mem_sleep_states(sysfs_root)
+    return {
+        "time": time.time(),
+        "mem_sleep": {"available": available, "current": current},
+        "acpi": read_acpi_wakeup(procfs_root),
+        "devices": wakeup_devices(sysfs_root, pinned, scan),
+    }
+
+
+def fired_wakeup_sources(before, after):
+    """Return the devices whose wakeup count went up between two snapshots, most wakeups first."""
+    fired = []
+    for device, state in after["devices"].items():
+        previous = before["devices"].get(device, {}).get("wakeup_count")
+        if state["wakeup_count"] is not None and previous is not None and state["wakeup_count"] > previous:
+            fired.append({"device": device, "driver": state["driver"], "wakeups": state["wakeup_count"] - previous})
+    return sorted(fired, key=lambda source: -source["wakeups"])
+
+
+def record_wakeups(phase, action, sysfs_root="/sys", procfs_root="/proc"):
+    """Snapshot the wakeup counts before suspend and store what fired after resume, called by the system-sleep hook."""
+    # Called on every suspend and resume, only enabled devices can have woken the system
+    snapshot = wakeup_snapshot(sysfs_root, procfs_root, scan=False)
+    if phase == "pre":
+        atomic_write(WAKEUP_SNAPSHOT_PATH, json.dumps(snapshot))
+        return None
+    try:
+        with open(WAKEUP_SNAPSHOT_PATH, "r") as f:
+            before = json.load(f)
+    except (OSError, ValueError):
+        return None
+    last = {
+        "time": snapshot["time"],
+        "action": action,
+        "mem_sleep": before["mem_sleep"]["current"],
+        "seconds": snapshot["time"] - before["time"],
+        "fired": fired_wakeup_sources(before, snapshot),
+    }
+    atomic_write(WAKEUP_LAST_PATH, json.dumps(last))
+    return last
+
+
+def last_wakeup(root="/"):
+    try:
+        with open(rooted(root, WAKEUP_LAST_PATH), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def format_wakeup_audit(snapshot, last=None):
+    available = snapshot["mem_sleep"]["available"]
+    lines = [
+        f"Suspend mode: {snapshot['mem_sleep']['current'] or 'unknown'}"
+        + (f" (available: {', '.join(available)})" if available else "")
+    ]
+    enabled = sorted(device for device, state in snapshot["devices"].items() if state["enabled"])
+    lines.append(f"Devices allowed to wake the system: {len(enabled)} of {len(snapshot['devices'])}")
+    for device in enabled:
+        state = snapshot["devices"][device]
+        lines.append(f"  {device} ({state['driver'] or 'no driver'}), {state['wakeup_count'] or 0} wakeups")
+    acpi = [entry["device"] for entry in snapshot["acpi"] if entry["enabled"]]
+    if acpi:
+        lines.append(f"ACPI wakeup devices enabled: {', '.join(acpi)}")
+    if last is None:
+        lines.append("No suspend measured yet.")
+    elif last["fired"]:
+        mode = f" ({last['mem_sleep']})" if last["mem_sleep"] else ""
+        lines.append(
+            f"Woken from {last['action'] or 'suspend'}{mode} after {last['seconds'] / 60:.0f} minutes by: "
+            + ", ".join(f"{source['device']} ({source['wakeups']}x)" for source in last["fired"])
+        )
+    else:
+        lines.append(f"No device wakeup counted during the last {last['action'] or 'suspend'}.")
+    return "\n".join(lines)
+
+
+def wakeup_tmpfiles(pins):
+    """Return the tmpfiles.d lines that set the wakeup of ``{device path: {"enabled", "default"}}`` on every boot.
+
+    The kernel's default of each device goes in a comment before its line.
+    """
+    state = {True: "enabled", False: "disabled"}
+    return "".join(
+        f"# {device} defaults to {state[pin['default']]}\n"
+        f"w /sys/{device}/power/wakeup - - - - {state[pin['enabled']]}\n"
+        for device, pin in sorted(pins.items())
+    )
+
+
+def persisted_wakeups(path=WAKEUP_TMPFILES):
+    """Return the ``{device path: {"enabled", "default"}}`` pinned by :func:`wakeup_tmpfiles`."""
+    pins = {}
+    defaults = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                match = re.match(r"# (\S+) defaults to (enabled|disabled)$", line.strip())
+                if match:
+                    defaults[match.group(1)] = match.group(2) == "enabled"
+                    continue
+                match = re.match(r"w /sys/(\S+)/power/wakeup - - - - (enabled|disabled)$", line.strip())
+                if match:
+                    enabled = match.group(2) == "enabled"
+                    # A pin always differs from the default
+                    pins[match.group(1)] = {"enabled": enabled, "default": defaults.get(match.group(1), not enabled)}
+    except FileNotFoundError:
+        pass
+    return pins
+
+
+def apply_sleep_state(args, session, sysfs_root="/sys", tmpfiles=WAKEUP_TMPFILES):
+    """Select the suspend mode and which devices may wake the system, now and on later boots."""
+    result = {"mem_sleep": None, "kernel_args_changed": False, "wakeup": {}}
+    mem_sleep = args.get("mem_sleep")
+    if mem_sleep is not None:
+        available, current = mem_sleep_states(sysfs_root)
+        if mem_sleep not in available:
+            raise ValueError(f"Unsupported suspend mode {mem_sleep}, the kernel offers {', '.join(available)}")
+        if mem_sleep != current:
+            session.log(f"Setting the suspend mode to {mem_sleep}")
+            with open(os.path.join(sysfs_root, "power", "mem_sleep"), "w") as f:
+                f.write(mem_sleep)
+        argument = f"mem_sleep_default={mem_sleep}"
+        if argument not in kernel_args(session):
+            # grubby replaces an existing mem_sleep_default
+            session.run(["grubby", "--update-kernel=ALL", f"--args={argument}"])
+            result["kernel_args_changed"] = True
+        result["mem_sleep"] = mem_sleep
+
+    wakeup = args.get("wakeup")
+    if wakeup:
+        pins = persisted_wakeups(tmpfiles)
+        devices = wakeup_devices(sysfs_root, pins)
+        for device, enabled in wakeup.items():
+            if device not in devices:
+                raise ValueError(f"{device} cannot wake the system")
+        for device, enabled in wakeup.items():
+            if devices[device]["enabled"] != enabled:
+                session.log(f"{'Enabling' if enabled else 'Disabling'} wakeup from {device}")
+                with open(os.path.join(sysfs_root, device, "power", "wakeup"), "w") as f:
+                    f.write("enabled" if enabled else "disabled")
+            # sysfs is reset on boot, tmpfiles.d writes the devices that differ
+            # from the kernel's default again
+            default = pins[device]["default"] if device in pins else devices[device]["enabled"]
+            if enabled == default:
+                pins.pop(device, None)
+            else:
+                pins[device] = {"enabled": enabled, "default": default}
+        if pins:
+            atomic_write(tmpfiles, f"# Wakeup sources selected in {APP_ID}\n" + wakeup_tmpfiles(pins))
+        else:
+            try:
+                os.remove(tmpfiles)
+            except FileNotFoundError:
+                pass
+        result["wakeup"] = wakeup
+    return result
+
+
+def privileged_set_sleep_state(args, session):
+    return apply_sleep_state(args, session)
+
+
+AUDIT_LOG_DIR = "/var/log/audit"
+AUDIT_SCAN_PATH = f"/var/lib/{APP_ID}/audit-scan.json"
+AUDIT_BLOCK_SIZE = 4 * 1024 ** 2
+AVC_DENIED_MARKER = b"avc:  denied"
+# Newest distinct denials kept in the scan summary
+AUDIT_DENIAL_LIMIT = 100
+# Processes and SELinux types involved in suspend, hibernate and resume (comm is cut to 15 characters)
+HIBERNATE_AVC_COMMANDS = {"systemd-sleep", "systemd-logind", "systemd-hiberna", "swapon", "swapoff", "mkswap", "dracut"}
+HIBERNATE_AVC_TYPES = {"systemd_sleep_t", "systemd_logind_t", "systemd_hibernate_resume_t", "swapfile_t"}
+
+
+def audit_log_files(log_dir=AUDIT_LOG_DIR):
+    """Return the audit log and its rotated copies, oldest first."""
+    files = []
+    if not os.path.isdir(log_dir):
+        # auditd is not installed
+        return files
+    for name in os.listdir(log_dir):
+        suffix = name[len("audit.log"):]
+        if name.startswith("audit.log") and (suffix == "" or suffix[1:].isdigit() and suffix[0] == "."):
+            files.append((int(suffix[1:] or 0), os.path.join(log_dir, name)))
+    return [path for generation, path in sorted(files, reverse=True)]
+
+
+def scan_audit_file(path, offset, on_denial, block_size=AUDIT_BLOCK_SIZE):
+    """Hand every AVC denial after ``offset`` to ``on_denial``, returning the offset after the last full line.
+
+    Blocks are searched for the denial marker directly, so the lines that are
+    not denials are never split or decoded.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        carry = b""
+        for block in iter(lambda: f.read(block_size), b""):
+            data = carry + block
+            end = data.rfind(b"\n") + 1
+            # A line still being written is left for the next scan
+            carry = data[end:]
+            position = data.find(AVC_DENIED_MARKER, 0, end)
+            while position != -1:
+                start = data.rfind(b"\n", 0, position) + 1
+                stop = data.find(b"\n", position)
+                on_denial(data[start:stop])
+                position = data.find(AVC_DENIED_MARKER, stop, end)
+            offset += end
+    return offset
+
+
+def parse_avc(line):
+    """Return the fields of an AVC denial record that matter for hibernation."""
+    text = line.decode("utf-8", "replace")
+    fields = {key: value.strip('"') for key, value in re.findall(r'(\w+)=("[^"]*"|\S+)', text)}
+    permissions = re.search(r"\{ ([^}]*) \}", text)
+    stamp = re.search(r"audit\((\d+(?:\.\d+)?):", text)
+
+    def selinux_type(context):
+        parts = context.split(":")
+        return parts[2] if len(parts) > 2 else context
+
+    return {
+        "time": float(stamp.group(1)) if stamp else None,
+        "comm": fields.get("comm", ""),
+        "permissions": permissions.group(1).split() if permissions else [],
+        "name": fields.get("name", ""),
+        "path": fields.get("path", ""),
+        "scontext": selinux_type(fields.get("scontext", "")),
+        "tcontext": selinux_type(fields.get("tcontext", "")),
+        "tclass": fields.get("tclass", ""),
+        "permissive": fields.get("permissive") == "1",
+    }
+
+
+def hibernation_related(denial):
+    return (
+        denial["comm"] in HIBERNATE_AVC_COMMANDS
+        or denial["scontext"] in HIBERNATE_AVC_TYPES
+        or denial["tcontext"] in HIBERNATE_AVC_TYPES
+        or "swap" in denial["name"] or "swap" in denial["path"]
+    )
+
+
+def suggest_avc_fix(denial):
+    """Return a command that should resolve a denial: relabel what is mislabeled, otherwise extend the policy."""
+    target = denial["path"] or denial["name"]
+    if "swap" in target and denial["tclass"] == "file" and denial["tcontext"] != "swapfile_t":
+        if not denial["path"].startswith("/"):
+            # Records without a path= only name the file, which may be any swap file
+            placeholder = f"<path of {denial['name']}>"
+            return f"semanage fcontext -a -t swapfile_t {placeholder} && restorecon -v {placeholder}"
+        path = denial["path"]
+        return (
+            f"semanage fcontext -a -t swapfile_t {shlex.quote(re.escape(path))} && restorecon -v {shlex.quote(path)}"
+        )
+    if denial["tcontext"] in ("unlabeled_t", "default_t", "file_t"):
+        return f"restorecon -Rv {shlex.quote(denial['path']) if denial['path'] else '<path of ' + denial['name'] + '>'}"
+    module = "hibernate-" + "".join(c if c.isalnum() else "-" for c in denial["comm"] or "local")
+    return (
+        f"ausearch -m AVC -c {shlex.quote(denial['comm'])} --raw | audit2allow -M {module} && semodule -i {module}.pp"
+    )
+
+
+def scan_audit_logs(log_dir=AUDIT_LOG_DIR, index_path=AUDIT_SCAN_PATH):
+    """Scan the audit logs for hibernation related denials, reading only what earlier scans did not.
+
+    The index keeps the offset reached in each log file by device and inode,
+    so a log that was rotated to audit.log.1 is not read again, and the
+    distinct denials found so far with a count and a suggested fix.
+    """
+    try:
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    offsets = index.get("files", {})
+    # Suggestions are made again, they may have improved since the denial was first seen
+    denials = {denial["key"]: dict(denial, fix=suggest_avc_fix(denial)) for denial in index.get("denials", [])}
+
+    start = time.perf_counter()
+    scanned = 0
+    new = 0
+    files = {}
+
+    def on_denial(line):
+        nonlocal new
+        denial = parse_avc(line)
+        if not hibernation_related(denial):
+            return
+        key = "|".join([denial["comm"], denial["scontext"], denial["tcontext"], denial["tclass"],
+                        " ".join(denial["permissions"]), denial["name"] or denial["path"]])
+        entry = denials.setdefault(key, dict(denial, key=key, count=0, first=denial["time"], fix=suggest_avc_fix(denial)))
+        entry["count"] += 1
+        entry["time"] = denial["time"]
+        new += 1
+
+    for path in audit_log_files(log_dir):
+        info = os.stat(path)
+        inode = f"{info.st_dev}:{info.st_ino}"
+        known = offsets.get(inode, {"offset": 0, "head": ""})
+        with open(path, "rb") as f:
+            head = f.read(len(known["head"]) // 2).hex()
+        offset = known["offset"]
+        # A truncated log, or a new file that reuses the inode, is read from the start
+        if known["head"] != head or info.st_size < offset:
+            offset = 0
+        end = scan_audit_file(path, offset, on_denial)
+        scanned += end - offset
+        with open(path, "rb") as f:
+            head = f.read(min(end, 64)).hex()
+        files[inode] = {"path": path, "offset": end, "head": head}
+
+    kept = sorted(denials.values(), key=lambda denial: denial["time"] or 0)[-AUDIT_DENIAL_LIMIT:]
+    summary = {"scanned": time.time(), "files": files, "denials": kept}
+    # Readable by the unprivileged window, it only holds hibernation related denials
+    atomic_write(index_path, json.dumps(summary, indent=1))
+    return {"bytes": scanned, "new": new, "seconds": time.perf_counter() - start, "denials": kept}
+
+
+def privileged_scan_audit(args, session):
+    result = scan_audit_logs()
+    session.log(f"Scanned {result['bytes']} bytes of audit log in {result['seconds']:.2f}s, "
+                f"{result['new']} new hibernation related denials")
+    return {key: value for key, value in result.items() if key != "denials"}
+
+
+def privileged_install_extension(args, session):
+    root = checked_sysroot(args.get("root", "/"))
+    session.log(f"Installing the extension from {args['archive']} in {root}")
+    return {"uuid": install_sysroot_extension(args["archive"], root)}
+
+
+def privileged_uninstall_extension(args, session):
+    root = checked_sysroot(args.get("root", "/"))
+    return {"removed": uninstall_sysroot_extension(root)}
+
+
+PRIVILEGED_OPERATIONS = {
+    "write_file": privileged_write_file,
+    "install_packages": privileged_install_packages,
+    "run_script": privileged_run_script,
+    "provision_swap": privileged_provision_swap,
+    "tune_hibernation": privileged_tune_hibernation,
+    "install_sleep_hook": privileged_install_sleep_hook,
+    "scan_audit": privileged_scan_audit,
+    "set_sleep_state": privileged_set_sleep_state,
+    "install_extension": privileged_install_extension,
+    "uninstall_extension": privileged_uninstall_extension,
+    "batch": privileged_batch,
+}
+
+
+class OperationSession:
+    """Lets a privileged operation run commands and report progress lines."""
+
+    def __init__(self, on_line):
+        self.on_line = on_line
+        self.cancelled = False
+        self._job = None
+
+    def log(self, line):
+        self.on_line("stdout", line)
+
+    def step(self, name, phase):
+        self.log(f"{STEP_MARKER} {name} {phase} {time.time():.6f}")
+
+    def run(self, command, on_line=None):
+        if self.cancelled:
+            raise RuntimeError("Cancelled")
+
+        def handle_line(job, stream, line):
+            self.on_line(stream, line)
+            if on_line is not None:
+                on_line(stream, line)
+
+        job = Job(command, on_line=handle_line)
+        self._job = job
+        try:
+            job.start().wait()
+        finally:
+            self._job = None
+        if job.cancelled:
+            raise RuntimeError("Cancelled")
+        if job.returncode != 0:
+            raise RuntimeError(f"{' '.join(command)} exited with code {job.returncode}")
+        return job.stdout
+
+    def cancel(self):
+        self.cancelled = True
+        if self._job is not None:
+            self._job.cancel()
+
+
+def handle_helper_request(request, emit, running):
+    request_id = request.get("id")
+    session = OperationSession(lambda stream, line: emit({"id": request_id, "stream": stream, "line": line}))
+    running[request_id] = session
+    try:
+        operation = PRIVILEGED_OPERATIONS.get(request.get("op"))
+        if operation is None:
+            raise ValueError(f"Unknown operation: {request.get('op')}")
+        result = operation(request.get("args") or {}, session)
+        emit({"id": request_id, "done": True, "ok": True, "result": result})
+    except Exception as e:
+        emit({"id": request_id, "done": True, "ok": False, "error": f"{type(e).__name__}: {e}"})
+    finally:
+        running.pop(request_id, None)
+
+
+def run_helper(requests_in=None, replies_out=None):
+    """Serve privileged requests until the client closes stdin.
+
+    The protocol is one JSON object per line. A request is
+    ``{"id": 1, "op": "write_file", "args": {...}}``; the helper replies with
+    ``{"id": 1, "stream": "stdout", "line": "..."}`` for command output and a
+    final ``{"id": 1, "done": true, "ok": true, "result": ...}``. Requests run
+    one at a time in order, except that a request with a ``"queue"`` runs
+    alongside the requests of other queues, ``{"op": "cancel", "target": 1}``
+    stops one.
+    """
+    requests_in = requests_in or sys.stdin
+    replies_out = replies_out or sys.stdout
+    # Progress messages go to stderr, stdout carries the protocol only
+    sys.stdout = sys.stderr
+    log.info(f"Privileged helper started with uid {os.getuid()}.")
+
+    lock = threading.Lock()
+
+    def emit(message):
+        with lock:
+            replies_out.write(json.dumps(message) + "\n")
+            replies_out.flush()
+
+    # One worker per queue, so that sysroots are prepared concurrently
+    workers = {}
+    running = {}
+    cancelled = set()
+
+    def worker(pending):
+        while True:
+            request = pending.get()
+            if request is None:
+                return
+            if request.get("id") in cancelled:
+                emit({"id": request.get("id"), "done": True, "ok": False, "error": "Cancelled"})
+                continue
+            handle_helper_request(request, emit, running)
+
+    for line in requests_in:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            emit({"id": None, "done": True, "ok": False, "error": "Malformed request"})
+            continue
+        if request.get("op") == "cancel":
+            cancelled.add(request.get("target"))
+            session = running.get(request.get("target"))
+            if session:
+                session.cancel()
+            continue
+        name = request.get("queue")
+        if name not in workers:
+            pending = queue.Queue()
+            workers[name] = (pending, threading.Thread(target=worker, args=(pending,)))
+            workers[name][1].start()
+        workers[name][0].put(request)
+    for pending, thread in workers.values():
+        pending.put(None)
+    for pending, thread in workers.values():
+        thread.join()
+    log.info("Privileged helper exiting.")
+    return 0
+
+
+class HelperRequest(Job):
+    """A request to the privileged helper, usable wherever a Job is."""
+
+    def __init__(self, helper, op, args, queue=None, **kwargs):
+        super().__init__(["privileged-helper", op], **kwargs)
+        self.helper = helper
+        self.op = op
+        self.args = args
+        self.queue = queue
+        self.id = None
+        self.process = None
+        self.result = None
+        self.error = None
+
+    def start(self):
+        log.info(f"Sending {self.op} request to the privileged helper")
+        self.span = TRACER.span(self.op, "helper")
+        self.helper.submit(self)
+        return self
+
+    def cancel(self):
+        if self.running and self.id is not None:
+            self.cancelled = True
+            self.helper.send({"op": "cancel", "target": self.id})
+
+    def complete(self, message):
+        self.result = message.get("result")
+        self.error = message.get("error")
+        if self.error:
+            self._append("stderr", self.error)
+        self.returncode = 0 if message.get("ok") else 1
+        self._finish()
+
+
+class PrivilegedHelper:
+    """Client side of the privileged helper.
+
+    The helper is this script started with ``--helper`` through pkexec, so
+    polkit asks for authorization once and every later request reuses the same
+    root process over its stdin/stdout. If the helper exits (for example
+    because authorization was dismissed) the next request starts a new one.
+    ``command`` can point at an unprivileged helper for testing.
+    """
+
+    def __init__(self, command=None, dispatch=None):
+        self.command = command or ["pkexec", sys.executable, os.path.abspath(__file__), "--helper"]
+        self.dispatch = dispatch
+        self._process = None
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._requests = {}
+
+    def request(self, op, on_line=None, on_done=None, queue=None, **args):
+        return HelperRequest(self, op, args, queue, on_line=on_line, on_done=on_done, dispatch=self.dispatch)
+
+    def call(self, op, queue=None, **args):
+        """Run a request and return its result, requests in different ``queue``s run concurrently."""
+        request = self.request(op, queue=queue, **args).start()
+        request.wait()
+        if request.returncode != 0:
+            raise RuntimeError(request.error)
+        return request.result
+
+    def submit(self, request):
+        with self._lock:
+            if self._process is None:
+                log.info(f"Starting privileged helper: {' '.join(self.command)}")
+                self._process = subprocess.Popen(
+                    self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1,
+                )
+                threading.Thread(target=self._read_replies, args=(self._process,), daemon=True).start()
+            request.id = self._next_id
+            request.process = self._process
+            self._next_id += 1
+            self._requests[request.id] = request
+        message = {"id": request.id, "op": request.op, "args": request.args}
+        if request.queue is not None:
+            message["queue"] = request.queue
+        if not self.send(message):
+            self._requests.pop(request.id, None)
+            request.complete({"ok": False, "error": "The privileged helper is not running"})
+
+    def send(self, message):
+        with self._lock:
+            process = self._process
+        try:
+            process.stdin.write(json.dumps(message) + "\n")
+            process.stdin.flush()
+        except (AttributeError, OSError):
+            return False
+        return True
+
+    def close(self):
+        with self._lock:
+            process, self._process = self._process, None
+        if process is not None:
+            process.stdin.close()
+
+    def _read_replies(self, process):
+        for line in process.stdout:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                log.warning(f"Unexpected helper output: {line.rstrip()}")
+                continue
+            request = self._requests.get(message.get("id"))
+            if request is None:
+                continue
+            if message.get("done"):
+                self._requests.pop(request.id, None)
+                request.complete(message)
+            elif "line" in message:
+                request._append(message.get("stream", "stdout"), message["line"])
+
+        returncode = process.wait()
+        log.info(f"Privileged helper exited with code {returncode}.")
+        with self._lock:
+            if self._process is process:
+                self._process = None
+            # Anything still waiting on this helper will not be answered
+            orphaned = [request for request in self._requests.values() if request.process is process]
+            for request in orphaned:
+                del self._requests[request.id]
+        for request in orphaned:
+            request.complete({"ok": False, "error": f"The privileged helper exited with code {returncode}"})
+
+
+# Directories systemd reads its configuration from, highest precedence first
+SYSTEMD_CONFIG_DIRS = ["/etc/systemd", "/run/systemd", "/usr/local/lib/systemd", "/usr/lib/systemd"]
+# Drop-in this application writes its settings to
+MANAGED_DROPIN = f"90-{APP_ID}.conf"
+
+
+def parse_systemd_config(text):
+    """Yield ``(section, key, value)`` for every assignment in ``text``, in file order."""
+    section = None
+    pending = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line[0] in "#;":
+            continue
+        if pending is not None:
+            line = pending + line
+            pending = None
+        if line[-1] == "\\":
+            pending = line[:-1] + " "
+            continue
+        if line[0] == "[" and line[-1] == "]":
+            section = line[1:-1].strip()
+            continue
+        key, sep, value = line.partition("=")
+        if sep:
+            yield section, key.strip(), value.strip()
+
+
+def render_systemd_config(section, values):
+    lines = [f"# Managed by {APP_ID}, changes made here may be overwritten.", f"[{section}]"]
+    lines += [f"{key}={value}" for key, value in values.items()]
+    return "\n".join(lines) + "\n"
+
+
+class SystemdConfig:
+    """A systemd configuration file such as sleep.conf, read together with its drop-ins.
+
+    Values are resolved the way systemd does it: the main file first, then the
+    ``<name>.d/*.conf`` drop-ins of all configuration directories sorted by file
+    name, with the later assignment winning. Updates go to a drop-in owned by
+    this application rather than to the main file.
+    """
+
+    def __init__(self, name, section, root="/"):
+        self.name = name
+        self.section = section
+        self.root = root
+        self.managed_path = rooted(root, SYSTEMD_CONFIG_DIRS[0], f"{name}.d", MANAGED_DROPIN)
+
+    def sources(self, include_managed=False):
+        paths = []
+        # The main file comes from the first directory that has one
+        for directory in SYSTEMD_CONFIG_DIRS:
+            path = rooted(self.root, directory, self.name)
+            if os.path.isfile(path):
+                paths.append(path)
+                break
+
+        # A drop-in hides drop-ins of the same name in lower precedence directories
+        dropins = {}
+        for directory in reversed(SYSTEMD_CONFIG_DIRS):
+            dropin_dir = rooted(self.root, directory, f"{self.name}.d")
+            try:
+                names = os.listdir(dropin_dir)
+            except OSError:
+                continue
+            for name in names:
+                if name.endswith(".conf"):
+                    dropins[name] = os.path.join(dropin_dir, name)
+        if include_managed:
+            dropins[MANAGED_DROPIN] = self.managed_path
+        return paths + [dropins[name] for name in sorted(dropins)]
+
+    def effective(self, replace=None):
+        """Return ``{key: (value, path)}`` for the section.
+
+        ``replace`` is an optional ``(path, text)`` pair whose text is used in
+        place of that file, which need not exist yet.
+        """
+        values = {}
+        for path in self.sources(include_managed=replace is not None):
+            if replace is not None and path == replace[0]:
+                text = replace[1]
+            else:
+                try:
+                    with TRACER.span("read", "file", path=path), open(path, "r") as f:
+                        text = f.read()
+                except OSError:
+                    continue
+            for section, key, value in parse_systemd_config(text):
+                if section != self.section:
+                    continue
+                if value:
+                    values[key] = (value, path)
+                else:
+                    # An empty assignment resets the key to its default
+                    values.pop(key, None)
+        return values
+
+    def get(self, key, default=None):
+        return self.effective().get(key, (default, None))[0]
+
+    def managed_values(self):
+        try:
+            with open(self.managed_path, "r") as f:
+                text = f.read()
+        except OSError:
+            return {}
+        return {key: value for section, key, value in parse_systemd_config(text) if section == self.section}
+
+    def plan_update(self, values):
+        """Return the write that makes ``values`` effective, or None if they already are.
+
+        The result is a dict with the drop-in ``path`` and ``content``, the
+        ``changes`` it makes, and as ``overridden`` the keys a later drop-in
+        would still override, mapped to that drop-in's path.
+        """
+        values = {key: str(value) for key, value in values.items()}
+        effective = self.effective()
+        changes = {key: value for key, value in values.items() if effective.get(key, (None,))[0] != value}
+        if not changes:
+            return None
+
+        managed = self.managed_values()
+        managed.update(values)
+        content = render_systemd_config(self.section, managed)
+        resolved = self.effective(replace=(self.managed_path, content))
+        overridden = {
+            key: resolved[key][1] for key, value in values.items()
+            if key in resolved and resolved[key][0] != value
+        }
+        return {"path": self.managed_path, "content": content, "changes": changes, "overridden": overridden}
+
+
+def benchmark_config_parser(lines=100000, rounds=5):
+    """Time the systemd config parser against configparser on a large, comment-heavy file."""
+    body = []
+    for index in range(lines // 10):
+        if index % 100 == 0:
+            body.append(f"[Section{index // 100}]")
+        body += [f"# Comment line {index} explaining the setting below in some detail"] * 6
+        body += [";HibernateDelaySec=600", "", f"Key{index}=value {index}"]
+    text = "\n".join(body) + "\n"
+
+    def measure(parse):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            parse()
+        return (time.perf_counter() - start) / rounds
+
+    def parse_configparser():
+        parser = configparser.ConfigParser(strict=False, interpolation=None)
+        parser.read_string(text)
+
+    results = {
+        "systemd": measure(lambda: sum(1 for _ in parse_systemd_config(text))),
+        "configparser": measure(parse_configparser),
+    }
+    print(f"Config parsing over {len(body)} lines, {rounds} rounds:")
+    for name, seconds in results.items():
+        print(f"  {name:<12} {seconds * 1000:8.2f} ms  {len(body) / seconds:12.0f} lines/s")
+    return results
+
+EXTENSION_URL = "https://github.com/ctsdownloads/gnome-shell-extension-hibernate-status/archive/refs/heads/master.zip"
+EXTENSION_UUID = "hibernate-status@ctsdownloads"
+EXTENSIONS_DIR = "~/.local/share/gnome-shell/extensions"
+# Where extensions go in a sysroot, for every user of the image
+SYSTEM_EXTENSIONS_DIR = "/usr/share/gnome-shell/extensions"
+# dconf defaults that enable the extension in a sysroot
+DCONF_DEFAULTS_DIR = "/etc/dconf/db/local.d"
+# Size of the chunks the extension archive is downloaded and hashed in
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def cache_dir():
+    path = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), APP_ID)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_sha256(path):
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@TRACER.traced("fetch extension", "network")
+def fetch_extension_archive(url=EXTENSION_URL, directory=None, sha256=None):
+    """Return ``(path, status)`` of the extension archive in the cache directory.
+
+    A cached archive is revalidated with its ETag and Last-Modified, and only
+    reused after its SHA-256 still matches what was recorded on download.
+    ``status`` is "downloaded", "not-modified" or "offline" (the server could
+    not be reached and the cached copy is used). Passing ``sha256`` pins the
+    expected checksum of the archive.
+    """
+    import hashlib
+    import urllib.error
+    import urllib.request
+
+    directory = directory or cache_dir()
+    archive = os.path.join(directory, "hibernate-status.zip")
+    metadata_path = archive + ".json"
+    try:
+        with open(metadata_path, "r") as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        metadata = {}
+    cached = (
+        metadata.get("url") == url
+        and os.path.isfile(archive)
+        and file_sha256(archive) == metadata.get("sha256")
+        and sha256 in (None, metadata.get("sha256"))
+    )
+
+    request = urllib.request.Request(url)
+    if cached and metadata.get("etag"):
+        request.add_header("If-None-Match", metadata["etag"])
+    if cached and metadata.get("last_modified"):
+        request.add_header("If-Modified-Since", metadata["last_modified"])
+
+    log.info(f"Fetching extension from {url}")
+    try:
+        response = urllib.request.urlopen(request, timeout=30)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached:
+            log.info("Cached extension archive is up to date.")
+            return archive, "not-modified"
+        raise
+    except urllib.error.URLError as e:
+        if cached:
+            log.warning(f"Could not reach {url} ({e.reason}), using the cached archive.")
+            return archive, "offline"
+        raise
+
+    # Stream into a temporary file next to the archive and hash it on the way
+    digest = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".hibernate-status.")
+    try:
+        with response, os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: response.read(DOWNLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                f.write(chunk)
+        if sha256 is not None and digest.hexdigest() != sha256:
+            raise RuntimeError(f"Checksum mismatch for {url}: expected {sha256}, got {digest.hexdigest()}")
+        os.rename(temp_path, archive)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    metadata = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "sha256": digest.hexdigest(),
+    }
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f, indent=2)
+    log.info(f"Extension downloaded to {archive} (sha256 {metadata['sha256']}).")
+    return archive, "downloaded"
+
+
+def rename_exchange(source, target):
+    """Atomically swap two paths with renameat2(RENAME_EXCHANGE)."""
+    import ctypes
+
+    libc = ctypes.CDLL(None, use_errno=True)
+    at_fdcwd, rename_exchange_flag = -100, 2
+    if libc.renameat2(at_fdcwd, os.fsencode(source), at_fdcwd, os.fsencode(target), rename_exchange_flag) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno), target)
+
+
+@TRACER.traced("extract extension", "file")
+def extract_extension(archive, staging_dir):
+    """Extract the extension in ``archive`` into ``staging_dir``, returning its metadata.
+
+    The directory holding metadata.json becomes the root of the extension,
+    which strips the top-level folder GitHub archives wrap everything in.
+    """
+    import zipfile
+
+    with zipfile.ZipFile(archive) as zf:
+        candidates = [name for name in zf.namelist() if os.path.basename(name) == "metadata.json"]
+        if not candidates:
+            raise RuntimeError("Failed to find metadata.json in the extension archive.")
+        metadata_name = min(candidates, key=lambda name: name.count("/"))
+        prefix = metadata_name[:-len("metadata.json")]
+        metadata = json.loads(zf.read(metadata_name))
+
+        for info in zf.infolist():
+            if not info.filename.startswith(prefix) or info.filename == prefix:
+                continue
+            destination = os.path.normpath(os.path.join(staging_dir, info.filename[len(prefix):]))
+            if not destination.startswith(staging_dir + os.sep):
+                raise RuntimeError(f"Unsafe path in the extension archive: {info.filename}")
+            if info.is_dir():
+                os.makedirs(destination, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with zf.open(info) as source, open(destination, "wb") as target:
+                shutil.copyfileobj(source, target)
+            mode = (info.external_attr >> 16) & 0o777
+            if mode:
+                os.chmod(destination, mode)
+    return metadata
+
+
+@TRACER.traced("install extension")
+def install_extension_archive(archive, extensions_dir=EXTENSIONS_DIR, enable=True):
+    """Install the extension from its archive and, if ``enable``, try to enable it.
+
+    The archive is extracted into a staging directory next to the target,
+    which then replaces the installed copy in one rename. Returns
+    ``(uuid, enabled)``. Raises RuntimeError if the archive does not contain a
+    usable extension.
+    """
+    extensions_dir = os.path.expanduser(extensions_dir)
+    os.makedirs(extensions_dir, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=extensions_dir, prefix=".staging-")
+    try:
+        # mkdtemp makes it 0700, GNOME Shell of other users reads the system wide copy
+        os.chmod(staging_dir, 0o755)
+        log.info(f"Extracting {archive} to {staging_dir}")
+        extension_uuid = extract_extension(archive, staging_dir).get("uuid")
+        if not extension_uuid or "/" in extension_uuid or extension_uuid.startswith("."):
+            raise RuntimeError("Failed to get UUID from metadata.json.")
+        log.info(f"Extension UUID: {extension_uuid}")
+
+        # Compile schemas if the extension has any, before it goes live
+        schemas_dir = os.path.join(staging_dir, 'schemas')
+        if os.path.exists(schemas_dir):
+            log.info("Compiling schemas...")
+            subprocess.run(['glib-compile-schemas', schemas_dir], check=True)
+            log.info("Schemas compiled.")
+        else:
+            log.info("No schemas directory found; skipping schema compilation.")
+
+        target_dir = os.path.join(extensions_dir, extension_uuid)
+        if os.path.exists(target_dir):
+            try:
+                rename_exchange(staging_dir, target_dir)
+            except (AttributeError, OSError):
+                # renameat2 is unavailable, move the old copy aside first
+                os.rename(target_dir, staging_dir + ".old")
+                os.rename(staging_dir, target_dir)
+                os.rename(staging_dir + ".old", staging_dir)
+            log.info(f"Existing extension in {target_dir} replaced.")
+        else:
+            os.rename(staging_dir, target_dir)
+            log.info(f"Extension installed to {target_dir}")
+    finally:
+        # After a swap the staging directory holds the previous version
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    if not enable:
+        return extension_uuid, False
+    log.info("Enabling the extension...")
+    return extension_uuid, enable_extension(extension_uuid)
+
+
+def install_sysroot_extension(archive, root):
+    """Install the extension system wide in a sysroot and enable it by default for its users."""
+    extension_uuid, enabled = install_extension_archive(archive, rooted(root, SYSTEM_EXTENSIONS_DIR), enable=False)
+    dconf_dir = rooted(root, DCONF_DEFAULTS_DIR)
+    atomic_write(
+        os.path.join(dconf_dir, f"90-{APP_ID}"),
+        f"[org/gnome/shell]\nenabled-extensions=['{extension_uuid}']\n",
+    )
+    compile_dconf_defaults(dconf_dir)
+    return extension_uuid
+
+
+def uninstall_sysroot_extension(root):
+    removed = []
+    for path in glob.glob(rooted(root, SYSTEM_EXTENSIONS_DIR, "*hibernate-status*")):
+        shutil.rmtree(path)
+        removed.append(os.path.basename(path))
+    try:
+        os.unlink(rooted(root, DCONF_DEFAULTS_DIR, f"90-{APP_ID}"))
+        compile_dconf_defaults(rooted(root, DCONF_DEFAULTS_DIR))
+    except FileNotFoundError:
+        pass
+    return removed
+
+
+def compile_dconf_defaults(dconf_dir):
+    # The image's own dconf update would do the same at boot, compiling here makes it take effect at once
+    try:
+        subprocess.run(["dconf", "compile", dconf_dir[:-len(".d")], dconf_dir], check=True)
+    except FileNotFoundError:
+        log.warning(f"dconf is not installed, run dconf update in the image to apply {dconf_dir}.")
+
+
+# org.gnome.Shell.Extensions state value of an extension that has been removed
+EXTENSION_STATE_UNINSTALLED = 99
+# Milliseconds a call to GNOME Shell may take
+SHELL_CALL_TIMEOUT = 5000
+
+
+class ShellExtensions:
+    """Client for GNOME Shell's org.gnome.Shell.Extensions D-Bus interface.
+
+    ``shared()`` returns one proxy for the whole process. The extension list
+    is fetched once and then kept current from ExtensionStateChanged
+    signals (delivered on the main loop of the thread that created the
+    proxy), so state checks need neither a process nor a round trip. It is
+    fetched again after the Shell restarts.
+    ``bus`` can be any Gio.DBusConnection, such as a python-dbusmock session
+    bus standing in for the Shell.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def __init__(self, bus=None):
+        from gi.repository import Gio
+
+        self._Gio = Gio
+        bus = bus or Gio.bus_get_sync(Gio.BusType.SESSION, None)
+        self.proxy = Gio.DBusProxy.new_sync(
+            bus, Gio.DBusProxyFlags.DO_NOT_AUTO_START, None,
+            "org.gnome.Shell", "/org/gnome/Shell", "org.gnome.Shell.Extensions", None,
+        )
+        self.proxy.connect("g-signal", self._on_signal)
+        self.proxy.connect("notify::g-name-owner", self._on_owner_changed)
+        self._lock = threading.Lock()
+        self._extensions = None
+
+    @property
+    def available(self):
+        return self.proxy.get_name_owner() is not None
+
+    def _call(self, method, signature=None, *args):
+        from gi.repository import GLib
+
+        if not self.available:
+            raise RuntimeError("GNOME Shell is not running on the session bus")
+        parameters = GLib.Variant(signature, args) if signature else None
+        return self.proxy.call_sync(
+            method, parameters, self._Gio.DBusCallFlags.NONE, SHELL_CALL_TIMEOUT, None,
+        ).unpack()
+
+    def list(self):
+        """Return ``{uuid: info}`` for every extension the Shell knows about."""
+        with self._lock:
+            if self._extensions is None:
+                self._extensions = self._call("ListExtensions")[0]
+            return dict(self._extensions)
+
+    def is_installed(self, uuid):
+        return uuid in self.list()
+
+    def enable(self, uuid):
+        return self._call("EnableExtension", "(s)", uuid)[0]
+
+    def disable(self, uuid):
+        return self._call("DisableExtension", "(s)", uuid)[0]
+
+    def uninstall(self, uuid):
+        removed = self._call("UninstallExtension", "(s)", uuid)[0]
+        if removed:
+            with self._lock:
+                if self._extensions is not None:
+                    self._extensions.pop(uuid, None)
+        return removed
+
+    def _on_owner_changed(self, proxy, param):
+        # A restarted Shell may know other extensions, and signals sent while it was gone were missed
+        with self._lock:
+            self._extensions = None
+
+    def _on_signal(self, proxy, sender, signal, parameters):
+        if signal != "ExtensionStateChanged":
+            return
+        uuid, info = parameters.unpack()
+        with self._lock:
+            if self._extensions is None:
+                return
+            if info.get("state") == EXTENSION_STATE_UNINSTALLED:
+                self._extensions.pop(uuid, None)
+            else:
+                self._extensions[uuid] = info
+
+
+def shell_extensions():
+    """Return the shared ShellExtensions client, or None if GNOME Shell cannot be reached."""
+    try:
+        client = ShellExtensions.shared()
+    except Exception as e:
+        log.warning(f"GNOME Shell extensions service unavailable: {e}")
+        return None
+    return client if client.available else None
+
+
+def enable_extension(uuid):
+    """Enable an extension, returning True if the running Shell enabled it right away.
+
+    A freshly installed extension is unknown to the Shell until the next
+    login, so it is added to the enabled-extensions setting to start then.
+    """
+    client = shell_extensions()
+    try:
+        if client is not None and client.enable(uuid):
+            log.info(f"Extension {uuid} enabled.")
+            return True
+    except Exception as e:
+        log.warning(f"The Shell could not enable {uuid}: {e}")
+
+    from gi.repository import Gio
+
+    source = Gio.SettingsSchemaSource.get_default()
+    if source is None or source.lookup("org.gnome.shell", True) is None:
+        log.warning("GNOME Shell settings are not installed, the extension cannot be enabled.")
+        return False
+    settings = Gio.Settings.new("org.gnome.shell")
+    enabled = settings.get_strv("enabled-extensions")
+    if uuid not in enabled:
+        settings.set_strv("enabled-extensions", enabled + [uuid])
+    settings.set_strv("disabled-extensions", [u for u in settings.get_strv("disabled-extensions") if u != uuid])
+    Gio.Settings.sync()
+    log.info(f"Extension {uuid} will be enabled at the next login.")
+    return False
+
+
+def uninstall_hibernate_extensions():
+    """Uninstall every installed hibernate-status extension, returning their UUIDs."""
+    client = shell_extensions()
+    if client is None:
+        # Nothing is loaded without a Shell, removing the files is enough
+        removed = []
+        for path in glob.glob(os.path.join(os.path.expanduser(EXTENSIONS_DIR), "*hibernate-status*")):
+            log.info(f"Removing {path}...")
+            shutil.rmtree(path)
+            removed.append(os.path.basename(path))
+        return removed
+    # Filter extensions that have 'hibernate-status' in their UUID
+    extension_uuids = [uuid for uuid in client.list() if 'hibernate-status' in uuid]
+    for extension_uuid in extension_uuids:
+        log.info(f"Uninstalling extension {extension_uuid}...")
+        if not client.uninstall(extension_uuid):
+            raise RuntimeError(f"GNOME Shell refused to uninstall {extension_uuid}.")
+    return extension_uuids
+
+
+EXTENSION_FETCH_LOCK = threading.Lock()
+
+# Seconds the status probes may take before the slow ones are reported as timed out
+STATUS_PROBE_TIMEOUT = 5
+
+
+def probe_dependencies(root="/"):
+    return {"missing": package_inventory(root).missing(["python3-gobject", "polkit"])}
+
+
+def extension_system_wide(root="/"):
+    """Whether the extension goes in the system extensions directory, enabled through dconf defaults.
+
+    That is the case for sysroots, and for root on the running system, as in
+    kickstart or first-boot scripts where there is no user session.
+    """
+    return root != "/" or os.geteuid() == 0
+
+
+def probe_extension(root="/"):
+    if extension_system_wide(root):
+        installed = os.path.isdir(rooted(root, SYSTEM_EXTENSIONS_DIR, EXTENSION_UUID))
+        return {"installed": installed, "source": "sysroot" if root != "/" else "system"}
+    # The files are checked in any case: the running Shell only sees an extension installed after it started
+    # from the next login, and the status panel runs this probe when the extension directory changes
+    on_disk = any(
+        os.path.isdir(os.path.join(os.path.expanduser(directory), EXTENSION_UUID))
+        for directory in (EXTENSIONS_DIR, SYSTEM_EXTENSIONS_DIR)
+    )
+    client = shell_extensions()
+    if client is not None:
+        active = client.is_installed(EXTENSION_UUID)
+        return {"installed": active or on_disk, "active": active, "source": "shell"}
+    return {"installed": on_disk, "source": "filesystem"}
+
+
+def format_extension_status(result):
+    if not result["installed"]:
+        return "Not Installed"
+    if result.get("active") is False:
+        return "Installed, active after the next login"
+    return "Installed"
+
+
+def probe_config(name, section, key):
+    def probe(root="/"):
+        value, path = SystemdConfig(name, section, root).effective().get(key, (None, None))
+        return {"value": value, "source": path}
+    return probe
+
+
+# MESSAGE_IDs systemd-sleep logs around every sleep operation
+SLEEP_START_MESSAGE_ID = "6bbd95ee977941e497c48be27c254128"
+SLEEP_STOP_MESSAGE_ID = "8811e6df2a8e40f58a94cea26f8ebf14"
+# Completed sleep cycles kept in the state directory
+SLEEP_HISTORY_LENGTH = 200
+SLEEP_JOURNAL_FIELDS = [
+    "MESSAGE", "MESSAGE_ID", "SLEEP", "SYSLOG_IDENTIFIER", "_TRANSPORT", "_BOOT_ID", "_SOURCE_MONOTONIC_TIMESTAMP",
+]
+# Kernel power management messages, as (pattern, event); a captured number is a duration in seconds
+KERNEL_PM_EVENTS = [
+    (r"PM: suspend entry \((\w+)\)", "suspend_entry"),
+    (r"PM: suspend exit", "suspend_exit"),
+    (r"PM: (?:hibernation: )?hibernation entry", "hibernate_entry"),
+    (r"PM: (?:hibernation: )?hibernation exit", "hibernate_exit"),
+    (r"Freezing .*\(elapsed ([\d.]+) seconds\)", "freeze"),
+    (r"PM: (?:hibernation: )?Wrote \d+ kbytes in ([\d.]+) seconds", "image_write"),
+    (r"PM: (?:hibernation: )?Read \d+ kbytes in ([\d.]+) seconds", "image_read"),
+]
+# Phases of a sleep cycle in display order
+SLEEP_PHASES = ["entry", "freeze", "suspend", "hibernate", "image_write", "image_read", "resume", "total"]
+SLEEP_TIMINGS_LOCK = threading.Lock()
+
+
+def journal_field(entry, key):
+    """Return a journal JSON field as a string, whatever form journalctl used for it."""
+    value = entry.get(key)
+    if isinstance(value, list):
+        # Binary fields are arrays of bytes, repeated fields are arrays of values
+        if value and isinstance(value[0], int):
+            return bytes(value).decode("utf-8", "replace")
+        value = value[0] if value else None
+    return value
+
+
+def read_journal_export(f):
+    """Yield entries from a binary stream in the journal export format (``journalctl -o export``)."""
+    entry = {}
+    for line in iter(f.readline, b""):
+        if line == b"\n":
+            if entry:
+                yield entry
+            entry = {}
+            continue
+        line = line.rstrip(b"\n")
+        if b"=" in line:
+            key, _, value = line.partition(b"=")
+        else:
+            # Fields that are not plain text are followed by their size and raw data
+            key = line
+            value = f.read(struct.unpack("<Q", f.read(8))[0])
+            f.read(1)
+        entry[key.decode()] = value.decode("utf-8", "replace")
+    if entry:
+        yield entry
+
+
+def read_journal_file(path):
+    """Yield entries from a recorded journal in either the JSON or the export format."""
+    with open(path, "rb") as f:
+        if f.peek(1)[:1] == b"{":
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from read_journal_export(f)
+
+
+def classify_journal_entry(entry):
+    """Return ``(event, value)`` for a sleep related journal entry, or None."""
+    message = journal_field(entry, "MESSAGE") or ""
+    message_id = journal_field(entry, "MESSAGE_ID")
+    if journal_field(entry, "_TRANSPORT") == "kernel":
+        for pattern, event in KERNEL_PM_EVENTS:
+            match = re.search(pattern, message)
+            if match:
+                return event, match.group(1) if match.groups() else None
+        return None
+    if message_id == SLEEP_START_MESSAGE_ID or message.startswith(("Entering sleep state", "Performing sleep operation")):
+        mode = journal_field(entry, "SLEEP") or (re.findall(r"'([\w-]+)'", message) or [None])[0]
+        return "sleep_start", mode
+    if message_id == SLEEP_STOP_MESSAGE_ID or message.startswith("System returned from sleep"):
+        return "sleep_stop", None
+    return None
+
+
+class SleepCycleParser:
+    """Turn journal entries into per cycle sleep timings, one entry at a time.
+
+    A cycle runs from systemd-sleep starting a sleep operation to it reporting
+    the system back. Durations within the kernel use the kernel's own
+    timestamps, which do not advance while the machine sleeps. The cursor of
+    the last entry and any cycle still in progress are kept in ``state()`` so
+    that parsing can resume where it stopped.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.cursor = state.get("cursor")
+        self.cycles = state.get("cycles", [])
+        self.current = state.get("current")
+
+    def state(self):
+        return {"cursor": self.cursor, "cycles": self.cycles[-SLEEP_HISTORY_LENGTH:], "current": self.current}
+
+    def feed(self, entry):
+        """Parse one entry, returning the cycle it completes or None."""
+        self.cursor = journal_field(entry, "__CURSOR") or self.cursor
+        event = classify_journal_entry(entry)
+        if event is None:
+            return None
+        name, value = event
+        boot = journal_field(entry, "_BOOT_ID")
+        monotonic = int(journal_field(entry, "__MONOTONIC_TIMESTAMP") or 0) / 1e6
+        realtime = int(journal_field(entry, "__REALTIME_TIMESTAMP") or 0) / 1e6
+
+        if name == "sleep_start":
+            # A cycle that never finished (crash, failed resume) is dropped
+            self.current = {
+                "mode": value, "mem_sleep": None, "boot": boot, "start": realtime, "monotonic": monotonic,
+                "marks": {}, "phases": {},
+            }
+            return None
+        cycle = self.current
+        if cycle is None or cycle["boot"] != boot:
+            return None
+        if name == "sleep_stop":
+            self.current = None
+            return self._complete(cycle, realtime, monotonic)
+
+        kernel_time = int(journal_field(entry, "_SOURCE_MONOTONIC_TIMESTAMP") or 0) / 1e6 or monotonic
+        if name == "suspend_entry":
+            cycle["mem_sleep"] = value
+        if name.endswith(("_entry", "_exit")):
+            cycle["marks"][name] = kernel_time
+        else:
+            cycle["phases"][name] = cycle["phases"].get(name, 0.0) + float(value)
+        return None
+
+    def _complete(self, cycle, realtime, monotonic):
+        marks, phases = cycle["marks"], cycle["phases"]
+        for kind in ("suspend", "hibernate"):
+            if f"{kind}_entry" in marks and f"{kind}_exit" in marks:
+                phases[kind] = marks[f"{kind}_exit"] - marks[f"{kind}_entry"]
+        entries = [marks[name] for name in ("suspend_entry", "hibernate_entry") if name in marks]
+        exits = [marks[name] for name in ("suspend_exit", "hibernate_exit") if name in marks]
+        # Userspace time on either side of the kernel, both sides on the monotonic clock
+        if entries and min(entries) >= cycle["monotonic"]:
+            phases["entry"] = min(entries) - cycle["monotonic"]
+        if exits and monotonic >= max(exits):
+            phases["resume"] = monotonic - max(exits)
+        phases["total"] = realtime - cycle["start"]
+        completed = {"mode": cycle["mode"], "mem_sleep": cycle["mem_sleep"], "start": cycle["start"], "phases": phases}
+        self.cycles.append(completed)
+        return completed
+
+
+def journal_command(cursor=None, root="/"):
+    command = ["journalctl", "-o", "json", "--no-pager", f"--output-fields={','.join(SLEEP_JOURNAL_FIELDS)}"]
+    if root != "/":
+        command.append(f"--root={root}")
+    if cursor:
+        command.append(f"--after-cursor={cursor}")
+    # systemd-sleep messages or kernel messages, then only lines about sleeping
+    command += [
+        "SYSLOG_IDENTIFIER=systemd-sleep", "+", "_TRANSPORT=kernel",
+        "--grep=PM: |Freezing |sleep state|sleep operation|returned from sleep",
+    ]
+    return command
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile, so that small samples report values that were actually measured."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def summarize_sleep_cycles(cycles):
+    """Return ``{mode: {"count": n, "phases": {phase: {"p50", "p90", "p99", "max"}}}}``."""
+    summary = {}
+    for cycle in cycles:
+        mode = cycle["mode"] if not cycle.get("mem_sleep") else f"{cycle['mode']} ({cycle['mem_sleep']})"
+        summary.setdefault(mode, {"count": 0, "samples": {}})
+        summary[mode]["count"] += 1
+        for phase, seconds in cycle["phases"].items():
+            summary[mode]["samples"].setdefault(phase, []).append(seconds)
+    for mode in summary.values():
+        samples = mode.pop("samples")
+        mode["phases"] = {
+            phase: {
+                "p50": percentile(samples[phase], 0.5),
+                "p90": percentile(samples[phase], 0.9),
+                "p99": percentile(samples[phase], 0.99),
+                "max": max(samples[phase]),
+            }
+            for phase in SLEEP_PHASES if phase in samples
+        }
+    return summary
+
+
+def probe_sleep_timings(root="/", journal_file=None):
+    """Sleep cycle timings from the journal, or from a recorded ``journal_file``.
+
+    Only the live journal of this system keeps a cursor, so later probes read
+    just the entries added since.
+    """
+    if journal_file is not None:
+        parser = SleepCycleParser()
+        for entry in read_journal_file(journal_file):
+            parser.feed(entry)
+        return {"cycles": len(parser.cycles), "last": parser.cycles[-1:], "summary": summarize_sleep_cycles(parser.cycles)}
+
+    path = os.path.join(state_dir(), "sleep-timings.json") if root == "/" else None
+    with SLEEP_TIMINGS_LOCK:
+        try:
+            with open(path, "r") as f:
+                parser = SleepCycleParser(json.load(f))
+        except (TypeError, OSError, ValueError):
+            parser = SleepCycleParser()
+        read_from = parser.cursor
+
+        # Entries are parsed as journalctl streams them, nothing holds the whole output
+        process = subprocess.Popen(
+            journal_command(parser.cursor, root), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+        )
+        for line in process.stdout:
+            parser.feed(json.loads(line))
+        # journalctl exits with 1 when --grep matched nothing new
+        if process.wait() not in (0, 1):
+            raise RuntimeError(f"journalctl failed: {process.stderr.read().strip()}")
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(parser.state(), f)
+    cycles = parser.cycles[-SLEEP_HISTORY_LENGTH:]
+    return {
+        "cycles": len(cycles),
+        "incremental": read_from is not None,
+        "last": cycles[-1:],
+        "summary": summarize_sleep_cycles(cycles),
+    }
+
+
+def format_sleep_timings(result):
+    if not result["cycles"]:
+        return "No suspend or hibernate cycles found in the journal."
+
+    def seconds(value):
+        return f"{value * 1000:.0f} ms" if value < 10 else f"{value:.1f} s"
+
+    lines = []
+    for cycle in result["last"]:
+        phases = ", ".join(f"{phase} {seconds(cycle['phases'][phase])}" for phase in SLEEP_PHASES if phase in cycle["phases"])
+        lines.append(f"Last {cycle['mode']}: {phases}")
+    for mode, summary in result["summary"].items():
+        lines.append(f"{mode}, {summary['count']} cycles (p50 / p90 / p99):")
+        for phase, stats in summary["phases"].items():
+            lines.append(f"  {phase}: {seconds(stats['p50'])} / {seconds(stats['p90'])} / {seconds(stats['p99'])}")
+    return "\n".join(lines)
+
+
+def probe_audit_denials(root="/"):
+    """Hibernation related SELinux denials, scanned now when running as root, else from the last scan."""
+    if root == "/" and os.geteuid() == 0:
+        scan_audit_logs()
+    try:
+        with open(rooted(root, AUDIT_SCAN_PATH), "r") as f:
+            summary = json.load(f)
+    except FileNotFoundError:
+        return {"scanned": None, "denials": []}
+    return {"scanned": summary["scanned"], "denials": summary["denials"]}
+
+
+def format_audit_denials(result, limit=5):
+    if result["scanned"] is None:
+        return "Not scanned yet, checking the audit log needs administrator rights."
+    denials = result["denials"]
+    if not denials:
+        return "None found."
+    lines = []
+    for denial in reversed(denials[-limit:]):
+        mode = " (permissive)" if denial["permissive"] else ""
+        lines.append(
+            f"{denial['count']}x {denial['comm']} denied {' '.join(denial['permissions'])} on "
+            f"{denial['tclass']} {denial['name'] or denial['path']} ({denial['tcontext']}){mode}\n"
+            f"  Fix: {denial['fix']}"
+        )
+    if len(denials) > limit:
+        lines.append(f"and {len(denials) - limit} more")
+    return "\n".join(lines)
+
+
+# Probes run by collect_status, each returning a dict
+STATUS_PROBES = {
+    "dependencies": probe_dependencies,
+    "extension": probe_extension,
+    "hibernate_delay": probe_config("sleep.conf", "Sleep", "HibernateDelaySec"),
+    "lid_action": probe_config("logind.conf", "Login", "HandleLidSwitch"),
+    "sleep_timings": probe_sleep_timings,
+    "selinux": probe_audit_denials,
+}
+
+
+@TRACER.traced(category="check")
+def collect_status(probes=STATUS_PROBES, timeout=STATUS_PROBE_TIMEOUT, root="/"):
+    """Run all status probes in parallel.
+
+    Returns ``{"probes": {name: probe}, "elapsed": seconds}`` where each probe
+    has ``ok``, its ``result`` or ``error``, and its ``latency`` in seconds.
+    Probes still running after ``timeout`` are reported as timed out.
+    """
+    def timed(name, probe):
+        start = time.perf_counter()
+        try:
+            with TRACER.span(name, "probe"):
+                result = probe(root=root)
+            return {"ok": True, "result": result, "latency": time.perf_counter() - start}
+        except Exception as e:
+            return {"ok": False, "error": f"{type(e).__name__}: {e}", "latency": time.perf_counter() - start}
+
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=len(probes), thread_name_prefix="status-probe")
+    futures = {name: executor.submit(TRACER.wrap(timed), name, probe) for name, probe in probes.items()}
+    wait(futures.values(), timeout=timeout)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    report = {}
+    for name, future in futures.items():
+        if future.done():
+            report[name] = future.result()
+        else:
+            report[name] = {"ok": False, "error": f"Timed out after {timeout}s", "latency": timeout}
+    return {"probes": report, "elapsed": time.perf_counter() - start}
+
+
+def status_config_value(default):
+    def render(result):
+        if result["value"] is None:
+            return default
+        return f"{result['value']} (from {result['source']})"
+    return render
+
+
+# Fields of the status view in display order, as (probe, title, render)
+STATUS_FIELDS = [
+    ("dependencies", "Dependencies", lambda result: (
+        "All required packages are installed." if not result["missing"]
+        else f"Missing packages: {', '.join(result['missing'])}"
+    )),
+    ("extension", "GNOME Extension", format_extension_status),
+    ("hibernate_delay", "Suspend-then-Hibernate Time", status_config_value("Not Set")),
+    ("lid_action", "Lid Close Action", status_config_value("Unknown")),
+    ("sleep_timings", "Sleep Timings", format_sleep_timings),
+    ("selinux", "SELinux Denials", format_audit_denials),
+]
+
+
+def render_status_field(name, probe):
+    if not probe["ok"]:
+        return f"Unavailable ({probe['error']})"
+    render = next(render for field, title, render in STATUS_FIELDS if field == name)
+    return render(probe["result"])
+
+
+def format_status(status):
+    probes = status["probes"]
+    lines = []
+    for name, title, render in STATUS_FIELDS:
+        if name in probes:
+            text = render_status_field(name, probes[name])
+            lines.append(f"\n{title}:\n{text}" if "\n" in text else f"{title}: {text}")
+    timings = ", ".join(f"{name} {probe['latency'] * 1000:.0f} ms" for name, probe in probes.items())
+    lines.append(f"\nChecked in {status['elapsed'] * 1000:.0f} ms ({timings})")
+    return "\n".join(lines)
+
+
+def status_watches(root="/"):
+    """Return ``{directory: {entry: probe}}``, the probe a change to each entry of a directory affects.
+
+    The entry None stands for every entry. A watched entry that is itself a
+    directory of this map is watched as well once it is created.
+    """
+    watches = {}
+    for directory in SYSTEMD_CONFIG_DIRS:
+        for name, probe in (("sleep.conf", "hibernate_delay"), ("logind.conf", "lid_action")):
+            watches.setdefault(rooted(root, directory), {}).update({name: probe, f"{name}.d": probe})
+            watches[rooted(root, directory, f"{name}.d")] = {None: probe}
+    extensions_dir = os.path.expanduser(EXTENSIONS_DIR)
+    watches[os.path.dirname(extensions_dir)] = {os.path.basename(extensions_dir): "extension"}
+    watches[extensions_dir] = {EXTENSION_UUID: "extension"}
+    for path in RPMDB_PATHS:
+        watches[rooted(root, path)] = {None: "dependencies"}
+    # The root helper rewrites the scan summary after every audit log scan
+    watches[os.path.dirname(rooted(root, AUDIT_SCAN_PATH))] = {os.path.basename(AUDIT_SCAN_PATH): "selinux"}
+    return watches
+
+
+# Set to the spawn time to make the window print its startup timings and quit after the first frame
+STARTUP_PROBE_ENV = "SUSPEND_THEN_HIBERNATE_STARTUP_PROBE"
+STARTUP_PROBE_MARKER = "startup-probe:"
+
+
+def start_virtual_display():
+    """Start Xvfb on a free display, returning ``(process, display)``."""
+    read_fd, write_fd = os.pipe()
+    process = subprocess.Popen(
+        ["Xvfb", "-displayfd", str(write_fd), "-nolisten", "tcp"],
+        pass_fds=(write_fd,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        display = f.readline().strip()
+    if not display:
+        process.kill()
+        raise RuntimeError("Xvfb did not report a display")
+    return process, f":{display}"
+
+
+def benchmark_startup(rounds=5):
+    """Time imports, CSS loading and time-to-first-frame of the window.
+
+    Uses the current display, or a private Xvfb when there is none. The
+    medians are appended to startup-benchmark.json in the state directory so
+    that runs can be compared for regressions.
+    """
+    import statistics
+
+    env = dict(os.environ)
+    xvfb = None
+    if not env.get("DISPLAY") and not env.get("WAYLAND_DISPLAY"):
+        try:
+            xvfb, env["DISPLAY"] = start_virtual_display()
+        except (OSError, RuntimeError) as e:
+            log.warning(f"No display available and Xvfb could not be started: {e}")
+            return None
+        log.info(f"Started Xvfb on {env['DISPLAY']}")
+
+    samples = []
+    try:
+        for _ in range(rounds):
+            env[STARTUP_PROBE_ENV] = repr(time.time())
+            result = subprocess.run(
+                [sys.executable, os.path.abspath(__file__)], env=env,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, timeout=60,
+            )
+            for line in result.stdout.splitlines():
+                if line.startswith(STARTUP_PROBE_MARKER):
+                    samples.append({
+                        key: float(value)
+                        for key, value in (field.split("=") for field in line.split()[1:])
+                    })
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+
+    if not samples:
+        log.warning("The window did not report its startup timings.")
+        return None
+    results = {key: statistics.median(sample[key] for sample in samples) for key in samples[0]}
+    print(f"Startup over {len(samples)} runs (median):")
+    for name, seconds in results.items():
+        print(f"  {name:<12} {seconds * 1000:8.1f} ms")
+
+    path = os.path.join(state_dir(), "startup-benchmark.json")
+    try:
+        with open(path, "r") as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        history = []
+    if history:
+        previous = history[-1]["results"]["first_frame"]
+        print(f"  first frame was {previous * 1000:.1f} ms in the previous run")
+    history.append({"time": time.time(), "results": results})
+    with open(path, "w") as f:
+        json.dump(history, f, indent=2)
+    return results
+
+
+class DirectHelper:
+    """Runs privileged operations in this process, for callers that are already root."""
+
+    def call(self, op, queue=None, **args):
+        # Every caller's thread runs its own operation, so queues need no handling
+        session = OperationSession(lambda stream, line: log.info(line))
+        return PRIVILEGED_OPERATIONS[op](args, session)
+
+    def close(self):
+        pass
+
+
+def privileged_session():
+    return DirectHelper() if os.geteuid() == 0 else PrivilegedHelper()
+
+
+# Profile keys that are systemd settings, with the file and section they belong to
+PROFILE_CONFIG_KEYS = {
+    "HibernateDelaySec": ("sleep.conf", "Sleep"),
+    "HandleLidSwitch": ("logind.conf", "Login"),
+}
+LID_SWITCH_ACTIONS = [
+    "ignore", "poweroff", "reboot", "halt", "kexec", "suspend", "hibernate",
+    "hybrid-sleep", "suspend-then-hibernate", "lock",
+]
+EXTENSION_STATES = ["installed", "absent"]
+
+
+def load_profile(path):
+    """Read a JSON or TOML profile and check its keys, raising ValueError if it is invalid."""
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+
+        except ImportError:
+            try:
+                import tomli as tomllib
+
+            except ImportError:
+                raise ValueError("TOML profiles need Python 3.11 or python3-tomli") from None
+
+        with open(path, "rb") as f:
+            profile = tomllib.load(f)
+    else:
+        with open(path, "r") as f:
+            profile = json.load(f)
+
+    if not isinstance(profile, dict):
+        raise ValueError("A profile must be an object of settings")
+    unknown = set(profile) - set(PROFILE_CONFIG_KEYS) - {"packages", "extension"}
+    if unknown:
+        raise ValueError(f"Unknown profile keys: {', '.join(sorted(unknown))}")
+    if "HibernateDelaySec" in profile and not str(profile["HibernateDelaySec"]).isdigit():
+        raise ValueError("HibernateDelaySec must be a number of seconds")
+    if "HandleLidSwitch" in profile and profile["HandleLidSwitch"] not in LID_SWITCH_ACTIONS:
+        raise ValueError(f"HandleLidSwitch must be one of {', '.join(LID_SWITCH_ACTIONS)}")
+    if "extension" in profile and profile["extension"] not in EXTENSION_STATES:
+        raise ValueError(f"extension must be one of {', '.join(EXTENSION_STATES)}")
+    if not isinstance(profile.get("packages", True), (bool, list)):
+        raise ValueError("packages must be true, false or a list of package names")
+    return profile
+
+
+def plan_profile(profile, root="/", dnf_options=None):
+    """Return the steps needed to apply ``profile`` to ``root``, leaving out what is already in place.
+
+    Privileged steps carry the helper ``op`` and ``args`` to send, extension
+    steps an ``extension`` action, also sent to the helper when the extension
+    is installed system wide. Packages are
+    planned as one transaction, installed with the dnf ``cacheonly`` and
+    ``local_repo`` options in ``dnf_options``.
+    """
+    steps = []
+    # Helper operations work on the running system unless told otherwise
+    sysroot = {"root": root} if root != "/" else {}
+
+    packages = profile.get("packages")
+    if packages:
+        plan = plan_packages(STEP_PACKAGES if packages is True else {"profile": packages}, root)
+        if plan["packages"]:
+            steps.append({
+                "description": f"Install packages: {' '.join(plan['packages'])}",
+                "op": "install_packages",
+                "args": dict(sysroot, packages=plan["packages"], **(dnf_options or {})),
+                "plan": plan,
+            })
+
+    for key, (name, section) in PROFILE_CONFIG_KEYS.items():
+        if key not in profile:
+            continue
+        update = SystemdConfig(name, section, root).plan_update({key: profile[key]})
+        if update is None:
+            continue
+        step = {
+            "description": f"Set {key}={profile[key]} in {update['path']}",
+            "op": "write_file",
+            "args": dict(sysroot, path=update["path"], content=update["content"]),
+        }
+        if update["overridden"]:
+            step["warning"] = f"{key} is still overridden by {update['overridden'][key]}"
+        steps.append(step)
+
+    extension = profile.get("extension")
+    if extension:
+        installed = probe_extension(root)["installed"]
+        step = None
+        if extension == "installed" and not installed:
+            step = {"description": "Install the hibernate status extension", "extension": "install"}
+        elif extension == "absent" and installed:
+            step = {"description": "Uninstall the hibernate status extension", "extension": "uninstall"}
+        if step is not None and extension_system_wide(root):
+            # System wide installs belong to root, the helper does them
+            step.update(op=f"{step['extension']}_extension", args=dict(sysroot))
+        if step is not None:
+            steps.append(step)
+    return steps
+
+
+def apply_profile(steps, session=None, root="/"):
+    """Apply planned steps, sending all privileged ones to the helper as one batch.
+
+    The result of each privileged step is stored in its ``result``. A
+    ``session`` passed in is left open for the caller to reuse. Batches for
+    different roots run concurrently in the helper.
+    """
+    for step in steps:
+        if step.get("extension") == "install":
+            # Parallel sysroots share the cached archive, downloaded as the calling user
+            with EXTENSION_FETCH_LOCK:
+                archive, status = fetch_extension_archive()
+            if "op" in step:
+                step["args"]["archive"] = archive
+            else:
+                install_extension_archive(archive)
+
+    privileged = [step for step in steps if "op" in step]
+    if privileged:
+        own_session = session is None
+        session = session or privileged_session()
+        try:
+            results = session.call(
+                "batch", queue=root, requests=[{"op": step["op"], "args": step["args"]} for step in privileged],
+            )
+        finally:
+            if own_session:
+                session.close()
+        for step, result in zip(privileged, results):
+            step["result"] = result
+
+    for step in steps:
+        if step.get("extension") == "uninstall" and "op" not in step:
+            uninstall_hibernate_extensions()
+
+
+def prepare_sysroots(profile, roots, jobs=None, dry_run=False, dnf_options=None):
+    """Apply ``profile`` to several sysroots at once, returning a report per sysroot.
+
+    Every sysroot is planned and applied by its own worker. Privileged steps
+    share one helper, so authorization is asked for only once, which runs the
+    batch of each sysroot in its own queue.
+    """
+    session = None if dry_run else privileged_session()
+
+    def prepare(root):
+        start = time.perf_counter()
+        report = {"root": root, "ok": False, "steps": []}
+        try:
+            if not os.path.isdir(root):
+                raise FileNotFoundError(f"{root} is not a directory")
+            report["steps"] = plan_profile(profile, root, dnf_options)
+            if not dry_run:
+                apply_profile(report["steps"], session, root)
+            report["ok"] = True
+        except Exception as e:
+            report["error"] = f"{type(e).__name__}: {e}"
+            log.warning(f"Preparing {root} failed: {report['error']}")
+        report["seconds"] = time.perf_counter() - start
+        return report
+
+    jobs = jobs or min(len(roots), os.cpu_count() or 1)
+    try:
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="sysroot") as executor:
+            return list(executor.map(TRACER.wrap(prepare), roots))
+    finally:
+        if session is not None:
+            session.close()
+
+
+def format_sysroot_report(reports, elapsed):
+    lines = []
+    for report in reports:
+        if not report["ok"]:
+            status = f"failed: {report['error']}"
+        elif report["steps"]:
+            status = f"{len(report['steps'])} changes"
+        else:
+            status = "already configured"
+        lines.append(f"{report['root']}: {status} ({report['seconds']:.1f}s)")
+        lines += [f"  {step['description']}" for step in report["steps"]]
+        lines += [f"  {format_transaction(step['plan'], step['result'])}" for step in report["steps"] if "result" in step and "plan" in step]
+    failed = sum(not report["ok"] for report in reports)
+    busy = sum(report["seconds"] for report in reports)
+    lines.append(f"{len(reports) - failed} of {len(reports)} sysroots prepared in {elapsed:.1f}s ({busy:.1f}s of work)")
+    return "\n".join(lines)
+
+
+def run_cli(args):
+    # Progress messages go to stderr so that stdout stays machine readable
+    sys.stdout, output = sys.stderr, sys.stdout
+
+    def report(data, text):
+        output.write((json.dumps(data, indent=2) if args.json else text) + "\n")
+
+    if args.status:
+        probes = STATUS_PROBES
+        if args.journal:
+            probes = dict(STATUS_PROBES, sleep_timings=lambda root: probe_sleep_timings(root, journal_file=args.journal))
+        if not args.root:
+            status = collect_status(probes)
+            report(status, format_status(status))
+            return 0 if all(probe["ok"] for probe in status["probes"].values()) else 1
+        statuses = {root: collect_status(probes, root=root) for root in args.root}
+        report(statuses, "\n\n".join(f"{root}:\n{format_status(status)}" for root, status in statuses.items()))
+        return 0 if all(p["ok"] for status in statuses.values() for p in status["probes"].values()) else 1
+
+    if args.wakeups:
+        # A fake sysfs and procfs tree can be checked with --root
+        for root in args.root or ["/"]:
+            snapshot = wakeup_snapshot(
+                rooted(root, "/sys"), rooted(root, "/proc"), persisted_wakeups(rooted(root, WAKEUP_TMPFILES)),
+            )
+            last = last_wakeup(root)
+            report(dict(snapshot, last=last), (f"{root}:\n" if args.root else "") + format_wakeup_audit(snapshot, last))
+        return 0
+
+    try:
+        profile = load_profile(args.apply)
+    except (OSError, ValueError) as e:
+        report({"ok": False, "error": str(e)}, f"Invalid profile {args.apply}: {e}")
+        return 2
+
+    dnf_options = {"cacheonly": args.cacheonly, "local_repo": args.local_repo and os.path.abspath(args.local_repo)}
+    if args.root:
+        start = time.perf_counter()
+        reports = prepare_sysroots(profile, args.root, args.jobs, args.dry_run, dnf_options)
+        elapsed = time.perf_counter() - start
+        report({"ok": all(r["ok"] for r in reports), "dry_run": args.dry_run, "elapsed": elapsed, "sysroots": reports},
+               format_sysroot_report(reports, elapsed))
+        return 0 if all(r["ok"] for r in reports) else 1
+
+    try:
+        steps = plan_profile(profile, dnf_options=dnf_options)
+    except (OSError, subprocess.SubprocessError) as e:
+        report({"ok": False, "error": str(e)}, f"Could not inspect the system: {e}")
+        return 1
+    lines = [("Would: " if args.dry_run else "") + step["description"] for step in steps]
+    lines += [f"Warning: {step['warning']}" for step in steps if "warning" in step]
+    if not steps:
+        lines = ["Nothing to do, the system already matches the profile."]
+    if args.dry_run:
+        report({"ok": True, "dry_run": True, "steps": steps}, "\n".join(lines))
+        return 0
+
+    try:
+        apply_profile(steps)
+    except Exception as e:
+        report({"ok": False, "steps": steps, "error": str(e)}, "\n".join(lines + [f"Failed: {e}"]))
+        return 1
+    lines += [format_transaction(step["plan"], step["result"]) for step in steps if "result" in step and "plan" in step]
+    report({"ok": True, "dry_run": False, "steps": steps}, "\n".join(lines))
+    return 0
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        description="Configure suspend-then-hibernate. Without options the settings window opens.",
+    )
+    parser.add_argument("--apply", metavar="PROFILE", help="apply a JSON or TOML profile without opening the window")
+    parser.add_argument("--dry-run", action="store_true", help="with --apply, only show what would change")
+    parser.add_argument("--status", action="store_true", help="print the hibernation status and exit")
+    parser.add_argument("--json", action="store_true", help="print --apply and --status results as JSON")
+    parser.add_argument(
+        "--root", metavar="DIR", action="append",
+        help="apply to or check a mounted sysroot instead of this system, can be given several times",
+    )
+    parser.add_argument("--jobs", type=int, metavar="N", help="sysroots prepared at the same time (default: one per CPU)")
+    parser.add_argument("--cacheonly", action="store_true", help="with --apply, install packages from the dnf cache only")
+    parser.add_argument(
+        "--local-repo", metavar="DIR", help="with --apply, install packages only from this local repository directory",
+    )
+    parser.add_argument("--journal", metavar="FILE", help="with --status, read sleep timings from a recorded journal")
+    parser.add_argument("--benchmark-packages", action="store_true", help="time batched and cached rpm lookups")
+    parser.add_argument("--benchmark-config", action="store_true", help="time the systemd config parser")
+    parser.add_argument("--benchmark-startup", action="store_true", help="time startup up to the first frame")
+    parser.add_argument("--benchmark-hibernate", action="store_true", help="benchmark hibernation image compressors and size")
+    parser.add_argument("--benchmark-swapfile", action="store_true", help="time swap file creation on loop images (root)")
+    parser.add_argument("--adaptive-delay", action="store_true", help="print the HibernateDelaySec measured drain allows")
+    parser.add_argument("--wakeups", action="store_true", help="print the suspend mode and the wakeup sources")
+    parser.add_argument("--reserve", type=int, default=20, metavar="PERCENT", help="battery kept by --adaptive-delay")
+    parser.add_argument("--record-battery", nargs="+", metavar=("PHASE", "ACTION"), help=argparse.SUPPRESS)
+    parser.add_argument("--trace", metavar="FILE", help="write a Chrome trace (chrome://tracing) of the run to FILE")
+    parser.add_argument(
+        "--log-level", choices=["debug", "info", "warning", "error"], default="info",
+        help="diagnostics printed to stderr (default: info, debug adds the duration of every span)",
+    )
+    parser.add_argument("--helper", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.dry_run and not args.apply:
+        parser.error("--dry-run needs --apply")
+    if args.journal and not args.status:
+        parser.error("--journal needs --status")
+    if args.root and not (args.apply or args.status or args.wakeups):
+        parser.error("--root needs --apply, --status or --wakeups")
+    if args.root:
+        # The helper runs from another working directory
+        args.root = [os.path.abspath(root) for root in args.root]
+    return args
+
+
+def run_headless(args):
+    """Run the mode selected on the command line, returning its exit code or None for the window."""
+    configure_logging(args.log_level)
+    if args.trace:
+        TRACER.enable(args.trace)
+    if args.helper:
+        return run_helper()
+    if args.record_battery:
+        # Called by the system-sleep hook, which must never hold up suspend
+        phase, action = (args.record_battery + [None])[:2]
+        try:
+            record_battery(phase, action)
+        except Exception as e:
+            log.warning(f"Could not record the battery level: {e}")
+        try:
+            record_wakeups(phase, action)
+        except Exception as e:
+            log.warning(f"Could not record the wakeup counts: {e}")
+        return 0
+    if args.adaptive_delay:
+        recommendation = adaptive_hibernate_delay(BatteryLog().records(), reserve=args.reserve / 100)
+        print(format_adaptive_delay(recommendation))
+        return 0 if recommendation else 1
+    if args.benchmark_packages:
+        benchmark_package_lookup()
+        return 0
+    if args.benchmark_config:
+        benchmark_config_parser()
+        return 0
+    if args.benchmark_startup:
+        return 0 if benchmark_startup() else 1
+    if args.benchmark_hibernate:
+        benchmark_hibernation()
+        return 0
+    if args.benchmark_swapfile:
+        return 0 if benchmark_swapfile() else 1
+    if args.apply or args.status or args.wakeups:
+        return run_cli(args)
+    return None
+
+
+if __name__ == "__main__":
+    # Headless modes run without a display (the helper as root), so they must not load Gtk
+    exit_code = run_headless(parse_arguments(sys.argv[1:]))
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+import gi  # noqa: E402
 gi.require_version("Gtk", "3.0")
-from gi.repository import Gtk, Gdk, GLib
-import subprocess
-import os
-import urllib.request
-import shutil
-import threading
-import tempfile
-import time
-import json
+from gi.repository import Gtk, Gdk, Gio, GLib  # noqa: E402
+
+# Milliseconds to wait for a burst of file changes to settle before probing
+STATUS_DEBOUNCE_MS = 200
+
+
+class StatusPanel(Gtk.Frame):
+    """The hibernation status, kept current by file monitors.
+
+    Every field shows the cached result of its status probe. All probes run
+    when the panel starts; afterwards a probe only runs again when a file it
+    depends on changes, so an idle panel costs nothing.
+    """
+
+    def __init__(self, root="/"):
+        Gtk.Frame.__init__(self, label="Status")
+        self.root = root
+        self.watches = status_watches(root)
+        self.monitors = {}
+        self.results = {}
+        self.labels = {}
+        self._generations = collections.Counter()
+        self._pending = set()
+        self._flush_source = None
+
+        grid = Gtk.Grid(column_spacing=10, row_spacing=5)
+        grid.set_border_width(10)
+        for row, (name, title, render) in enumerate(STATUS_FIELDS):
+            grid.attach(Gtk.Label(label=f"{title}:", xalign=0, yalign=0), 0, row, 1, 1)
+            value = Gtk.Label(label="Checking...", xalign=0, selectable=True)
+            value.set_line_wrap(True)
+            grid.attach(value, 1, row, 1, 1)
+            self.labels[name] = value
+        self.add(grid)
+
+    def start(self):
+        for directory in self.watches:
+            self.watch(directory)
+        self.refresh()
+        return False
+
+    def watch(self, directory):
+        if directory in self.monitors or not os.path.isdir(directory):
+            return
+        monitor = Gio.File.new_for_path(directory).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+        monitor.connect("changed", self.on_file_changed, directory)
+        self.monitors[directory] = monitor
+
+    def on_file_changed(self, monitor, file, other_file, event, directory):
+        if event == Gio.FileMonitorEvent.ATTRIBUTE_CHANGED:
+            return
+        entries = self.watches[directory]
+        for changed in filter(None, [file, other_file]):
+            name = changed.get_basename()
+            probe = entries.get(name, entries.get(None))
+            if probe is None:
+                continue
+            self._pending.add(probe)
+            path = os.path.join(directory, name)
+            if path in self.watches:
+                self.watch(path)
+        if self._pending and self._flush_source is None:
+            self._flush_source = GLib.timeout_add(STATUS_DEBOUNCE_MS, self.flush)
+
+    def flush(self):
+        self._flush_source = None
+        names, self._pending = self._pending, set()
+        log.info(f"Files changed, refreshing {', '.join(sorted(names))}")
+        self.refresh(names)
+        return False
+
+    def refresh(self, names=None):
+        probes = {name: STATUS_PROBES[name] for name in (names or STATUS_PROBES)}
+        # A slow probe must not overwrite the result of a newer one
+        generations = {}
+        for name in probes:
+            self._generations[name] += 1
+            generations[name] = self._generations[name]
+        threading.Thread(target=TRACER.wrap(self.run_probes), args=(probes, generations), daemon=True).start()
+
+    @TRACER.traced(category="task")
+    def run_probes(self, probes, generations):
+        status = collect_status(probes, root=self.root)
+        GLib.idle_add(_call_once, self.update, status["probes"], generations)
+
+    def update(self, probes, generations):
+        for name, probe in probes.items():
+            if generations[name] != self._generations[name]:
+                continue
+            self.results[name] = probe
+            self.labels[name].set_text(render_status_field(name, probe))
+
 
 class SleepConfigApp(Gtk.Window):
     def __init__(self):
-        print("Initializing application...")
+        log.info("Initializing application...")
         Gtk.Window.__init__(self, title="Lid Close and Hibernate Settings")
         self.set_border_width(20)
         self.set_default_size(400, 600)
@@ -21,7 +3691,7 @@ class SleepConfigApp(Gtk.Window):
         self.apply_styles()
 
         # Connect the delete-event signal to close the application properly
-        self.connect("delete-event", Gtk.main_quit)
+        self.connect("delete-event", lambda window, event: self.on_exit_clicked(window))
 
         # Create the main vertical box layout
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=20)
@@ -62,23 +3732,59 @@ class SleepConfigApp(Gtk.Window):
         suspend_time_button.connect("clicked", self.set_suspend_then_hibernate_time)
         vbox.pack_start(suspend_time_button, True, True, 0)
 
-        # 5) (Optional) Set Lid Close Action
-        lid_action_button = self.create_button("5) (Optional) Set Lid Close Action", "system-shutdown")
+        # 5) (Optional) Tune Hibernation Image
+        tuning_button = self.create_button("5) (Optional) Tune Hibernation Image", "media-floppy")
+        tuning_button.connect("clicked", self.tune_hibernation_image)
+        vbox.pack_start(tuning_button, True, True, 0)
+
+        # 6) (Optional) Set Lid Close Action
+        lid_action_button = self.create_button("6) (Optional) Set Lid Close Action", "system-shutdown")
         lid_action_button.connect("clicked", self.set_lid_close_action)
         vbox.pack_start(lid_action_button, True, True, 0)
 
-        # 6) (Optional) Check Hibernation Settings
-        status_button = self.create_button("6) (Optional) Check Hibernation Settings", "dialog-information")
+        # 7) (Optional) Audit Sleep Mode and Wakeups
+        wakeup_button = self.create_button("7) (Optional) Audit Sleep Mode and Wakeups", "preferences-system-power")
+        wakeup_button.connect("clicked", self.audit_wakeups)
+        vbox.pack_start(wakeup_button, True, True, 0)
+
+        # 8) (Optional) Check Hibernation Settings
+        status_button = self.create_button("8) (Optional) Check Hibernation Settings", "dialog-information")
         status_button.connect("clicked", self.check_status)
         vbox.pack_start(status_button, True, True, 0)
 
+        # Live status, probed again whenever the files behind a field change
+        self.status_panel = StatusPanel()
+        self.status_panel.set_margin_start(20)
+        self.status_panel.set_margin_end(20)
+        vbox.pack_start(self.status_panel, False, False, 0)
+
+        # Streamed output of running commands
+        # The text view is only built when the output is first expanded
+        log_expander = Gtk.Expander(label="Command Output")
+        log_expander.connect("notify::expanded", self.on_log_expanded)
+        self.log_buffer = Gtk.TextBuffer()
+        self.log_view = None
+        self.log_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
+        self.cancel_button = Gtk.Button(label="Cancel Running Command")
+        self.cancel_button.set_sensitive(False)
+        self.cancel_button.connect("clicked", self.cancel_jobs)
+        self.log_box.pack_end(self.cancel_button, False, False, 0)
+        log_expander.add(self.log_box)
+        log_expander.set_margin_start(20)
+        log_expander.set_margin_end(20)
+        vbox.pack_start(log_expander, False, False, 0)
+        self.jobs = set()
+        self.helper = PrivilegedHelper(dispatch=GLib.idle_add)
+
         # Exit button
         exit_button = self.create_button("Exit", "application-exit")
         exit_button.connect("clicked", self.on_exit_clicked)
         vbox.pack_start(exit_button, True, True, 0)
 
         self.show_all()
-        print("Application initialized.")
+        # Probe after the first frame so that startup is not held up
+        GLib.idle_add(self.status_panel.start, priority=GLib.PRIORITY_LOW)
+        log.info("Application initialized.")
 
     def create_button(self, label, icon_name):
         button = Gtk.Button()
@@ -128,121 +3834,167 @@ class SleepConfigApp(Gtk.Window):
             box-shadow: 2px 2px 10px rgba(0, 0, 0, 0.2);
         }
         """
+        start = time.perf_counter()
         style_provider = Gtk.CssProvider()
         style_provider.load_from_data(css)
         Gtk.StyleContext.add_provider_for_screen(
             Gdk.Screen.get_default(), style_provider, Gtk.STYLE_PROVIDER_PRIORITY_USER
         )
+        self.css_seconds = time.perf_counter() - start
 
     # 1) Install Dependencies
+    @TRACER.traced(category="ui")
     def install_dependencies(self, button):
-        print("Installing dependencies...")
-        required_packages = ["python3-gobject", "polkit", "gettext"]
-        missing_packages = []
-
-        for package in required_packages:
-            result = subprocess.run(["rpm", "-q", package], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if result.returncode != 0:
-                print(f"Package {package} is missing.")
-                missing_packages.append(package)
-            else:
-                print(f"Package {package} is already installed.")
+        log.info("Installing dependencies...")
+        # Everything the later steps need goes into the same dnf transaction
+        plan = plan_packages()
+        for step, missing in plan["by_step"].items():
+            log.info(f"Packages missing for {step}: {' '.join(missing) or 'none'}")
 
-        if missing_packages:
-            self.show_message_dialog(f"Installing missing packages: {' '.join(missing_packages)}")
-            install_command = ["pkexec", "dnf", "install", "-y"] + missing_packages
-            self.run_command(install_command)
-            self.show_message_dialog("Dependencies installed successfully.")
+        if plan["packages"]:
+            self.show_message_dialog(f"Installing missing packages: {' '.join(plan['packages'])}")
+            self.start_privileged(
+                "install_packages",
+                packages=plan["packages"],
+                on_success=lambda job: self.show_message_dialog(
+                    "Dependencies installed successfully.\n\n" + format_transaction(plan, job.result)
+                ),
+            )
         else:
             self.show_message_dialog("All required packages are already installed.")
-        print("Dependency installation completed.")
+        log.info("Dependency installation completed.")
 
     # 2) Configure Hibernate
+    @TRACER.traced(category="ui")
     def configure_hibernation(self, button):
-        print("Configuring hibernation...")
+        log.info("Configuring hibernation...")
         self.progress_bar.set_fraction(0.0)
-        threading.Thread(target=self.run_configuration_script).start()
+        self.progress_bar.set_show_text(True)
+        self.progress_bar.set_text("Preparing")
+        threading.Thread(target=TRACER.wrap(self.run_configuration_script)).start()
 
+    @TRACER.traced(category="task")
     def run_configuration_script(self):
-        steps = 6  # Number of steps in the configuration process
-        progress_increment = 1.0 / steps
+        plan = plan_packages()
 
-        with tempfile.NamedTemporaryFile(delete=False) as temp_script:
-            temp_script.write(b"#!/bin/bash\n")
-            temp_script.write(b"set -e\n")
+        # Run the script in the privileged helper, its step markers drive the progress bar
+        log.info("Running configuration script in the privileged helper...")
+        step_timer = StepTimer()
+        request = self.start_privileged(
+            "batch",
+            requests=[
+                {"op": "install_packages", "args": {"packages": plan["packages"]}},
+                {"op": "run_script", "args": {"script": build_configuration_script()}},
+                {"op": "provision_swap", "args": {}},
+            ],
+            on_line=lambda job, stream, line: self.on_configuration_output(step_timer, line),
+        )
+        request.wait()
 
-            # Check and install required packages
-            temp_script.write(b"REQUIRED_PACKAGES=\"audit policycoreutils-python-utils libnotify\"\n")
-            temp_script.write(b"for PACKAGE in $REQUIRED_PACKAGES; do\n")
-            temp_script.write(b"    if ! rpm -q $PACKAGE &>/dev/null; then\n")
-            temp_script.write(b"        dnf install -y $PACKAGE\n")
-            temp_script.write(b"    fi\n")
-            temp_script.write(b"done\n")
+        if request.returncode != 0:
+            GLib.idle_add(_call_once, self.progress_bar.set_text, "Failed")
+            return
 
-            # Create /etc/systemd/sleep.conf immediately
-            temp_script.write(b"mkdir -p /etc/systemd/\n")
-            temp_script.write(b"touch /etc/systemd/sleep.conf\n")
+        step_timer.save()
+        log.info(f"Step durations: {step_timer.summary()}")
 
-        temp_script_path = temp_script.name
-        os.chmod(temp_script_path, 0o755)
-        print(f"Temporary script created at {temp_script_path}")
+        # Show completion message
+        GLib.idle_add(
+            self.show_message_dialog,
+            "Hibernate configuration completed. Please reboot for the changes to take effect.\n\n"
+            f"Step durations: {step_timer.summary()}",
+        )
+        log.info("Hibernate configuration completed.")
 
-        # Update progress bar for the initial step
-        self.update_progress_bar(progress_increment)
+    def on_configuration_output(self, step_timer, line):
+        step = step_timer.feed(line)
+        if step is None:
+            return
+        self.progress_bar.set_fraction(step_timer.fraction())
+        self.progress_bar.set_text("Done" if step_timer.fraction() == 1.0 else step_timer.labels[step])
+        log.debug(f"Progress bar updated to {step_timer.fraction() * 100}%")
 
-        # Run the temporary script with pkexec
-        print("Running configuration script with pkexec...")
-        result = self.pkexec_command([temp_script_path])
+    def start_privileged(self, op, on_success=None, on_line=None, **args):
+        # Privileged work goes through the helper so that polkit asks only once per session
+        return self.track_job(self.helper.request(op, **args), on_success, on_line).start()
 
-        # Clean up the temporary file
-        os.remove(temp_script_path)
-        print("Temporary script removed.")
+    def track_job(self, job, on_success, on_line):
+        def handle_line(job, stream, line):
+            self.append_log(job, stream, line)
+            if on_line:
+                on_line(job, stream, line)
 
-        # Update progress bar for each completed step
-        for i in range(1, steps):
-            self.update_progress_bar(progress_increment * (i + 1))
-            time.sleep(0.5)  # Simulate time delay for each step
+        job.on_line = handle_line
+        job.on_done = lambda job: self.on_job_done(job, on_success)
+        self.jobs.add(job)
+        GLib.idle_add(_call_once, self.cancel_button.set_sensitive, True)
+        GLib.idle_add(_call_once, self.append_log, job, "stdout", f"$ {' '.join(job.command)}")
+        return job
 
-        # Show completion message
-        GLib.idle_add(self.show_message_dialog, "Hibernate configuration completed. Please reboot for the changes to take effect.")
-        print("Hibernate configuration completed.")
+    def on_job_done(self, job, on_success):
+        self.jobs.discard(job)
+        self.cancel_button.set_sensitive(bool(self.jobs))
+        if job.cancelled:
+            self.show_message_dialog(f"Command cancelled: {' '.join(job.command)}")
+        elif job.returncode != 0:
+            error_message = job.error_message()
+            log.warning(error_message)
+            self.show_message_dialog(error_message)
+        elif on_success:
+            on_success(job)
 
-    def update_progress_bar(self, fraction):
-        GLib.idle_add(self.progress_bar.set_fraction, fraction)
-        print(f"Progress bar updated to {fraction * 100}%")
+    def cancel_jobs(self, button):
+        for job in list(self.jobs):
+            job.cancel()
 
-    def pkexec_command(self, command):
-        try:
-            print(f"Executing command with pkexec: {' '.join(command)}")
-            return self.run_command(["pkexec"] + command)
-        except subprocess.CalledProcessError:
-            GLib.idle_add(
-                self.show_message_dialog,
-                "An error occurred while executing a command with pkexec. Please check your system logs for details.",
-            )
-            return None
+    def on_log_expanded(self, expander, param):
+        if self.log_view is not None or not expander.get_expanded():
+            return
+        self.log_view = Gtk.TextView(buffer=self.log_buffer, editable=False, cursor_visible=False, monospace=True)
+        self.log_view.set_wrap_mode(Gtk.WrapMode.WORD_CHAR)
+        log_scroller = Gtk.ScrolledWindow()
+        log_scroller.set_size_request(-1, 150)
+        log_scroller.add(self.log_view)
+        self.log_box.pack_start(log_scroller, True, True, 0)
+        self.log_box.show_all()
+        self.scroll_log_to_end()
 
-    def run_command(self, command):
-        try:
-            print(f"Running command: {' '.join(command)}")
-            result = subprocess.run(
-                command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, text=True
-            )
-            print(f"Command output: {result.stdout}")
-            return result.stdout
-        except subprocess.CalledProcessError as e:
-            error_message = (
-                f"An error occurred while executing the command: {' '.join(command)}\n"
-                f"Exit Code: {e.returncode}\n"
-                f"Output: {e.stdout}\n"
-                f"Error Output: {e.stderr}"
+    def append_log(self, job, stream, line):
+        buffer = self.log_buffer
+        buffer.insert(buffer.get_end_iter(), line + "\n")
+        excess = buffer.get_line_count() - JOB_OUTPUT_MAX_LINES
+        if excess > 0:
+            buffer.delete(buffer.get_start_iter(), buffer.get_iter_at_line(excess))
+        self.scroll_log_to_end()
+
+    def scroll_log_to_end(self):
+        self.log_buffer.place_cursor(self.log_buffer.get_end_iter())
+        if self.log_view is not None:
+            self.log_view.scroll_to_mark(self.log_buffer.get_insert(), 0.0, False, 0.0, 1.0)
+
+    @TRACER.traced(category="ui")
+    def apply_config(self, config, values, success_message):
+        update = config.plan_update(values)
+        if update is None:
+            log.info(f"{config.name} already has {values}, nothing to write.")
+            self.show_message_dialog(f"{config.name} already has these settings, nothing was changed.")
+            return
+
+        if update["overridden"]:
+            success_message += "\n\nWarning: these settings are still overridden by a later drop-in:\n" + "\n".join(
+                f"{key} in {path}" for key, path in update["overridden"].items()
             )
-            print(error_message)
-            GLib.idle_add(self.show_message_dialog, error_message)
-            return None
+        log.info(f"Writing {update['changes']} to {update['path']}")
+        self.start_privileged(
+            "write_file",
+            path=update["path"],
+            content=update["content"],
+            on_success=lambda job: self.show_message_dialog(success_message),
+        )
 
+    @TRACER.traced(category="dialog")
     def show_message_dialog(self, message):
-        print(f"Displaying message dialog: {message}")
+        log.debug(f"Displaying message dialog: {message}")
         dialog = Gtk.MessageDialog(
             transient_for=self,
             flags=0,
@@ -254,8 +4006,9 @@ class SleepConfigApp(Gtk.Window):
         dialog.destroy()
 
     # 3) Manage Hibernate Extension
+    @TRACER.traced(category="dialog")
     def manage_gnome_extension(self, button):
-        print("Managing GNOME extension...")
+        log.info("Managing GNOME extension...")
         dialog = Gtk.Dialog(title="GNOME Extension Setup", transient_for=self, flags=0)
         dialog.add_buttons(Gtk.STOCK_OK, Gtk.ResponseType.OK, Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
         dialog.set_default_size(300, 100)
@@ -273,129 +4026,60 @@ class SleepConfigApp(Gtk.Window):
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
             if install_button.get_active():
-                self.download_extension()
-                self.install_extension()
+                threading.Thread(target=TRACER.wrap(self.install_extension)).start()
             elif uninstall_button.get_active():
-                self.uninstall_extension()
+                threading.Thread(target=TRACER.wrap(self.uninstall_extension)).start()
         dialog.destroy()
-        print("GNOME extension management completed.")
-
-    def download_extension(self):
-        EXTENSION_URL = "https://github.com/ctsdownloads/gnome-shell-extension-hibernate-status/archive/refs/heads/master.zip"
-        ZIP_FILE = "gnome-shell-extension-hibernate-status-master.zip"
-
-        if not os.path.isfile(ZIP_FILE):
-            self.show_message_dialog("Downloading extension zip file...")
-            print(f"Downloading extension from {EXTENSION_URL}")
-            urllib.request.urlretrieve(EXTENSION_URL, ZIP_FILE)
-            print("Extension downloaded.")
-        else:
-            self.show_message_dialog("Extension zip file already downloaded.")
-            print("Extension zip file already exists.")
+        log.info("GNOME extension management completed.")
 
+    @TRACER.traced(category="task")
     def install_extension(self):
-        ZIP_FILE = "gnome-shell-extension-hibernate-status-master.zip"
-
-        # Extract the zip file to a temporary directory
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            print(f"Extracting {ZIP_FILE} to {tmpdirname}")
-            subprocess.run(["unzip", "-o", ZIP_FILE, "-d", tmpdirname], check=True)
-
-            # Find the extracted extension directory
-            extracted_dir = os.path.join(tmpdirname, 'gnome-shell-extension-hibernate-status-master')
-            if not os.path.isdir(extracted_dir):
-                self.show_message_dialog("Failed to find the extracted extension directory.")
-                print("Extracted extension directory not found.")
-                return
-
-            # Read the UUID from metadata.json
-            metadata_path = os.path.join(extracted_dir, 'metadata.json')
-            if not os.path.isfile(metadata_path):
-                self.show_message_dialog("Failed to find metadata.json in the extension directory.")
-                print("metadata.json not found in the extracted extension.")
-                return
-
-            with open(metadata_path, "r") as f:
-                metadata = json.load(f)
-                extension_uuid = metadata.get("uuid")
-                if not extension_uuid:
-                    self.show_message_dialog("Failed to get UUID from metadata.json.")
-                    print("UUID not found in metadata.json.")
-                    return
-
-                print(f"Extension UUID: {extension_uuid}")
-
-            # Install the extension manually
-            self.show_message_dialog("Installing the extension...")
-            print("Installing the extension...")
-
-            # Create the extensions directory if it doesn't exist
-            extensions_dir = os.path.expanduser("~/.local/share/gnome-shell/extensions")
-            os.makedirs(extensions_dir, exist_ok=True)
-
-            # Copy the extension to the extensions directory
-            target_dir = os.path.join(extensions_dir, extension_uuid)
-            if os.path.exists(target_dir):
-                shutil.rmtree(target_dir)
-                print(f"Existing extension directory {target_dir} removed.")
-            shutil.copytree(extracted_dir, target_dir)
-            print(f"Extension copied to {target_dir}")
-
-            # Compile schemas if the extension has any
-            schemas_dir = os.path.join(target_dir, 'schemas')
-            if os.path.exists(schemas_dir):
-                print("Compiling schemas...")
-                subprocess.run(['glib-compile-schemas', schemas_dir], check=True)
-                print("Schemas compiled.")
-            else:
-                print("No schemas directory found; skipping schema compilation.")
-
-            # Reload GNOME Shell extensions
-            print("Reloading GNOME Shell extensions...")
-            subprocess.run(["dbus-send", "--session", "--dest=org.gnome.Shell", "--type=method_call",
-                            "/org/gnome/Shell", "org.gnome.Shell.Eval", "string:'Main.extensionManager.reloadExtensions()'"],
-                           check=True)
-            print("GNOME Shell extensions reloaded.")
+        # Runs on a worker thread, the download can take a while
+        try:
+            archive, status = fetch_extension_archive()
+            if status == "offline":
+                GLib.idle_add(self.show_message_dialog, "GitHub could not be reached, installing the cached extension.")
+            extension_uuid, enabled = install_extension_archive(archive)
+        except Exception as e:
+            log.warning(f"Extension installation failed: {e}")
+            GLib.idle_add(self.show_message_dialog, f"Extension installation failed: {e}")
+            return
 
-            # Enable the extension
-            try:
-                self.show_message_dialog("Extension installed. Enabling the extension...")
-                print("Enabling the extension...")
-                subprocess.run(["gnome-extensions", "enable", extension_uuid], check=True)
-                self.show_message_dialog(
-                    "Extension installed and enabled. Please reboot your system for the extension to take effect."
-                )
-                print("Extension installation and activation completed.")
-            except subprocess.CalledProcessError as e:
-                print(f"Failed to enable the extension. Reboot is required. Error: {e}")
-                self.show_message_dialog("Extension installed, but a reboot is required to enable it. Please reboot now.")
+        if enabled:
+            GLib.idle_add(
+                self.show_message_dialog,
+                "Extension installed and enabled. Please reboot your system for the extension to take effect.",
+            )
+        else:
+            GLib.idle_add(
+                self.show_message_dialog,
+                "Extension installed, but a reboot is required to enable it. Please reboot now.",
+            )
 
+    @TRACER.traced(category="task")
     def uninstall_extension(self):
-        print("Uninstalling extension...")
-        # List installed extensions to get accurate UUIDs
-        result = subprocess.run(["gnome-extensions", "list"], capture_output=True, text=True)
-        installed_extensions = result.stdout.strip().split('\n')
-        print(f"Installed extensions: {installed_extensions}")
-
-        # Filter extensions that have 'hibernate-status' in their UUID
-        extension_uuids = [uuid for uuid in installed_extensions if 'hibernate-status' in uuid]
+        # Runs on a worker thread like the installation
+        log.info("Uninstalling extension...")
+        try:
+            extension_uuids = uninstall_hibernate_extensions()
+        except Exception as e:
+            log.warning(f"Extension uninstallation failed: {e}")
+            GLib.idle_add(self.show_message_dialog, f"Extension uninstallation failed: {e}")
+            return
 
         if not extension_uuids:
-            self.show_message_dialog("Extension is not installed.")
-            print("Extension is not installed.")
+            log.info("Extension is not installed.")
+            GLib.idle_add(self.show_message_dialog, "Extension is not installed.")
             return
-
-        for extension_uuid in extension_uuids:
-            self.show_message_dialog(f"Uninstalling the extension {extension_uuid}...")
-            print(f"Uninstalling extension {extension_uuid}...")
-            subprocess.run(["gnome-extensions", "uninstall", extension_uuid], check=True)
-            print(f"Extension {extension_uuid} uninstalled.")
-
-        self.show_message_dialog("Extension(s) successfully uninstalled. Please reboot your system to complete the changes.")
+        GLib.idle_add(
+            self.show_message_dialog,
+            "Extension(s) successfully uninstalled. Please reboot your system to complete the changes.",
+        )
 
     # 4) (Optional) Set Suspend-then-Hibernate Time
+    @TRACER.traced(category="dialog")
     def set_suspend_then_hibernate_time(self, button):
-        print("Setting Suspend-then-Hibernate Time...")
+        log.info("Setting Suspend-then-Hibernate Time...")
         dialog = Gtk.Dialog(title="Set Suspend-then-Hibernate Time", transient_for=self, flags=0)
         dialog.add_buttons(Gtk.STOCK_OK, Gtk.ResponseType.OK, Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
         dialog.set_default_size(300, 100)
@@ -407,26 +4091,106 @@ class SleepConfigApp(Gtk.Window):
         entry = Gtk.Entry()
         entry.set_placeholder_text("Time in seconds (e.g., 600 for 10 minutes)")
         content_area.add(entry)
+
+        # Adaptive mode: suggest the delay the measured suspend drain allows
+        try:
+            recommendation = adaptive_hibernate_delay(BatteryLog().records())
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not read the battery log: {e}")
+            recommendation = None
+        adaptive_label = Gtk.Label(label=format_adaptive_delay(recommendation))
+        adaptive_label.set_line_wrap(True)
+        content_area.add(adaptive_label)
+        if recommendation is not None:
+            adaptive_button = Gtk.Button(label="Use Measured Value")
+            adaptive_button.connect("clicked", lambda button: entry.set_text(str(recommendation["delay"])))
+            content_area.add(adaptive_button)
+        record_check = None
+        if not os.path.exists(SLEEP_HOOK_PATH):
+            record_check = Gtk.CheckButton(label="Measure battery drain while suspended")
+            record_check.set_active(True)
+            content_area.add(record_check)
         dialog.show_all()
 
         response = dialog.run()
+        if response == Gtk.ResponseType.OK and record_check is not None and record_check.get_active():
+            self.start_privileged("install_sleep_hook")
         if response == Gtk.ResponseType.OK:
             sth_time = entry.get_text()
             if sth_time.isdigit():
-                # Overwrite existing /etc/systemd/sleep.conf with new time
-                command = f"""
-                    echo '[Sleep]' | sudo tee /etc/systemd/sleep.conf;
-                    echo 'HibernateDelaySec={sth_time}' | sudo tee -a /etc/systemd/sleep.conf;
-                """
-                self.pkexec_command(["bash", "-c", command])
-                self.show_message_dialog("Suspend-then-hibernate time updated successfully.")
+                self.apply_config(
+                    SystemdConfig("sleep.conf", "Sleep"),
+                    {"HibernateDelaySec": sth_time},
+                    "Suspend-then-hibernate time updated successfully.",
+                )
             else:
                 self.show_message_dialog("Invalid input. Please enter a valid number in seconds.")
         dialog.destroy()
 
-    # 5) (Optional) Set Lid Close Action
+    # 5) (Optional) Tune Hibernation Image
+    @TRACER.traced(category="ui")
+    def tune_hibernation_image(self, button):
+        log.info("Benchmarking the hibernation image...")
+        self.progress_bar.set_text("Benchmarking compressors and the swap disk...")
+        self.progress_bar.set_show_text(True)
+        threading.Thread(target=TRACER.wrap(self.run_hibernation_benchmark)).start()
+
+    @TRACER.traced(category="task")
+    def run_hibernation_benchmark(self):
+        try:
+            result = tune_hibernation_image()
+        except Exception as e:
+            GLib.idle_add(self.show_message_dialog, f"The hibernation benchmark failed: {e}")
+            return
+        finally:
+            GLib.idle_add(_call_once, self.progress_bar.set_text, None)
+        GLib.idle_add(_call_once, self.show_tuning_dialog, result)
+
+    @TRACER.traced(category="dialog")
+    def show_tuning_dialog(self, result):
+        if not result["candidates"]:
+            self.show_message_dialog(format_tuning(result))
+            return
+
+        dialog = Gtk.Dialog(title="Tune Hibernation Image", transient_for=self, flags=0)
+        dialog.add_buttons(Gtk.STOCK_OK, Gtk.ResponseType.OK, Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        dialog.set_default_size(400, 200)
+        content_area = dialog.get_content_area()
+        content_area.set_spacing(10)
+
+        content_area.add(Gtk.Label(label=format_tuning(result)))
+        content_area.add(Gtk.Label(label="Select the image size and compressor to use, the fastest is selected:"))
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
+        radios = []
+        for candidate in result["candidates"]:
+            radio = Gtk.RadioButton.new_with_label_from_widget(
+                radios[0] if radios else None,
+                f"{candidate['compressor']}, {candidate['label']} image: {candidate['total']:.1f}s in total",
+            )
+            box.pack_start(radio, False, False, 0)
+            radios.append(radio)
+        content_area.add(box)
+        dialog.show_all()
+
+        response = dialog.run()
+        if response == Gtk.ResponseType.OK:
+            candidate = next(c for c, radio in zip(result["candidates"], radios) if radio.get_active())
+            compressor = candidate["compressor"] if result["current"]["compressor"] is not None else None
+            self.start_privileged(
+                "tune_hibernation",
+                image_size=candidate["image_size"],
+                compressor=compressor,
+                on_success=lambda job: self.show_message_dialog(
+                    "Hibernation image settings updated."
+                    + ("\n\nRestart for the new compressor to be used." if job.result["kernel_args_changed"] else "")
+                ),
+            )
+        dialog.destroy()
+
+    # 6) (Optional) Set Lid Close Action
+    @TRACER.traced(category="dialog")
     def set_lid_close_action(self, button):
-        print("Setting Lid Close Action...")
+        log.info("Setting Lid Close Action...")
         dialog = Gtk.Dialog(title="Set Lid Close Action", transient_for=self, flags=0)
         dialog.add_buttons(Gtk.STOCK_OK, Gtk.ResponseType.OK, Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
         dialog.set_default_size(300, 150)
@@ -455,63 +4219,123 @@ class SleepConfigApp(Gtk.Window):
                 lid_choice = None
 
             if lid_choice:
-                command = [
-                    "bash", "-c",
-                    (
-                        "mkdir -p /etc/systemd && "
-                        "touch /etc/systemd/logind.conf && "
-                        f"echo -e '[Login]\\nHandleLidSwitch={lid_choice}' > /etc/systemd/logind.conf"
-                    )
-                ]
-                self.pkexec_command(command)
-                self.show_message_dialog(f"Lid close action set to {lid_choice}. Please power off and restart your system for the changes to take effect.")
+                self.apply_config(
+                    SystemdConfig("logind.conf", "Login"),
+                    {"HandleLidSwitch": lid_choice},
+                    f"Lid close action set to {lid_choice}. Please power off and restart your system for the changes to take effect.",
+                )
+        dialog.destroy()
+
+    # 7) (Optional) Audit Sleep Mode and Wakeups
+    @TRACER.traced(category="dialog")
+    def audit_wakeups(self, button):
+        log.info("Auditing the sleep mode and wakeup sources...")
+        snapshot = wakeup_snapshot(pinned=persisted_wakeups())
+        last = last_wakeup()
+        dialog = Gtk.Dialog(title="Audit Sleep Mode and Wakeups", transient_for=self, flags=0)
+        dialog.add_buttons(Gtk.STOCK_OK, Gtk.ResponseType.OK, Gtk.STOCK_CANCEL, Gtk.ResponseType.CANCEL)
+        dialog.set_default_size(500, 400)
+        content_area = dialog.get_content_area()
+        content_area.set_spacing(10)
+
+        summary = format_wakeup_audit(snapshot, last).splitlines()
+        label = Gtk.Label(label="\n".join([summary[0], summary[-1]]), xalign=0)
+        label.set_line_wrap(True)
+        content_area.add(label)
+
+        # deep usually drains far less than s2idle, where the firmware supports it
+        content_area.add(Gtk.Label(label="Suspend mode:", xalign=0))
+        mode_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=10)
+        mode_radios = {}
+        for state in snapshot["mem_sleep"]["available"]:
+            radio = Gtk.RadioButton.new_with_label_from_widget(next(iter(mode_radios.values()), None), state)
+            radio.set_active(state == snapshot["mem_sleep"]["current"])
+            mode_box.pack_start(radio, False, False, 0)
+            mode_radios[state] = radio
+        content_area.add(mode_box)
+
+        fired = {source["device"]: source["wakeups"] for source in (last or {}).get("fired", [])}
+        content_area.add(Gtk.Label(label="Devices allowed to wake the system:", xalign=0))
+        device_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=5)
+        device_checks = {}
+        for device, state in sorted(snapshot["devices"].items()):
+            text = f"{device} ({state['driver'] or 'no driver'})"
+            if device in fired:
+                text += f", woke the last suspend {fired[device]}x"
+            check = Gtk.CheckButton(label=text)
+            check.set_active(state["enabled"])
+            device_box.pack_start(check, False, False, 0)
+            device_checks[device] = check
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.set_vexpand(True)
+        scrolled.add(device_box)
+        content_area.pack_start(scrolled, True, True, 0)
+
+        record_check = None
+        if not os.path.exists(SLEEP_HOOK_PATH):
+            record_check = Gtk.CheckButton(label="Record which devices wake the system from suspend")
+            record_check.set_active(True)
+            content_area.add(record_check)
+        dialog.show_all()
+
+        response = dialog.run()
+        if response == Gtk.ResponseType.OK:
+            if record_check is not None and record_check.get_active():
+                self.start_privileged("install_sleep_hook")
+            # Only what the user changed, an untouched mode must not end up on the kernel command line
+            mem_sleep = next((state for state, radio in mode_radios.items() if radio.get_active()), None)
+            if mem_sleep == snapshot["mem_sleep"]["current"]:
+                mem_sleep = None
+            wakeup = {
+                device: check.get_active()
+                for device, check in device_checks.items()
+                if check.get_active() != snapshot["devices"][device]["enabled"]
+            }
+            if mem_sleep is None and not wakeup:
+                dialog.destroy()
+                return
+            self.start_privileged(
+                "set_sleep_state",
+                mem_sleep=mem_sleep,
+                wakeup=wakeup,
+                on_success=lambda job: self.show_message_dialog(
+                    "Sleep mode and wakeup sources updated."
+                    + ("\n\nThe suspend mode is also set on the kernel command line." if job.result["kernel_args_changed"] else "")
+                ),
+            )
         dialog.destroy()
 
-    # 6) (Optional) Check Hibernation Settings
+    # 8) (Optional) Check Hibernation Settings
+    @TRACER.traced(category="ui")
     def check_status(self, button):
-        print("Checking Hibernation Settings...")
-        required_packages = ["python3-gobject", "polkit"]
-        missing_packages = []
-        for package in required_packages:
-            result = subprocess.run(["rpm", "-q", package], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if result.returncode != 0:
-                missing_packages.append(package)
-
-        dependencies_status = "All required packages are installed." if not missing_packages else f"Missing packages: {', '.join(missing_packages)}"
-
-        EXTENSION_UUID = "hibernate-status@ctsdownloads"
-        installed_extensions = subprocess.run(["gnome-extensions", "list"], capture_output=True, text=True).stdout
-        extension_status = "Installed" if EXTENSION_UUID in installed_extensions else "Not Installed"
-
-        hibernate_delay = "Not Set"
-        if os.path.exists("/etc/systemd/sleep.conf"):
-            with open("/etc/systemd/sleep.conf", "r") as file:
-                lines = file.readlines()
-                for line in lines:
-                    if line.strip().startswith("HibernateDelaySec="):
-                        hibernate_delay = line.strip().split('=')[1]
-                        break
-
-        lid_action = "Unknown"
-        if os.path.exists("/etc/systemd/logind.conf"):
-            with open("/etc/systemd/logind.conf", "r") as file:
-                for line in file:
-                    if line.strip().startswith("HandleLidSwitch="):
-                        lid_action = line.strip().split('=')[1]
-                        break
-
-        status_message = (
-            f"Dependencies: {dependencies_status}\n"
-            f"GNOME Extension: {extension_status}\n"
-            f"Suspend-then-Hibernate Time: {hibernate_delay}\n"
-            f"Lid Close Action: {lid_action}"
-        )
-        self.show_message_dialog(status_message)
+        # Files are watched, but the journal and anything missed are only read again on request
+        log.info("Checking Hibernation Settings...")
+        self.status_panel.refresh()
+        # Reading the audit log needs root, the panel picks up the new summary through its file monitor
+        self.start_privileged("scan_audit", on_success=lambda job: self.status_panel.refresh(["selinux"]))
+
+    def report_startup(self, spawned, imported, constructed):
+        # Print the startup timings once the first frame is drawn, then quit
+        def on_first_frame(widget, context):
+            print(
+                f"{STARTUP_PROBE_MARKER} imports={imported - spawned:.4f} css={self.css_seconds:.4f} "
+                f"window={constructed - imported:.4f} first_frame={time.time() - spawned:.4f}",
+                flush=True,
+            )
+            GLib.idle_add(Gtk.main_quit)
+            self.disconnect(handler)
+            return False
+
+        handler = self.connect_after("draw", on_first_frame)
 
     def on_exit_clicked(self, button):
-        print("Exiting application...")
+        log.info("Exiting application...")
+        self.helper.close()
         Gtk.main_quit()
 
 if __name__ == "__main__":
+    imported = time.time()
     app = SleepConfigApp()
+    if os.environ.get(STARTUP_PROBE_ENV):
+        app.report_startup(float(os.environ[STARTUP_PROBE_ENV]), imported, time.time())
     Gtk.main()
@@ -0,0 +1,24 @@
+import pathlib
+import types
+
+import pytest
+
+SCRIPT = pathlib.Path(__file__).resolve().parent.parent / "Suspend-then-Hibernate-settings.py"
+DATA = pathlib.Path(__file__).resolve().parent / "data"
+# The window's half of the script starts here, everything above runs without Gtk
+GUI_IMPORT = "\nimport gi  # noqa: E402\n"
+
+
+@pytest.fixture(scope="session")
+def app():
+    """The headless half of the script as a module, the part the command line modes and the helper run."""
+    source = SCRIPT.read_text()
+    module = types.ModuleType("suspend_then_hibernate_settings")
+    module.__file__ = str(SCRIPT)
+    exec(compile(source[:source.index(GUI_IMPORT)], str(SCRIPT), "exec"), module.__dict__)
+    return module
+
+
+@pytest.fixture
+def data():
+    return DATA
@@ -0,0 +1,41 @@
+"""python-dbusmock template standing in for GNOME Shell's org.gnome.Shell.Extensions interface.
+
+The ``extensions`` parameter lists the UUIDs of the installed extensions,
+which all start disabled.
+"""
+import dbus
+
+BUS_NAME = "org.gnome.Shell"
+MAIN_OBJ = "/org/gnome/Shell"
+MAIN_IFACE = "org.gnome.Shell.Extensions"
+SYSTEM_BUS = False
+
+# ExtensionState values of GNOME Shell
+ENABLED = 1.0
+DISABLED = 2.0
+UNINSTALLED = 99.0
+
+
+def load(mock, parameters):
+    mock.extensions = {
+        uuid: dbus.Dictionary({"uuid": uuid, "state": dbus.Double(DISABLED)}, signature="sv")
+        for uuid in parameters.get("extensions", [])
+    }
+
+    def set_state(uuid, state):
+        if uuid not in mock.extensions:
+            return False
+        info = mock.extensions[uuid]
+        info["state"] = dbus.Double(state)
+        if state == UNINSTALLED:
+            del mock.extensions[uuid]
+        mock.EmitSignal(MAIN_IFACE, "ExtensionStateChanged", "sa{sv}", [uuid, info])
+        return True
+
+    mock.set_state = set_state
+    mock.AddMethods(MAIN_IFACE, [
+        ("ListExtensions", "", "a{sa{sv}}", "ret = dbus.Dictionary(self.extensions, signature='sa{sv}')"),
+        ("EnableExtension", "s", "b", f"ret = self.set_state(args[0], {ENABLED})"),
+        ("DisableExtension", "s", "b", f"ret = self.set_state(args[0], {DISABLED})"),
+        ("UninstallExtension", "s", "b", f"ret = self.set_state(args[0], {UNINSTALLED})"),
+    ])
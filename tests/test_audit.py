@@ -0,0 +1,38 @@
+import pytest
+
+SWAP_PATH = (
+    b'type=AVC msg=audit(1700000000.123:42): avc:  denied  { read write } for  pid=1 comm="systemd-sleep" '
+    b'path="/swap/my swapfile" dev="dm-0" ino=12 scontext=system_u:system_r:init_t:s0 '
+    b'tcontext=system_u:object_r:var_t:s0 tclass=file permissive=0'
+)
+SWAP_NAME = (
+    b'type=AVC msg=audit(1700000000.123:43): avc:  denied  { write } for  pid=1 comm="systemd-sleep" '
+    b'name="swapfile" dev="dm-0" ino=12 scontext=system_u:system_r:init_t:s0 '
+    b'tcontext=system_u:object_r:var_t:s0 tclass=file permissive=0'
+)
+POLICY = (
+    b'type=AVC msg=audit(1700000000.123:44): avc:  denied  { read } for  pid=1 comm="sleep hook;x" '
+    b'name="wakeup" scontext=system_u:system_r:init_t:s0 '
+    b'tcontext=system_u:object_r:sysfs_t:s0 tclass=file permissive=1'
+)
+
+
+def test_parse_avc(app):
+    denial = app.parse_avc(SWAP_PATH)
+    assert denial["time"] == pytest.approx(1700000000.123)
+    assert denial["comm"] == "systemd-sleep"
+    assert denial["permissions"] == ["read", "write"]
+    assert (denial["path"], denial["tcontext"], denial["tclass"]) == ("/swap/my swapfile", "var_t", "file")
+    assert not denial["permissive"]
+    assert app.hibernation_related(denial)
+
+
+@pytest.mark.parametrize("line, fix", [
+    (SWAP_PATH, "semanage fcontext -a -t swapfile_t '/swap/my\\ swapfile' && restorecon -v '/swap/my swapfile'"),
+    # Nothing tells which swap file it is
+    (SWAP_NAME, "semanage fcontext -a -t swapfile_t <path of swapfile> && restorecon -v <path of swapfile>"),
+    (POLICY, "ausearch -m AVC -c 'sleep hook;x' --raw | audit2allow -M hibernate-sleep-hook-x "
+             "&& semodule -i hibernate-sleep-hook-x.pp"),
+])
+def test_suggest_avc_fix(app, line, fix):
+    assert app.suggest_avc_fix(app.parse_avc(line)) == fix
@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+HOUR = 3600
+FULL = 50_000_000
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def supply(root, name, **attributes):
+    for attribute, value in attributes.items():
+        write(root / "class" / "power_supply" / name / attribute, f"{value}\n")
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    """A /sys with two batteries, a wireless mouse and the AC adapter."""
+    root = tmp_path / "sys"
+    write(root / "power" / "mem_sleep", "s2idle [deep]\n")
+    supply(root, "AC", type="Mains", online=1)
+    supply(root, "BAT0", type="Battery", scope="System", energy_now=30_000_000, energy_full=FULL)
+    # No scope attribute, as with most laptop batteries
+    supply(root, "BAT1", type="Battery", energy_now=10_000_000, energy_full=20_000_000)
+    supply(root, "hidpp_battery_0", type="Battery", scope="Device", energy_now=1_000, energy_full=2_000)
+    return root
+
+
+def cycle(start, level, drained, hours, mem_sleep="deep", action="suspend"):
+    """A pre and post sample around one suspend, levels as fractions of a full battery."""
+    pre = {"time": start, "phase": "pre", "mem_sleep": mem_sleep, "action": action, "unit": "energy",
+           "level": int(level * FULL), "full": FULL}
+    post = dict(pre, time=start + hours * HOUR, phase="post", level=int((level - drained) * FULL))
+    return [pre, post]
+
+
+def test_read_battery_skips_peripherals(app, sysfs):
+    assert app.read_battery(str(sysfs)) == ("energy", 40_000_000, 70_000_000)
+
+
+def test_read_battery_charge_fallback(app, tmp_path):
+    supply(tmp_path, "BAT0", type="Battery", charge_now=2_000_000, charge_full=4_000_000)
+    assert app.read_battery(str(tmp_path)) == ("charge", 2_000_000, 4_000_000)
+    assert app.read_battery(str(tmp_path / "missing")) is None
+
+
+def test_battery_log_wraps_around(app, tmp_path):
+    log = app.BatteryLog(str(tmp_path / "battery.bin"), capacity=4)
+    assert log.records() == []
+    for index in range(6):
+        log.append(float(index), index % 2, 2, 0, 0, 1000 - index, 2000)
+    size = os.path.getsize(log.path)
+    assert [record["time"] for record in log.records()] == [2.0, 3.0, 4.0, 5.0]
+    record = log.records()[-1]
+    assert (record["phase"], record["mem_sleep"], record["action"], record["unit"]) == (
+        "post", "deep", "suspend", "energy",
+    )
+    log.append(6.0, 0, app.UNKNOWN_CODE, app.UNKNOWN_CODE, 0, 994, 2000)
+    assert os.path.getsize(log.path) == size
+    assert log.records()[-1]["mem_sleep"] is None and log.records()[-1]["action"] is None
+    assert [record["time"] for record in log.records()] == [3.0, 4.0, 5.0, 6.0]
+
+
+def test_battery_log_rejects_other_files(app, tmp_path):
+    path = tmp_path / "battery.bin"
+    path.write_bytes(b"not a battery log at all")
+    with pytest.raises(ValueError, match="not a battery log"):
+        app.BatteryLog(str(path)).records()
+
+
+def test_record_battery(app, sysfs, tmp_path):
+    log = app.BatteryLog(str(tmp_path / "battery.bin"), capacity=4)
+    assert app.record_battery("pre", "suspend", str(sysfs), log)["level"] == 40_000_000
+    assert app.record_battery("post", "suspend", str(sysfs), log)["mem_sleep"] == "deep"
+    assert [(record["phase"], record["level"]) for record in log.records()] == [
+        ("pre", 40_000_000), ("post", 40_000_000),
+    ]
+    assert app.record_battery("pre", "suspend", str(tmp_path / "no-battery"), log) is None
+
+
+def test_suspend_drain_filters(app):
+    records = (
+        cycle(0, 0.9, 0.05, 2)
+        # Too short to tell sleep from entry and resume
+        + cycle(10 * HOUR, 0.9, 0.01, 0.1)
+        # Hibernated part of the time
+        + cycle(20 * HOUR, 0.9, 0.05, 8, action="suspend-then-hibernate")[:1]
+        + cycle(20 * HOUR, 0.9, 0.05, 8, action="hibernate")[1:]
+        + cycle(30 * HOUR, 0.8, 0.12, 4, mem_sleep="s2idle")
+        # A pre sample without its post, the resume was not recorded
+        + cycle(40 * HOUR, 0.9, 0.1, 1)[:1]
+        + cycle(50 * HOUR, 0.9, 0.02, 1)
+    )
+    drains = app.suspend_drain(records)
+    assert drains == {"deep": [pytest.approx(0.025), pytest.approx(0.02)], "s2idle": [pytest.approx(0.03)]}
+
+
+def test_adaptive_delay_needs_enough_suspends(app):
+    records = cycle(0, 0.9, 0.05, 2) + cycle(10 * HOUR, 0.9, 0.05, 2)
+    assert app.adaptive_hibernate_delay(records) is None
+    assert "at least 3" in app.format_adaptive_delay(None)
+
+
+def test_adaptive_delay_keeps_the_reserve(app):
+    records = [record for start in range(3) for record in cycle(start * 10 * HOUR, 0.9, 0.1, 2)]
+    recommendation = app.adaptive_hibernate_delay(records, reserve=0.2)
+    assert recommendation["drain_per_hour"] == pytest.approx(0.05)
+    assert recommendation["start_level"] == pytest.approx(0.9)
+    # 0.7 of the battery at 5% an hour
+    assert recommendation["delay"] == pytest.approx(14 * HOUR, abs=1)
+    assert app.adaptive_hibernate_delay(records, reserve=0.5)["delay"] == pytest.approx(8 * HOUR, abs=1)
+
+
+@pytest.mark.parametrize("drained, delay", [(0, 24 * HOUR), (0.8, 15 * 60)])
+def test_adaptive_delay_is_clamped(app, drained, delay):
+    records = [record for start in range(3) for record in cycle(start * 10 * HOUR, 0.9, drained, 0.25)]
+    assert app.adaptive_hibernate_delay(records)["delay"] == delay
@@ -0,0 +1,120 @@
+import hashlib
+import http.server
+import io
+import threading
+import zipfile
+
+import pytest
+
+
+def extension_zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    return buffer.getvalue()
+
+
+ARCHIVE = extension_zip({
+    "extension-master/metadata.json": '{"uuid": "hibernate-status@ctsdownloads"}',
+    "extension-master/extension.js": "// extension",
+})
+ETAG = '"archive-1"'
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    """Serves ARCHIVE with an ETag and answers 304 when the client already has it."""
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(ARCHIVE)))
+        self.end_headers()
+        self.wfile.write(ARCHIVE)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    for name in ("http_proxy", "HTTP_PROXY", "all_proxy", "ALL_PROXY"):
+        monkeypatch.delenv(name, raising=False)
+    httpd = http.server.HTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    httpd.requests = []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/master.zip"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_revalidate_and_offline(app, server, tmp_path):
+    archive, status = app.fetch_extension_archive(server.url, str(tmp_path))
+    assert status == "downloaded"
+    with open(archive, "rb") as f:
+        assert f.read() == ARCHIVE
+
+    assert app.fetch_extension_archive(server.url, str(tmp_path)) == (archive, "not-modified")
+    assert server.requests[-1]["If-None-Match"] == ETAG
+
+    server.shutdown()
+    server.server_close()
+    assert app.fetch_extension_archive(server.url, str(tmp_path)) == (archive, "offline")
+
+
+def test_corrupted_cache_is_downloaded_again(app, server, tmp_path):
+    archive, status = app.fetch_extension_archive(server.url, str(tmp_path))
+    with open(archive, "ab") as f:
+        f.write(b"garbage")
+    assert app.fetch_extension_archive(server.url, str(tmp_path)) == (archive, "downloaded")
+    assert "If-None-Match" not in server.requests[-1]
+
+
+def test_checksum_mismatch(app, server, tmp_path):
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        app.fetch_extension_archive(server.url, str(tmp_path), sha256="0" * 64)
+    # Nothing is left behind, not even the partial download
+    assert list(tmp_path.iterdir()) == []
+
+    expected = hashlib.sha256(ARCHIVE).hexdigest()
+    archive, status = app.fetch_extension_archive(server.url, str(tmp_path), sha256=expected)
+    assert status == "downloaded"
+
+
+def test_extract_strips_top_level_folder(app, tmp_path):
+    archive = tmp_path / "extension.zip"
+    archive.write_bytes(ARCHIVE)
+    staging = tmp_path / "staging"
+    staging.mkdir()
+    assert app.extract_extension(str(archive), str(staging)) == {"uuid": "hibernate-status@ctsdownloads"}
+    assert sorted(path.name for path in staging.iterdir()) == ["extension.js", "metadata.json"]
+
+
+def test_installed_directory_is_readable_by_everyone(app, tmp_path):
+    archive = tmp_path / "extension.zip"
+    archive.write_bytes(ARCHIVE)
+    extensions = tmp_path / "extensions"
+    assert app.install_extension_archive(str(archive), str(extensions), enable=False) == (
+        "hibernate-status@ctsdownloads", False,
+    )
+    assert [path.name for path in extensions.iterdir()] == ["hibernate-status@ctsdownloads"]
+    assert (extensions / "hibernate-status@ctsdownloads").stat().st_mode & 0o777 == 0o755
+
+
+@pytest.mark.parametrize("name", ["extension-master/../../evil.js", "extension-master/../staging-evil/x.js"])
+def test_extract_rejects_zip_slip(app, tmp_path, name):
+    archive = tmp_path / "extension.zip"
+    archive.write_bytes(extension_zip({"extension-master/metadata.json": '{"uuid": "x@y"}', name: "evil"}))
+    staging = tmp_path / "staging"
+    staging.mkdir()
+    with pytest.raises(RuntimeError, match="Unsafe path"):
+        app.extract_extension(str(archive), str(staging))
+    assert not (tmp_path / "evil.js").exists()
+    assert not (tmp_path / "staging-evil").exists()
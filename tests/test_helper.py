@@ -0,0 +1,80 @@
+import sys
+import time
+
+import pytest
+
+from conftest import SCRIPT
+
+
+@pytest.fixture
+def helper(app):
+    """The real helper protocol, with the helper started directly instead of through pkexec."""
+    helper = app.PrivilegedHelper(command=[sys.executable, str(SCRIPT), "--helper"])
+    yield helper
+    process = helper._process
+    helper.close()
+    if process is not None:
+        process.wait(10)
+
+
+def script(text):
+    return {"op": "run_script", "args": {"script": text}}
+
+
+def test_batch_runs_in_order(helper):
+    request = helper.request("batch", requests=[script("echo one"), script("echo two")]).start()
+    assert request.wait(10) == 0
+    assert request.stdout.splitlines() == ["one", "two"]
+    assert request.result == [{}, {}]
+
+
+def test_batch_stops_at_the_first_failure(helper):
+    request = helper.request("batch", requests=[
+        script("echo one"),
+        script("exit 3"),
+        script("echo three"),
+    ]).start()
+    assert request.wait(10) == 1
+    assert "exited with code 3" in request.error
+    assert request.stdout.splitlines() == ["one"]
+    # The helper keeps serving after a failed request
+    assert helper.call("run_script", script="true") == {}
+
+
+@pytest.mark.parametrize("path", ["/tmp/evil.conf", "/etc/systemd/../passwd"])
+def test_write_file_outside_the_prefixes(helper, path):
+    with pytest.raises(RuntimeError, match="PermissionError: Writing .* is not allowed"):
+        helper.call("write_file", path=path, content="")
+
+
+def test_unknown_operation(helper):
+    with pytest.raises(RuntimeError, match="Unknown operation"):
+        helper.call("format_disk")
+
+
+def test_cancel(helper):
+    request = helper.request("run_script", script="echo started; sleep 30").start()
+    deadline = time.monotonic() + 10
+    while "started" not in request.stdout:
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+    start = time.monotonic()
+    request.cancel()
+    assert request.wait(10) == 1
+    assert time.monotonic() - start < 5
+    assert request.cancelled
+    assert "Cancelled" in request.error
+
+
+def test_queues_run_concurrently(helper):
+    # Started once, so that its start up is not timed
+    helper.call("run_script", script="true")
+    start = time.monotonic()
+    requests = [helper.request("run_script", queue=name, script="sleep 1").start() for name in ("a", "b")]
+    assert [request.wait(10) for request in requests] == [0, 0]
+    assert time.monotonic() - start < 1.8
+
+    start = time.monotonic()
+    requests = [helper.request("run_script", script="sleep 1").start() for _ in range(2)]
+    assert [request.wait(10) for request in requests] == [0, 0]
+    assert time.monotonic() - start >= 2
@@ -0,0 +1,21 @@
+import subprocess
+import time
+
+
+def test_cancel_stops_the_process_group(app):
+    job = app.Job(["bash", "-c", "sleep 30 & wait"]).start()
+    start = time.monotonic()
+    job.cancel()
+    assert job.wait(10) is not None
+    assert job.cancelled
+    assert time.monotonic() - start < 5
+
+
+def test_cancel_after_the_process_exited(app):
+    # The process is gone before the job collected its return code
+    job = app.Job(["true"])
+    job._process = subprocess.Popen(["true"])
+    job._process.wait()
+    job.cancel()
+    assert job.cancelled
+    assert job.returncode is None
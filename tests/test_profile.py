@@ -0,0 +1,44 @@
+import subprocess
+import sys
+
+import pytest
+
+from conftest import SCRIPT
+
+
+@pytest.mark.parametrize("content", ["[]", '"x"', "3"])
+def test_profile_must_be_an_object(app, tmp_path, content):
+    path = tmp_path / "profile.json"
+    path.write_text(content)
+    with pytest.raises(ValueError, match="must be an object"):
+        app.load_profile(str(path))
+
+
+def test_invalid_profile_exit_code(tmp_path):
+    path = tmp_path / "profile.json"
+    path.write_text("[]")
+    result = subprocess.run(
+        [sys.executable, str(SCRIPT), "--apply", str(path), "--dry-run"], capture_output=True, text=True,
+    )
+    assert result.returncode == 2
+    assert f"Invalid profile {path}" in result.stdout
+    assert "Traceback" not in result.stderr
+
+
+def test_toml_without_a_parser(app, tmp_path, monkeypatch):
+    # None in sys.modules makes the import fail
+    monkeypatch.setitem(sys.modules, "tomllib", None)
+    monkeypatch.setitem(sys.modules, "tomli", None)
+    path = tmp_path / "profile.toml"
+    path.write_text('HibernateDelaySec = "3600"\n')
+    with pytest.raises(ValueError, match="python3-tomli"):
+        app.load_profile(str(path))
+
+
+def test_keys_are_checked(app, tmp_path):
+    path = tmp_path / "profile.toml"
+    path.write_text('HibernateDelaySec = "3600"\nextension = "installed"\n')
+    assert app.load_profile(str(path)) == {"HibernateDelaySec": "3600", "extension": "installed"}
+    path.write_text('HibernateDelay = "3600"\n')
+    with pytest.raises(ValueError, match="Unknown profile keys: HibernateDelay"):
+        app.load_profile(str(path))
@@ -0,0 +1,99 @@
+import os
+import pathlib
+import subprocess
+import time
+
+import pytest
+
+dbusmock = pytest.importorskip("dbusmock")
+pytest.importorskip("gi")
+from gi.repository import Gio, GLib  # noqa: E402
+
+TEMPLATE = str(pathlib.Path(__file__).resolve().parent / "gnome_shell_mock.py")
+UUID = "hibernate-status@ctsdownloads"
+OTHER = "appindicatorsupport@rgcjonas.gmail.com"
+ENABLED, DISABLED = 1.0, 2.0
+
+
+def wait_for(condition, timeout=5):
+    # Signals reach the proxy through the main context of this thread
+    context = GLib.MainContext.default()
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        if not context.iteration(False):
+            time.sleep(0.01)
+
+
+class TestShellExtensions(dbusmock.DBusTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.start_session_bus()
+
+    @pytest.fixture(autouse=True)
+    def client(self, app):
+        self.start_shell([UUID, OTHER])
+        self.bus = Gio.DBusConnection.new_for_address_sync(
+            os.environ["DBUS_SESSION_BUS_ADDRESS"],
+            Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT | Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION,
+            None, None,
+        )
+        self.client = app.ShellExtensions(self.bus)
+        yield
+        self.stop_shell()
+        self.bus.close_sync(None)
+
+    def start_shell(self, extensions):
+        self.shell, self.shell_object = self.spawn_server_template(
+            TEMPLATE, {"extensions": extensions}, stdout=subprocess.PIPE,
+        )
+
+    def stop_shell(self):
+        if self.shell.poll() is None:
+            self.shell.stdout.close()
+            self.shell.terminate()
+            self.shell.wait()
+
+    def list_calls(self):
+        return len(self.shell_object.GetMethodCalls("ListExtensions", dbus_interface=dbusmock.MOCK_IFACE))
+
+    def test_list_is_fetched_once(self):
+        assert self.client.available
+        assert set(self.client.list()) == {UUID, OTHER}
+        assert self.client.is_installed(UUID)
+        assert not self.client.is_installed("missing@example.com")
+        assert self.list_calls() == 1
+
+    def test_enable_and_disable_update_the_cache(self):
+        assert self.client.list()[UUID]["state"] == DISABLED
+        assert self.client.enable(UUID)
+        wait_for(lambda: self.client.list()[UUID]["state"] == ENABLED)
+        assert self.client.disable(UUID)
+        wait_for(lambda: self.client.list()[UUID]["state"] == DISABLED)
+        assert not self.client.enable("missing@example.com")
+        assert self.list_calls() == 1
+
+    def test_uninstall(self):
+        self.client.list()
+        assert self.client.uninstall(UUID)
+        assert set(self.client.list()) == {OTHER}
+        assert not self.client.uninstall(UUID)
+        assert self.list_calls() == 1
+
+    def test_uninstalled_elsewhere(self):
+        # Another client (Extensions app, gnome-extensions) removes one
+        self.client.list()
+        self.shell_object.UninstallExtension(OTHER, dbus_interface="org.gnome.Shell.Extensions")
+        wait_for(lambda: OTHER not in self.client.list())
+        assert self.list_calls() == 1
+
+    def test_cache_dropped_when_the_shell_restarts(self):
+        assert set(self.client.list()) == {UUID, OTHER}
+        self.stop_shell()
+        wait_for(lambda: not self.client.available)
+        with pytest.raises(RuntimeError, match="not running"):
+            self.client.enable(UUID)
+        self.start_shell([OTHER])
+        wait_for(lambda: self.client.available)
+        assert set(self.client.list()) == {OTHER}
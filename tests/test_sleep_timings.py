@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+# sleep-cycles.export was recorded in the journal export format: an s2idle
+# suspend, a deep suspend and a hibernation, one message in the binary field
+# encoding, and an unrelated kernel message before them.
+EXPECTED_CYCLES = [
+    ("suspend", "s2idle", {"entry": 0.25, "freeze": 0.02, "suspend": 0.5, "resume": 0.25, "total": 600.0}),
+    ("suspend", "deep", {"entry": 0.5, "freeze": 0.03, "suspend": 0.5, "resume": 0.25, "total": 1800.0}),
+    ("hibernate", None, {
+        "entry": 1.0, "freeze": 0.05, "image_write": 4.0, "hibernate": 4.0, "resume": 0.5, "total": 3600.0,
+    }),
+]
+
+
+def parse(app, entries, parser=None):
+    parser = parser or app.SleepCycleParser()
+    for entry in entries:
+        parser.feed(entry)
+    return parser
+
+
+def check_cycles(cycles):
+    assert [(cycle["mode"], cycle["mem_sleep"]) for cycle in cycles] == [cycle[:2] for cycle in EXPECTED_CYCLES]
+    for cycle, (mode, mem_sleep, phases) in zip(cycles, EXPECTED_CYCLES):
+        assert cycle["phases"] == pytest.approx(phases)
+
+
+def test_export_fixture_phases(app, data):
+    parser = parse(app, app.read_journal_file(data / "sleep-cycles.export"))
+    check_cycles(parser.cycles)
+    assert parser.current is None
+    assert parser.cursor.startswith("s=5f1d;i=11;")
+
+
+def test_json_format_matches_export(app, data, tmp_path):
+    entries = list(app.read_journal_file(data / "sleep-cycles.export"))
+    recorded = tmp_path / "sleep-cycles.json"
+    recorded.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+    check_cycles(parse(app, app.read_journal_file(recorded)).cycles)
+
+
+@pytest.mark.parametrize("split", [3, 8, 14])
+def test_resume_from_cursor(app, data, split):
+    # Stop part way, possibly in the middle of a cycle, and go on from the saved state
+    entries = list(app.read_journal_file(data / "sleep-cycles.export"))
+    first = parse(app, entries[:split])
+    assert first.cursor == entries[split - 1]["__CURSOR"]
+    state = json.loads(json.dumps(first.state()))
+    # What journalctl --after-cursor returns
+    cursors = [entry["__CURSOR"] for entry in entries]
+    remaining = entries[cursors.index(state["cursor"]) + 1:]
+    check_cycles(parse(app, remaining, app.SleepCycleParser(state)).cycles)
+
+
+def test_summary_and_probe(app, data):
+    result = app.probe_sleep_timings(journal_file=str(data / "sleep-cycles.export"))
+    assert result["cycles"] == 3
+    assert set(result["summary"]) == {"suspend (s2idle)", "suspend (deep)", "hibernate"}
+    deep = result["summary"]["suspend (deep)"]
+    assert deep["count"] == 1
+    assert deep["phases"]["entry"] == {"p50": 0.5, "p90": 0.5, "p99": 0.5, "max": 0.5}
+    assert "Last hibernate: entry 1000 ms" in app.format_sleep_timings(result)
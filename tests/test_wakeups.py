@@ -0,0 +1,143 @@
+import os
+import shutil
+
+import pytest
+
+XHCI = "devices/pci0000:00/0000:00:14.0"
+LID = "devices/platform/PNP0C0D:00"
+LPC = "devices/pci0000:00/0000:00:1f.0"
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def register(root, device, count, index):
+    """What the kernel does when a device's wakeup is enabled."""
+    source = root / "class" / "wakeup" / f"wakeup{index}"
+    write(source / "wakeup_count", f"{count}\n")
+    os.symlink(os.path.relpath(root / device, source), source / "device")
+
+
+def unregister(root, device):
+    """What the kernel does when a device's wakeup is disabled."""
+    for source in (root / "class" / "wakeup").iterdir():
+        if (source / "device").resolve() == (root / device).resolve():
+            shutil.rmtree(source)
+
+
+@pytest.fixture
+def sysfs(tmp_path):
+    """A /sys with two enabled wakeup devices and a disabled one."""
+    root = tmp_path / "sys"
+    write(root / "power" / "mem_sleep", "[s2idle] deep\n")
+    for device, enabled in [(XHCI, True), (LID, True), (LPC, False)]:
+        write(root / device / "power" / "wakeup", "enabled\n" if enabled else "disabled\n")
+        # Empty while the device has no wakeup source
+        write(root / device / "power" / "wakeup_count", "\n")
+    register(root, XHCI, 3, 0)
+    register(root, LID, 1, 1)
+    # A wakeup source of the kernel itself, without a device
+    write(root / "class" / "wakeup" / "wakeup2" / "wakeup_count", "7\n")
+    # A device that cannot wake the system, with a power directory all the same
+    write(root / "devices" / "pci0000:00" / "0000:00:02.0" / "power" / "control", "auto\n")
+    driver = root / "bus" / "pci" / "drivers" / "xhci_hcd"
+    driver.mkdir(parents=True)
+    os.symlink(os.path.relpath(driver, root / XHCI), root / XHCI / "driver")
+    return root
+
+
+class Session:
+    def __init__(self, args=""):
+        self.args = args
+        self.commands = []
+
+    def log(self, line):
+        pass
+
+    def run(self, command):
+        self.commands.append(command)
+        return f'args="{self.args}"\n' if command == ["grubby", "--info=DEFAULT"] else ""
+
+
+def test_wakeup_devices(app, sysfs):
+    assert app.wakeup_devices(str(sysfs)) == {
+        XHCI: {"enabled": True, "wakeup_count": 3, "driver": "xhci_hcd"},
+        LID: {"enabled": True, "wakeup_count": 1, "driver": None},
+        LPC: {"enabled": False, "wakeup_count": None, "driver": None},
+    }
+    # What the sleep hook reads
+    assert set(app.wakeup_devices(str(sysfs), scan=False)) == {XHCI, LID}
+    assert set(app.wakeup_devices(str(sysfs), pinned=[LPC], scan=False)) == {XHCI, LID, LPC}
+
+
+def test_fired_wakeup_sources(app, sysfs):
+    before = app.wakeup_snapshot(str(sysfs), str(sysfs.parent / "proc"))
+    assert before["mem_sleep"] == {"available": ["s2idle", "deep"], "current": "s2idle"}
+    (sysfs / "class" / "wakeup" / "wakeup0" / "wakeup_count").write_text("5\n")
+    (sysfs / "class" / "wakeup" / "wakeup1" / "wakeup_count").write_text("2\n")
+    after = app.wakeup_snapshot(str(sysfs), str(sysfs.parent / "proc"))
+    assert app.fired_wakeup_sources(before, after) == [
+        {"device": XHCI, "driver": "xhci_hcd", "wakeups": 2},
+        {"device": LID, "driver": None, "wakeups": 1},
+    ]
+
+
+def test_only_changed_devices_are_persisted(app, sysfs, tmp_path):
+    tmpfiles = str(tmp_path / "wakeup.conf")
+    session = Session()
+    app.apply_sleep_state({"wakeup": {XHCI: False}}, session, str(sysfs), tmpfiles)
+    assert (sysfs / XHCI / "power" / "wakeup").read_text() == "disabled"
+    assert app.persisted_wakeups(tmpfiles) == {XHCI: {"enabled": False, "default": True}}
+    assert session.commands == []
+
+    # A later change keeps the earlier one
+    app.apply_sleep_state({"wakeup": {LPC: True}}, session, str(sysfs), tmpfiles)
+    assert app.persisted_wakeups(tmpfiles) == {
+        XHCI: {"enabled": False, "default": True},
+        LPC: {"enabled": True, "default": False},
+    }
+
+    with pytest.raises(ValueError, match="cannot wake"):
+        app.apply_sleep_state({"wakeup": {"devices/missing": True}}, session, str(sysfs), tmpfiles)
+
+
+def test_disable_then_enable(app, sysfs, tmp_path):
+    tmpfiles = str(tmp_path / "wakeup.conf")
+    app.apply_sleep_state({"wakeup": {XHCI: False}}, Session(), str(sysfs), tmpfiles)
+    unregister(sysfs, XHCI)
+    # Still listed, so the user can turn it back on
+    assert app.wakeup_devices(str(sysfs))[XHCI]["enabled"] is False
+
+    app.apply_sleep_state({"wakeup": {XHCI: True}}, Session(), str(sysfs), tmpfiles)
+    assert (sysfs / XHCI / "power" / "wakeup").read_text() == "enabled"
+    # Back to the kernel's default, nothing is left pinned
+    assert not os.path.exists(tmpfiles)
+
+
+def test_pin_after_reboot(app, sysfs, tmp_path):
+    tmpfiles = tmp_path / "wakeup.conf"
+    app.apply_sleep_state({"wakeup": {XHCI: False, LPC: True}}, Session(), str(sysfs), str(tmpfiles))
+    assert tmpfiles.read_text().splitlines()[1:] == [
+        f"# {XHCI} defaults to enabled",
+        f"w /sys/{XHCI}/power/wakeup - - - - disabled",
+        f"# {LPC} defaults to disabled",
+        f"w /sys/{LPC}/power/wakeup - - - - enabled",
+    ]
+    # tmpfiles.d applied the pins on boot, the default is taken from the file
+    app.apply_sleep_state({"wakeup": {LPC: False}}, Session(), str(sysfs), str(tmpfiles))
+    assert app.persisted_wakeups(str(tmpfiles)) == {XHCI: {"enabled": False, "default": True}}
+
+
+def test_mem_sleep(app, sysfs, tmp_path):
+    tmpfiles = str(tmp_path / "wakeup.conf")
+    session = Session("ro quiet")
+    result = app.apply_sleep_state({"mem_sleep": "deep"}, session, str(sysfs), tmpfiles)
+    assert result["kernel_args_changed"]
+    assert (sysfs / "power" / "mem_sleep").read_text() == "deep"
+    assert session.commands[-1] == ["grubby", "--update-kernel=ALL", "--args=mem_sleep_default=deep"]
+    assert not os.path.exists(tmpfiles)
+
+    with pytest.raises(ValueError, match="Unsupported"):
+        app.apply_sleep_state({"mem_sleep": "shallow"}, session, str(sysfs), tmpfiles)